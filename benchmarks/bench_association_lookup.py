@@ -0,0 +1,94 @@
+"""Benchmark collection lookups on user_game with and without its keys.
+
+Builds two copies of the user_game table in a temporary SQLite file, one
+with the old unkeyed layout and one from the current model, fills both with
+the same rows and times the lookups the routes run against them.
+
+Run with:
+python -m benchmarks.bench_association_lookup --rows 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from tracker_app.models import games_owned_table
+
+GAMES_PER_USER = 100
+
+LOOKUPS = {
+    'owns': 'SELECT EXISTS (SELECT 1 FROM {table} WHERE user_id = ? AND game_id = ?)',
+    'user_games': 'SELECT game_id FROM {table} WHERE user_id = ? ORDER BY game_id LIMIT 50',
+    'game_owners': 'SELECT count(*) FROM {table} WHERE game_id = ?',
+}
+
+def create_tables(connection):
+    """Create user_game as it is today and user_game_old as it used to be."""
+    dialect = sqlite.dialect()
+    connection.execute(str(CreateTable(games_owned_table).compile(dialect=dialect)))
+    for index in games_owned_table.indexes:
+        connection.execute(str(CreateIndex(index).compile(dialect=dialect)))
+    connection.execute('CREATE TABLE user_game_old (game_id INTEGER, user_id INTEGER)')
+
+def generate_rows(row_count, game_count):
+    """Yield unique (game_id, user_id) pairs, GAMES_PER_USER per user."""
+    rng = random.Random(1)
+    for user_id in range(1, row_count // GAMES_PER_USER + 1):
+        for game_id in rng.sample(range(1, game_count + 1), GAMES_PER_USER):
+            yield game_id, user_id
+
+def time_lookups(connection, table, params):
+    """Return the mean milliseconds per call of each lookup."""
+    results = {}
+    for name, sql in LOOKUPS.items():
+        sql = sql.format(table=table)
+        start = time.perf_counter()
+        for args in params[name]:
+            connection.execute(sql, args).fetchall()
+        results[name] = (time.perf_counter() - start) * 1000 / len(params[name])
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    connection = sqlite3.connect(path)
+    create_tables(connection)
+
+    rows = list(generate_rows(args.rows, args.games))
+    for table in ('user_game', 'user_game_old'):
+        connection.executemany(f'INSERT INTO {table} VALUES (?, ?)', rows)
+    connection.commit()
+    connection.execute('ANALYZE')
+
+    rng = random.Random(2)
+    user_count = args.rows // GAMES_PER_USER
+    params = {
+        'owns': [rng.choice(rows)[::-1] for _ in range(args.lookups)],
+        'user_games': [(rng.randint(1, user_count),) for _ in range(args.lookups)],
+        'game_owners': [(rng.randint(1, args.games),) for _ in range(args.lookups)],
+    }
+
+    indexed = time_lookups(connection, 'user_game', params)
+    unindexed = time_lookups(connection, 'user_game_old', params)
+
+    print(f'{len(rows)} user_game rows, {args.lookups} lookups each')
+    print(f'{"lookup":<12} {"old ms":>10} {"keyed ms":>10} {"speedup":>10}')
+    for name in LOOKUPS:
+        speedup = unindexed[name] / indexed[name]
+        print(f'{name:<12} {unindexed[name]:>10.3f} {indexed[name]:>10.4f} {speedup:>9.0f}x')
+
+    connection.close()
+    os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Benchmark login throughput through the Flask test client.
+
+Logs users in over and over, first from one thread and then from several at
+once, and reports logins per second and the SQL statements each login runs.
+
+Run with:
+python -m benchmarks.bench_login --rounds 12 --threads 4
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12, help='bcrypt work factor')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--logins', type=int, default=40, help='logins per thread')
+    parser.add_argument('--users', type=int, default=1000)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    # Config reads its settings when tracker_app is first imported
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    os.environ['BCRYPT_LOG_ROUNDS'] = str(args.rounds)
+    os.environ['BCRYPT_THREADS'] = str(args.threads)
+    # Measured on its own by bench_ratelimit
+    os.environ['RATELIMIT_ENABLED'] = '0'
+
+    from sqlalchemy import event
+    from tracker_app import create_app, db
+    from tracker_app.auth.hashing import hash_password
+    from tracker_app.models import User
+
+    app = create_app()
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        db.create_all()
+        password_hash = hash_password('password')
+        db.session.bulk_insert_mappings(User, [
+            {'username': f'user{i}', 'password': password_hash} for i in range(args.users)
+        ])
+        db.session.commit()
+        engine = db.engine
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *a: statements.append(a[2]))
+
+    def login_many(count, offset):
+        client = app.test_client()
+        for i in range(count):
+            username = f'user{(offset + i) % args.users}'
+            response = client.post('/login', data={'username': username, 'password': 'password'})
+            assert response.status_code == 302, response.status_code
+
+    def run(threads):
+        del statements[:]
+        workers = [
+            threading.Thread(target=login_many, args=(args.logins, n * args.logins))
+            for n in range(threads)
+        ]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        logins = threads * args.logins
+        return logins / elapsed, len(statements) / logins
+
+    print(f'bcrypt rounds {args.rounds}, {args.users} users')
+    print(f'{"threads":>8} {"logins/sec":>12} {"statements/login":>18}')
+    for threads in sorted({1, args.threads}):
+        rate, per_login = run(threads)
+        print(f'{threads:>8} {rate:>12.1f} {per_login:>18.1f}')
+
+    os.remove(path)
+
+if __name__ == '__main__':
+    main()
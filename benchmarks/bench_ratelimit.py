@@ -0,0 +1,109 @@
+"""Benchmark the overhead the rate limiter adds to each request.
+
+Times LocalBackend.take on its own, from one thread and several at once,
+then POSTs collection edits to the API through the Flask test client with
+the limiter off and on in turn, with limits high enough that nothing is
+refused, and reports the difference in latency.
+
+Run with:
+python -m benchmarks.bench_ratelimit --requests 2000 --threads 4
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--takes', type=int, default=200000, help='tokens taken per thread')
+    parser.add_argument('--keys', type=int, default=10000, help='clients the tokens are spread over')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--requests', type=int, default=2000, help='requests with the limiter on, and as many off')
+    return parser.parse_args()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(1, -(-len(values) * p // 100)) - 1]
+
+def bench_backend(args):
+    from tracker_app.ratelimit import LocalBackend
+
+    backend = LocalBackend()
+    keys = [f'login:10.0.{i // 256}.{i % 256}' for i in range(args.keys)]
+
+    def take_many(offset):
+        for i in range(args.takes):
+            backend.take(keys[(offset + i) % len(keys)], 1e9, 1e9)
+
+    print(f'{"threads":>8} {"takes/sec":>12} {"us/take":>10}')
+    for threads in sorted({1, args.threads}):
+        workers = [threading.Thread(target=take_many, args=(n * 997,)) for n in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        takes = threads * args.takes
+        print(f'{threads:>8} {takes / elapsed:>12.0f} {elapsed / takes * 1e6:>10.2f}')
+
+def bench_requests(args, path):
+    from tracker_app import create_app, db, rate_limiter
+    from tracker_app.auth.hashing import hash_password
+    from tracker_app.models import Console, Game, User
+
+    app = create_app()
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['RATE_LIMITS'] = dict(app.config['RATE_LIMITS'], collection='1000000000/second')
+    with app.app_context():
+        db.create_all()
+        console = Console(name='Console', portable=False)
+        db.session.add_all([
+            console,
+            Game(title='Game', console=console),
+            User(username='user', password=hash_password('password')),
+        ])
+        db.session.commit()
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'user', 'password': 'password'})
+
+    # Each pair of an add and a remove runs with the limiter on or off in
+    # turn, so anything that drifts while the benchmark runs affects both
+    latencies = {False: [], True: []}
+    for i in range(args.requests * 4):
+        enabled = i // 2 % 2 == 1
+        app.config['RATELIMIT_ENABLED'] = enabled
+        # The API rather than the HTML routes, whose flashed messages would
+        # pile up in the session as no page shows them
+        action = 'add' if i % 2 == 0 else 'remove'
+        start = time.perf_counter()
+        response = client.post('/api/v1/collection/games', json={action: [1]})
+        elapsed = (time.perf_counter() - start) * 1000
+        assert response.status_code == 200, response.status_code
+        # The first round warms up
+        if i >= args.requests * 2:
+            latencies[enabled].append(elapsed)
+
+    print(f'\n{"limiter":>8} {"p50 ms":>10} {"p95 ms":>10}')
+    for enabled, values in latencies.items():
+        print(f'{"on" if enabled else "off":>8} {percentile(values, 50):>10.3f} {percentile(values, 95):>10.3f}')
+    overhead = percentile(latencies[True], 50) - percentile(latencies[False], 50)
+    print(f'Overhead per request: {overhead * 1000:.1f} us at p50')
+
+    os.remove(path)
+
+def main():
+    args = parse_args()
+
+    # Config reads its settings when tracker_app is first imported
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+
+    bench_backend(args)
+    bench_requests(args, path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Benchmark building and serving recommendations.
+
+Generates a catalog with benchmarks.catalog (--size large is 100k users and
+1M games), then times `rebuild()`, looking up similar games and users'
+recommendations, collection changes queuing updates, and the worker running
+those updates.
+
+Run with:
+python -m benchmarks.bench_recommendations --size small
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from benchmarks import catalog
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', choices=sorted(catalog.SIZES), default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--changes', type=int, default=200)
+    parser.add_argument('--database', help='SQLite file to reuse, generated if missing')
+    return parser.parse_args()
+
+def timings(func, args):
+    """Return the sorted milliseconds func took with each of args."""
+    times = []
+    for arg in args:
+        start = time.perf_counter()
+        func(arg)
+        times.append((time.perf_counter() - start) * 1000)
+    return sorted(times)
+
+def report(name, times):
+    p50, p99 = times[len(times) // 2], times[min(len(times) - 1, len(times) * 99 // 100)]
+    print(f'{name:<24} {p50:>10.3f} {p99:>10.3f}')
+
+def main():
+    args = parse_args()
+    sizes = catalog.SIZES[args.size]
+
+    # Config reads its settings when tracker_app is first imported
+    path = args.database or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    is_new = not os.path.exists(path)
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.abspath(path)}'
+    os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+
+    from tracker_app import create_app, db, jobs, recommendations
+    from tracker_app.models import User
+
+    app = create_app()
+    with app.app_context():
+        if is_new:
+            start = time.perf_counter()
+            db.create_all()
+            counts = catalog.generate(db.engine, password_hash='', seed=args.seed, **sizes)
+            rows = ', '.join(f'{count} {table}' for table, count in counts.items())
+            print(f'Generated {rows} in {time.perf_counter() - start:.1f}s')
+
+        start = time.perf_counter()
+        with db.engine.begin() as connection:
+            similar, recommended = recommendations.rebuild(connection)
+        print(f'Rebuilt {similar} similar games and {recommended} recommendations '
+              f'in {time.perf_counter() - start:.1f}s')
+
+        rng = random.Random(args.seed)
+        games = catalog.Zipf(sizes['games'])
+        game_ids = [games.draw(rng) for _ in range(args.lookups)]
+        user_ids = [rng.randint(1, sizes['users']) for _ in range(args.lookups)]
+
+        def change(user_id):
+            user = User.query.get(user_id)
+            game_id = games.draw(rng)
+            if user.add_game(game_id):
+                db.session.commit()
+                user.remove_game(game_id)
+            db.session.commit()
+
+        print(f'{"":<24} {"p50 ms":>10} {"p99 ms":>10}')
+        report('similar_games', timings(recommendations.similar_games, game_ids))
+        report('recommended_games', timings(recommendations.recommended_games, user_ids))
+        report('add and remove a game', timings(change, user_ids[:args.changes]))
+
+        # Jobs queued by the changes above
+        worker = jobs.Worker(app)
+        start = time.perf_counter()
+        ran = 0
+        while True:
+            count = worker.run_once()
+            if not count:
+                break
+            ran += count
+        if ran:
+            print(f'Ran {ran} queued jobs, {(time.perf_counter() - start) * 1000 / ran:.3f} ms each')
+
+    if not args.database:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""Benchmark the site's routes against a large synthetic catalog.
+
+Generates a catalog with benchmarks.catalog, then drives the Flask test
+client through the homepage, detail pages, profile, search, browse, the API, login
+and collection edits. Reports each scenario's throughput, latency
+percentiles and SQL statements per request, and can save them as JSON and
+compare them against a saved baseline, exiting with status 1 when a
+scenario has regressed.
+
+Run with:
+python -m benchmarks.bench_routes --size small --output results.json
+python -m benchmarks.bench_routes --size small --baseline results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks import catalog
+
+# Latencies may get this much worse before it counts as a regression, and
+# never by less than MIN_SLOWDOWN_MS, so tiny timings don't fail on noise
+DEFAULT_TOLERANCE = 0.25
+MIN_SLOWDOWN_MS = 1.0
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', choices=sorted(catalog.SIZES), default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--rounds', type=int, default=4, help='bcrypt work factor')
+    parser.add_argument('--database', help='SQLite file to reuse, generated if missing')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--baseline', help='fail on regressions against this JSON file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    return parser.parse_args()
+
+def scenarios(sizes, rng):
+    """Return (name, login?, make request) for each scenario.
+
+    Ids are drawn from the same Zipf distribution as the collections, so the
+    popular pages are requested the most.
+    """
+    consoles = catalog.Zipf(sizes['consoles'])
+    games = catalog.Zipf(sizes['games'])
+    users = sizes['users']
+
+    def collection_edit(client):
+        ids = [rng.randint(1, sizes['games']) for _ in range(20)]
+        client.post('/api/v1/collection/games', json={'add': ids})
+        return client.post('/api/v1/collection/games', json={'remove': ids})
+
+    return [
+        ('homepage', False, lambda client: client.get(
+            f'/?after={rng.randrange(sizes["consoles"])}')),
+        ('console_detail', True, lambda client: client.get(
+            f'/console/{consoles.draw(rng)}')),
+        ('game_detail', True, lambda client: client.get(
+            f'/game/{games.draw(rng)}')),
+        ('profile', True, lambda client: client.get('/profile')),
+        ('search', False, lambda client: client.get(
+            f'/search?q={rng.choice(catalog.WORDS)}')),
+        ('api_games', False, lambda client: client.get(
+            f'/api/v1/games?after={rng.randrange(sizes["games"])}&include=console,genres')),
+        ('stats', False, lambda client: client.get('/stats')),
+        ('browse', False, lambda client: client.get(
+            f'/games.json?genre={rng.randint(1, sizes["genres"])}&portable=1&min_rating=8'
+            f'&publisher={rng.choice(catalog.COMPANIES)}')),
+        ('login', False, lambda client: client.post('/login', data={
+            'username': f'user{rng.randint(1, users)}', 'password': 'password'})),
+        ('collection_edit', True, collection_edit),
+    ]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(1, -(-len(values) * p // 100)) - 1]
+
+def run_scenario(app, make_request, login, count, statements, rng, users):
+    client = app.test_client()
+    if login:
+        client.post('/login', data={'username': f'user{rng.randint(1, users)}', 'password': 'password'})
+
+    latencies = []
+    del statements[:]
+    start = time.perf_counter()
+    for _ in range(count):
+        request_start = time.perf_counter()
+        response = make_request(client)
+        latencies.append((time.perf_counter() - request_start) * 1000)
+        assert response.status_code < 400, response.status_code
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': count,
+        'throughput': round(count / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'statements': round(len(statements) / count, 2),
+    }
+
+def regressions(results, baseline, tolerance):
+    """Return a description of each way results are worse than baseline."""
+    found = []
+    for name, old in baseline['scenarios'].items():
+        new = results['scenarios'].get(name)
+        if new is None:
+            continue
+        # Statement counts are deterministic, so any increase is a regression
+        if new['statements'] > old['statements']:
+            found.append(f'{name}: {old["statements"]} -> {new["statements"]} statements per request')
+        for key in ('p50_ms', 'p95_ms'):
+            limit = max(old[key] * (1 + tolerance), old[key] + MIN_SLOWDOWN_MS)
+            if new[key] > limit:
+                found.append(f'{name}: {key} {old[key]} -> {new[key]}')
+    return found
+
+def main():
+    args = parse_args()
+    sizes = catalog.SIZES[args.size]
+
+    # Config reads its settings when tracker_app is first imported
+    path = args.database or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    is_new = not os.path.exists(path)
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.abspath(path)}'
+    os.environ['BCRYPT_LOG_ROUNDS'] = str(args.rounds)
+    # Measured on its own by bench_ratelimit
+    os.environ['RATELIMIT_ENABLED'] = '0'
+
+    from sqlalchemy import event
+    from tracker_app import create_app, db
+    from tracker_app.auth.hashing import hash_password
+
+    app = create_app()
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        engine = db.engine
+        if is_new:
+            start = time.perf_counter()
+            db.create_all()
+            counts = catalog.generate(engine, password_hash=hash_password('password'),
+                seed=args.seed, **sizes)
+            rows = ', '.join(f'{count} {table}' for table, count in counts.items())
+            print(f'Generated {rows} in {time.perf_counter() - start:.1f}s')
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *a: statements.append(a[2]))
+
+    rng = random.Random(args.seed)
+    results = {
+        'size': args.size,
+        'seed': args.seed,
+        'python': platform.python_version(),
+        'scenarios': {},
+    }
+    print(f'{"scenario":<16} {"req/sec":>10} {"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10} {"stmts/req":>10}')
+    for name, login, make_request in scenarios(sizes, rng):
+        result = run_scenario(app, make_request, login, args.requests, statements, rng, sizes['users'])
+        results['scenarios'][name] = result
+        print(f'{name:<16} {result["throughput"]:>10} {result["p50_ms"]:>10} '
+              f'{result["p95_ms"]:>10} {result["p99_ms"]:>10} {result["statements"]:>10}')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if not args.database:
+        os.remove(path)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print(f'REGRESSION {regression}')
+        if found:
+            sys.exit(1)
+        print('No regressions against', args.baseline)
+
+if __name__ == '__main__':
+    main()
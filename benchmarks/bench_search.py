@@ -0,0 +1,98 @@
+"""Benchmark full-text search queries against a large synthetic catalog.
+
+Fills a temporary SQLite file with generated games through the search
+triggers, then times the first and second pages of queries the way search()
+runs them, ranking the newest RANK_LIMIT matches of each.
+
+Run with:
+python -m benchmarks.bench_search --games 1000000
+"""
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from tracker_app.search import AFTER, RANK_LIMIT, RANKED, SCHEMA, SQLITE_SEARCH, match_expression
+
+SYLLABLES = 'ka ri zel da mar io son ic kir by sol id met ro hal o fin al dra gon tet ris'.split()
+
+def make_vocabulary(size, rng):
+    """Return size distinct made-up words built from SYLLABLES."""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.sample(SYLLABLES, rng.randint(2, 4))))
+    return sorted(words)
+
+def create_tables(connection):
+    connection.execute(
+        'CREATE TABLE console (id INTEGER PRIMARY KEY, name TEXT, company TEXT, console_notes TEXT)')
+    connection.execute(
+        'CREATE TABLE game (id INTEGER PRIMARY KEY, title TEXT, publisher TEXT, '
+        'game_notes TEXT, console_id INTEGER)')
+    for statement in SCHEMA:
+        connection.execute(statement)
+
+def generate_games(count, words):
+    """Yield game rows whose words follow a Zipf-like distribution, like real titles."""
+    rng = random.Random(1)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    for game_id in range(1, count + 1):
+        title = ' '.join(rng.choices(words, cum_weights=cum_weights, k=3)).title()
+        publisher = rng.choice(words).title() + ' Games'
+        notes = ' '.join(rng.choices(words, cum_weights=cum_weights, k=6))
+        yield game_id, title, publisher, notes, 1
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=1000000)
+    parser.add_argument('--words', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    connection = sqlite3.connect(path)
+    create_tables(connection)
+    words = make_vocabulary(args.words, random.Random(0))
+    connection.executemany('INSERT INTO game VALUES (?, ?, ?, ?, ?)', generate_games(args.games, words))
+    connection.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+    connection.commit()
+
+    # Mirrors tracker_app.search.search()
+    _, select = SQLITE_SEARCH
+    first_page = RANKED.format(select=select, where='')
+    next_page = RANKED.format(select=select, where=AFTER)
+    limits = {'candidates': RANK_LIMIT + 1, 'ranked': RANK_LIMIT, 'limit': 21}
+    # Query a very common word, a rare word, a pair and a few prefixes,
+    # once each, as short prefixes can be whole words too
+    queries = list(dict.fromkeys([
+        words[0], words[500], f'{words[10]} {words[20]}',
+        words[3][:2], words[100][:4], words[5000][:6],
+    ]))
+    print(f'{args.games} games, {len(words)} distinct words')
+    print(f'{"query":<24} {"matches":>10} {"first ms":>10} {"next ms":>10}')
+    for query in queries:
+        match = match_expression(query)
+        matches = connection.execute(
+            'SELECT count(*) FROM search_index WHERE search_index MATCH ?', (match,)).fetchone()[0]
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            rows = connection.execute(first_page, dict(limits, match=match)).fetchall()
+        first = (time.perf_counter() - start) * 1000 / args.repeat
+
+        following = '-'
+        if len(rows) > 20:
+            rowid, score = rows[19][0], rows[19][3]
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                connection.execute(next_page, dict(limits, match=match, score=score, rowid=rowid)).fetchall()
+            following = f'{(time.perf_counter() - start) * 1000 / args.repeat:.2f}'
+        print(f'{query:<24} {matches:>10} {first:>10.2f} {following:>10}')
+
+    connection.close()
+    os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Benchmark how long a new worker takes to serve its first request.
+
+Starts fresh Python processes that import tracker_app, build the app with
+create_app() and request the homepage, and reports how long each step took
+and how many database connections were opened before the first request.
+A pre-forking server runs the first two steps once, before forking, so
+they should open no connections.
+
+Run with:
+python -m benchmarks.bench_startup --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+STEPS = ('import', 'create_app', 'first_request')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def measure():
+    """Time starting the app in this process, printing the results as JSON."""
+    start = time.perf_counter()
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    connections = []
+    event.listen(Engine, 'connect', lambda *a: connections.append(time.perf_counter()))
+
+    import tracker_app
+    imported = time.perf_counter()
+    app = tracker_app.create_app()
+    created = time.perf_counter()
+    connected_early = len(connections)
+    response = app.test_client().get('/')
+    assert response.status_code == 200, response.status_code
+    served = time.perf_counter()
+
+    print(json.dumps({
+        'import': (imported - start) * 1000,
+        'create_app': (created - imported) * 1000,
+        'first_request': (served - created) * 1000,
+        'connections': connected_early,
+    }))
+
+def main():
+    args = parse_args()
+    if args.child:
+        return measure()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    env = dict(os.environ, SQLALCHEMY_DATABASE_URI=f'sqlite:///{path}', FLASK_APP='app.py')
+    subprocess.run([sys.executable, '-m', 'flask', 'init-db'], env=env, check=True,
+        stdout=subprocess.DEVNULL)
+
+    results = {step: [] for step in STEPS + ('process',)}
+    connections = 0
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_startup', '--child'],
+            env=env, check=True, stdout=subprocess.PIPE).stdout
+        results['process'].append((time.perf_counter() - start) * 1000)
+        timings = json.loads(output)
+        for step in STEPS:
+            results[step].append(timings[step])
+        connections = max(connections, timings['connections'])
+
+    print(f'{args.runs} runs')
+    print(f'{"step":<16} {"median ms":>10} {"min ms":>10}')
+    for step, values in results.items():
+        print(f'{step:<16} {statistics.median(values):>10.1f} {min(values):>10.1f}')
+    print(f'Connections before the first request: {connections}')
+
+    os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Deterministic synthetic catalogs for the benchmarks.
+
+The same sizes and seed always produce the same rows. Game and console
+popularity follow a Zipf distribution, so a few items are in many
+collections and most are in few, and collection sizes have a long tail.
+"""
+import bisect
+import itertools
+import random
+
+BATCH_SIZE = 10000
+
+# Preset catalog sizes, picked with --size
+SIZES = {
+    'tiny': dict(consoles=20, games=2000, genres=20, users=200),
+    'small': dict(consoles=500, games=50000, genres=50, users=5000),
+    'large': dict(consoles=10000, games=1000000, genres=200, users=100000),
+}
+
+COMPANIES = ['Nintendo', 'Sony', 'Sega', 'Microsoft', 'Atari', 'SNK', 'NEC', 'Bandai']
+
+WORDS = (
+    'super mega final dark legend quest star dragon racer soccer puzzle tales '
+    'world island kart fighter knight ninja galaxy shadow storm city ghost'
+).split()
+
+class Zipf(object):
+    """Draws ranks 1..n with probability proportional to 1 / rank ** s."""
+
+    def __init__(self, n, s=1.0):
+        self.n = n
+        self.cum_weights = list(itertools.accumulate(1 / rank ** s for rank in range(1, n + 1)))
+
+    def draw(self, rng):
+        point = rng.random() * self.cum_weights[-1]
+        return bisect.bisect_left(self.cum_weights, point) + 1
+
+    def sample(self, rng, k):
+        """Return up to k distinct ranks, drawing the popular ones most often."""
+        return {self.draw(rng) for _ in range(k)}
+
+def batched(rows):
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+def insert(connection, table, rows):
+    count = 0
+    for batch in batched(rows):
+        connection.execute(table.insert(), batch)
+        count += len(batch)
+    return count
+
+def title(rng):
+    return ' '.join(rng.sample(WORDS, rng.randint(1, 3))).title()
+
+def generate(engine, consoles, games, genres, users, password_hash,
+             max_collection=200, seed=0):
+    """Fill an empty database with a catalog of the given size.
+
+    Every user gets password_hash as their password and a username of
+    user<id>. Returns the number of rows inserted into each table.
+    """
+    # Imported here so callers can configure the app before it's created
+    from tracker_app import stats
+    from tracker_app.models import (Console, Game, Genre, User, game_genre_table,
+        consoles_owned_table, games_owned_table)
+
+    rng = random.Random(seed)
+    game_popularity = Zipf(games)
+    console_popularity = Zipf(consoles)
+    # Averages about 45 games with the default max_collection
+    collection_size = Zipf(max_collection, s=0.8)
+    # Shuffle which ids are popular, so they aren't all the oldest rows
+    game_ids = list(range(1, games + 1))
+    rng.shuffle(game_ids)
+
+    def console_rows():
+        for id in range(1, consoles + 1):
+            yield {'id': id, 'name': f'Console {id}', 'company': rng.choice(COMPANIES),
+                   'portable': rng.random() < 0.3, 'console_notes': None}
+
+    def game_rows():
+        for id in range(1, games + 1):
+            yield {'id': id, 'title': f'{title(rng)} {id}', 'publisher': rng.choice(COMPANIES),
+                   'personal_rating': rng.randint(1, 10), 'game_notes': None,
+                   'console_id': console_popularity.draw(rng)}
+
+    def game_genre_rows():
+        for game_id in range(1, games + 1):
+            for genre_id in rng.sample(range(1, genres + 1), rng.randint(1, 3)):
+                yield {'game_id': game_id, 'genre_id': genre_id}
+
+    def collections():
+        for user_id in range(1, users + 1):
+            size = collection_size.draw(rng)
+            for rank in game_popularity.sample(rng, size):
+                yield {'user_id': user_id, 'game_id': game_ids[rank - 1]}
+
+    def console_collections():
+        for user_id in range(1, users + 1):
+            for console_id in console_popularity.sample(rng, rng.randint(1, 4)):
+                yield {'user_id': user_id, 'console_id': console_id}
+
+    counts = {}
+    with engine.begin() as connection:
+        counts['console'] = insert(connection, Console.__table__, console_rows())
+        counts['genre'] = insert(connection, Genre.__table__, (
+            {'id': id, 'name': f'Genre {id}'} for id in range(1, genres + 1)))
+        counts['game'] = insert(connection, Game.__table__, game_rows())
+        counts['game_genre'] = insert(connection, game_genre_table, game_genre_rows())
+        counts['user'] = insert(connection, User.__table__, (
+            {'id': id, 'username': f'user{id}', 'password': password_hash}
+            for id in range(1, users + 1)))
+        counts['user_game'] = insert(connection, games_owned_table, collections())
+        counts['user_console'] = insert(connection, consoles_owned_table, console_collections())
+        stats.rebuild(connection)
+    return counts
@@ -1,43 +1,95 @@
+"""The Game Tracker, built by create_app().
+
+Importing the package only creates the extensions. Nothing connects to the
+database until a request or command needs it, and the tables of a new
+database are created with `flask init-db`.
+"""
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_bcrypt import Bcrypt
 from tracker_app.config import Config
-import os
-
-app = Flask(__name__)
-app.config.from_object(Config)
-app.secret_key = os.urandom(24)
+from tracker_app.engine import Database
+from tracker_app.cache import LRUCache
 
-db = SQLAlchemy(app)
+db = Database()
 
 ###########################
 # Authentication
 ###########################
 
-# TODO: Add authentication setup code here!
-
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
-login_manager.init_app(app)
 
-from .models import User
+# Logged in users are loaded from this cache on most requests, sized by
+# create_app()
+user_cache = LRUCache()
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    from tracker_app.auth.principal import load_principal
+    return load_principal(user_id)
+
+bcrypt = Bcrypt()
+
+###########################
+# Fragment cache
+###########################
+
+from tracker_app.fragments import FragmentCache
 
-bcrypt = Bcrypt(app)
+fragment_cache = FragmentCache()
 
 ###########################
-# Blueprints
+# Catalog snapshot
+###########################
+
+from tracker_app.snapshot import CatalogSnapshot
+
+catalog_snapshot = CatalogSnapshot()
+
 ###########################
+# Rate limiting
+###########################
+
+from tracker_app.ratelimit import RateLimiter
+
+rate_limiter = RateLimiter()
+
+###########################
+# Application factory
+###########################
+
+def create_app(config=Config):
+    """Return a new app, with settings from config's uppercase attributes."""
+    app = Flask(__name__)
+    app.config.from_object(config)
+    # A random key would log everyone out on each restart, and a request
+    # served by a different worker than the last couldn't read the session
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError('SECRET_KEY is not set, add it to .env')
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    bcrypt.init_app(app)
+    user_cache.maxsize = app.config['USER_CACHE_SIZE']
+    user_cache.ttl = app.config['USER_CACHE_TTL']
+    fragment_cache.init_app(app)
+    catalog_snapshot.init_app(app)
+    rate_limiter.init_app(app)
+
+    from tracker_app.main.routes import main as main_routes
+    app.register_blueprint(main_routes)
+
+    from tracker_app.auth.routes import auth as auth_routes
+    app.register_blueprint(auth_routes)
+
+    from tracker_app.api.routes import api as api_routes
+    app.register_blueprint(api_routes)
 
-from tracker_app.main.routes import main as main_routes
-app.register_blueprint(main_routes)
+    from tracker_app import commands
+    commands.init_app(app)
 
-from tracker_app.auth.routes import auth as auth_routes
-app.register_blueprint(auth_routes)
+    from tracker_app import perf
+    perf.init_app(app)
 
-with app.app_context():
-    db.create_all()
+    return app
@@ -0,0 +1,163 @@
+"""Activity feeds, from an append-only log of what users did.
+
+Adding to or removing from a collection, and creating or editing a console,
+game or genre, is noted with models.record_activity() as it happens. When
+the session commits, the events are written to activity_event with one
+INSERT in the same transaction, so the log has exactly the committed
+changes. The feeds read it newest first, for everyone or for one user.
+
+The same commit counts the events in activity_rollup, per item, action and
+day, e.g. how many users added a game each day. As the rollups already
+count every event, compact() deletes events older than
+ACTIVITY_RETENTION_DAYS without losing the trends, and the log stays as
+long as the feeds need it rather than growing forever. Only the feeds stop
+reaching further back.
+"""
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, bindparam, event, func, select
+from tracker_app import db, catalog_snapshot
+from tracker_app.models import (User, activity_event_table, activity_rollup_table,
+    insert_ignoring_duplicates)
+from tracker_app.pagination import DEFAULT_LIMIT, page_of
+
+# Old events deleted per transaction by compact(), so it never holds
+# locks on the whole log at once
+COMPACT_BATCH_SIZE = 10000
+
+# Days of trends shown by default
+TREND_DAYS = 7
+TREND_LIMIT = 10
+
+# One event of a feed; name is None if the item no longer exists
+FeedEvent = namedtuple('FeedEvent', 'id when user_id username action item item_id name')
+
+def day_of(timestamp):
+    """Return the UTC date of a Unix timestamp, which its rollups count."""
+    return datetime.fromtimestamp(timestamp, timezone.utc).date()
+
+##########################################
+#           Writing                      #
+##########################################
+
+def write(connection, events, now):
+    """Append (user_id, action, item, item_id) events that happened at now,
+    and count them in their day's rollups."""
+    connection.execute(activity_event_table.insert(), [
+        {'created_at': now, 'user_id': user_id, 'action': action, 'item': item, 'item_id': item_id}
+        for user_id, action, item, item_id in events])
+
+    day = day_of(now)
+    counts = Counter((item, item_id, action) for _, action, item, item_id in events)
+    # In key order, so commits counting the same rows lock them in the same order
+    params = [
+        {'b_item': item, 'b_item_id': item_id, 'b_action': action, 'b_day': day, 'change': change}
+        for (item, item_id, action), change in sorted(counts.items())]
+    rollup = activity_rollup_table
+    # Creates the rows missing, which another commit may be creating too,
+    # then adds to them
+    connection.execute(
+        insert_ignoring_duplicates(rollup, connection.dialect.name).values(
+            item=bindparam('b_item'), item_id=bindparam('b_item_id'),
+            action=bindparam('b_action'), day=bindparam('b_day'), count=0),
+        params)
+    connection.execute(
+        rollup.update()
+            .where(and_(
+                rollup.c.item == bindparam('b_item'), rollup.c.item_id == bindparam('b_item_id'),
+                rollup.c.action == bindparam('b_action'), rollup.c.day == bindparam('b_day')))
+            .values(count=rollup.c.count + bindparam('change')),
+        params)
+
+@event.listens_for(db.session, 'before_commit')
+def write_recorded_events(session):
+    # Flush first, as committing only flushes after this runs
+    session.flush()
+    events = session.info.pop('activity', None)
+    if events:
+        write(session.connection(), events, time.time())
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_events(session):
+    session.info.pop('activity', None)
+
+def compact(engine, older_than, batch_size=COMPACT_BATCH_SIZE):
+    """Delete the events from before the Unix timestamp older_than, which
+    the rollups already count, in batches. Returns how many were deleted."""
+    event_table = activity_event_table
+    oldest = select([event_table.c.id]) \
+        .where(event_table.c.created_at < older_than) \
+        .order_by(event_table.c.id) \
+        .limit(batch_size)
+    deleted = 0
+    while True:
+        with engine.begin() as connection:
+            batch = connection.execute(
+                event_table.delete().where(event_table.c.id.in_(oldest))).rowcount
+        deleted += batch
+        if batch < batch_size:
+            return deleted
+
+##########################################
+#           Reading                      #
+##########################################
+
+def feed(user_id=None, before=None, limit=DEFAULT_LIMIT):
+    """Return a Page of the newest events, of one user or everyone's, with
+    ids below before. The Page's next_after is the before of the next."""
+    event_table = activity_event_table
+    user_table = User.__table__
+    query = select([
+            event_table.c.id, event_table.c.created_at, event_table.c.user_id, user_table.c.username,
+            event_table.c.action, event_table.c.item, event_table.c.item_id]) \
+        .select_from(event_table.join(user_table, user_table.c.id == event_table.c.user_id)) \
+        .order_by(event_table.c.id.desc()) \
+        .limit(limit + 1)
+    if user_id is not None:
+        query = query.where(event_table.c.user_id == user_id)
+    if before is not None:
+        query = query.where(event_table.c.id < before)
+
+    # Names come from the snapshot rather than a join per kind of item
+    snapshot = catalog_snapshot.get()
+    return page_of([
+        FeedEvent(id, datetime.fromtimestamp(created_at, timezone.utc), user_id, username,
+            action, item, item_id, snapshot.name(item, item_id))
+        for id, created_at, user_id, username, action, item, item_id
+        in db.session.execute(query)], limit)
+
+def daily_counts(item, item_id, days=30, today=None):
+    """Return {action: [(day, count), ...]} of an item's last days, oldest
+    first, leaving out days without events."""
+    today = today or day_of(time.time())
+    rollup = activity_rollup_table
+    rows = db.session.execute(
+        select([rollup.c.action, rollup.c.day, rollup.c.count])
+            .where(and_(
+                rollup.c.item == item, rollup.c.item_id == item_id,
+                rollup.c.day > today - timedelta(days=days), rollup.c.count > 0))
+            .order_by(rollup.c.action, rollup.c.day))
+    counts = {}
+    for action, day, count in rows:
+        counts.setdefault(action, []).append((day, count))
+    return counts
+
+def trending(item='game', action='add', days=TREND_DAYS, limit=TREND_LIMIT, today=None):
+    """Return (id, name, count) of the items with the most events of action
+    in the last days, e.g. the games added most this week."""
+    today = today or day_of(time.time())
+    rollup = activity_rollup_table
+    total = func.sum(rollup.c.count).label('total')
+    rows = db.session.execute(
+        select([rollup.c.item_id, total])
+            .where(and_(
+                rollup.c.item == item, rollup.c.action == action,
+                rollup.c.day > today - timedelta(days=days)))
+            .group_by(rollup.c.item_id)
+            .having(total > 0)
+            .order_by(total.desc(), rollup.c.item_id)
+            .limit(limit))
+    snapshot = catalog_snapshot.get()
+    return [(item_id, snapshot.name(item, item_id), total) for item_id, total in rows]
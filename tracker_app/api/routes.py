@@ -0,0 +1,228 @@
+"""JSON API for the catalog and user collections.
+
+Everything is read-only apart from bulk collection edits. Lists page with
+the same ?after=<id>&limit=N cursor as the HTML pages.
+?fields=a,b picks the columns each item has (id is always there), and
+?include=console,genres expands a game's relationships. Items are built
+from column tuples rather than ORM instances, and each include is loaded
+with one IN query per page rather than one query per item.
+"""
+from flask import Blueprint, request, jsonify, url_for
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException, BadRequest, NotFound, Unauthorized
+from tracker_app.models import Console, Game, Genre, game_genre_table, consoles_owned_table, games_owned_table
+from tracker_app.pagination import page_args, keyset_page
+from tracker_app.main.forms import MAX_COLLECTION_IDS
+from tracker_app.ratelimit import by_user
+
+from tracker_app import db, rate_limiter
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+##########################################
+#           Resources                    #
+##########################################
+
+def include_console(items, rows):
+    """Add each game's console, loading all of them with one query."""
+    console_ids = {row.console_id for row in rows}
+    query = db.session.query(*CONSOLE.columns(CONSOLE.fields)) \
+        .filter(Console.id.in_(console_ids))
+    consoles = {row.id: dict(zip(CONSOLE.fields, row)) for row in query}
+    for item, row in zip(items, rows):
+        item['console'] = consoles[row.console_id]
+
+def include_genres(items, rows):
+    """Add each game's genres, loading all of them with one query."""
+    genres = {row.id: [] for row in rows}
+    query = db.session.query(game_genre_table.c.game_id, Genre.id, Genre.name) \
+        .join(Genre, Genre.id == game_genre_table.c.genre_id) \
+        .filter(game_genre_table.c.game_id.in_(list(genres))) \
+        .order_by(Genre.name)
+    for game_id, id, name in query:
+        genres[game_id].append({'id': id, 'name': name})
+    for item, row in zip(items, rows):
+        item['genres'] = genres[row.id]
+
+class Resource(object):
+    """The fields and includes a model is served with.
+
+    includes maps each include's name to the field it needs and the
+    function that adds it to a page of items.
+    """
+
+    def __init__(self, model, fields, includes=None):
+        self.model = model
+        self.fields = fields
+        self.includes = includes or {}
+
+    def columns(self, fields):
+        return [getattr(self.model, field) for field in fields]
+
+CONSOLE = Resource(Console, ['id', 'name', 'company', 'portable', 'console_notes'])
+
+GENRE = Resource(Genre, ['id', 'name'])
+
+GAME = Resource(Game,
+    ['id', 'title', 'publisher', 'personal_rating', 'game_notes', 'console_id'],
+    includes={
+        'console': ('console_id', include_console),
+        'genres': ('id', include_genres),
+    })
+
+##########################################
+#           Helpers                      #
+##########################################
+
+def list_arg(name):
+    """Read a comma separated list argument, e.g. ?fields=id,title."""
+    value = request.args.get(name, '')
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+class Selection(object):
+    """Which fields and includes of a resource the request asked for."""
+
+    def __init__(self, resource):
+        fields = list_arg('fields')
+        includes = list_arg('include')
+        unknown = set(fields) - set(resource.fields)
+        if unknown:
+            raise BadRequest(f'Unknown fields: {", ".join(sorted(unknown))}')
+        unknown = set(includes) - set(resource.includes)
+        if unknown:
+            raise BadRequest(f'Unknown includes: {", ".join(sorted(unknown))}')
+
+        self.resource = resource
+        self.includes = includes
+        self.fields = [
+            field for field in resource.fields
+            if field == 'id' or not fields or field in fields
+        ]
+        # Includes may need fields that weren't asked for, which are
+        # queried after the shown ones and left out of the items
+        needed = [resource.includes[name][0] for name in includes]
+        self.queried = self.fields + [
+            field for field in dict.fromkeys(needed) if field not in self.fields
+        ]
+
+    def query(self):
+        return db.session.query(*self.resource.columns(self.queried))
+
+    def items(self, rows):
+        items = [dict(zip(self.fields, row)) for row in rows]
+        if rows:
+            for name in self.includes:
+                _, include = self.resource.includes[name]
+                include(items, rows)
+        return items
+
+def list_response(resource, filter=None):
+    """Return a page of a resource's items, optionally filtering the query."""
+    selection = Selection(resource)
+    query = selection.query()
+    if filter is not None:
+        query = filter(query)
+    after, limit = page_args()
+    page = keyset_page(query, resource.model.id, after, limit)
+
+    next_url = None
+    if page.next_after:
+        args = dict(request.args.items(), after=page.next_after, limit=limit)
+        next_url = url_for(request.endpoint, **request.view_args, **args)
+    return jsonify(data=selection.items(page.items), next_after=page.next_after, next=next_url)
+
+def item_response(resource, id):
+    """Return one of a resource's items, or a 404."""
+    selection = Selection(resource)
+    row = selection.query().filter(resource.model.id == id).first()
+    if row is None:
+        raise NotFound(f'No {resource.model.__tablename__} with id {id}.')
+    return jsonify(data=selection.items([row])[0])
+
+def id_list(body, name):
+    """Read a list of ids from a JSON request body."""
+    ids = body.get(name, [])
+    if not isinstance(ids, list) or not all(type(id) is int for id in ids):
+        raise BadRequest(f'{name} must be a list of ids.')
+    if len(ids) > MAX_COLLECTION_IDS:
+        raise BadRequest(f'{name} can have at most {MAX_COLLECTION_IDS} ids.')
+    return ids
+
+def require_login():
+    if not current_user.is_authenticated:
+        raise Unauthorized('Log in to see your collection.')
+
+@api.errorhandler(HTTPException)
+def json_error(error):
+    # Keeping headers like a 429's Retry-After
+    headers = [(name, value) for name, value in error.get_headers() if name != 'Content-Type']
+    return jsonify(error=error.description), error.code, headers
+
+##########################################
+#           Routes                       #
+##########################################
+
+@api.route('/consoles')
+def consoles():
+    return list_response(CONSOLE)
+
+@api.route('/consoles/<int:console_id>')
+def console(console_id):
+    return item_response(CONSOLE, console_id)
+
+@api.route('/games')
+def games():
+    # ?console_id=<id> lists one console's games
+    console_id = request.args.get('console_id', type=int)
+    if console_id is None:
+        return list_response(GAME)
+    return list_response(GAME, lambda query: query.filter(Game.console_id == console_id))
+
+@api.route('/games/<int:game_id>')
+def game(game_id):
+    return item_response(GAME, game_id)
+
+@api.route('/genres')
+def genres():
+    return list_response(GENRE)
+
+@api.route('/genres/<int:genre_id>')
+def genre(genre_id):
+    return item_response(GENRE, genre_id)
+
+@api.route('/collection/consoles')
+def collection_consoles():
+    require_login()
+    return list_response(CONSOLE, lambda query: query
+        .join(consoles_owned_table)
+        .filter(consoles_owned_table.c.user_id == current_user.id))
+
+@api.route('/collection/games')
+def collection_games():
+    require_login()
+    return list_response(GAME, lambda query: query
+        .join(games_owned_table)
+        .filter(games_owned_table.c.user_id == current_user.id))
+
+@api.route('/collection/<any(consoles, games):kind>', methods=['POST'])
+def edit_collection(kind):
+    """Add and remove many items in one transaction.
+
+    Takes {"add": [ids], "remove": [ids]} and returns each id's outcome.
+    Only JSON bodies are read, which browsers can't send cross-site without
+    the API's consent, so no CSRF token is needed.
+    """
+    require_login()
+    rate_limiter.check('collection', by_user())
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise BadRequest('Send a JSON object with "add" and/or "remove" lists of ids.')
+    add_ids, remove_ids = id_list(body, 'add'), id_list(body, 'remove')
+
+    results = []
+    if add_ids:
+        results += getattr(current_user, f'add_{kind}')(add_ids).items()
+    if remove_ids:
+        results += getattr(current_user, f'remove_{kind}')(remove_ids).items()
+    db.session.commit()
+    return jsonify(results=[{'id': id, 'outcome': outcome} for id, outcome in results])
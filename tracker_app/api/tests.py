@@ -0,0 +1,181 @@
+import unittest
+
+from sqlalchemy import event
+
+from tracker_app import create_app, db, bcrypt, user_cache, rate_limiter
+from tracker_app.config import TestConfig
+from tracker_app.models import Console, Game, Genre, User
+
+"""
+Run these tests with the command:
+python -m unittest discover
+"""
+
+#################################################
+# Setup
+#################################################
+
+app = create_app(TestConfig)
+
+def create_games(count):
+    """Add count games, spread over two consoles, each with two genres."""
+    consoles = [Console(name='Gamecube', portable=False), Console(name='Game Boy', portable=True)]
+    genres = [Genre(name='Action'), Genre(name='Puzzle'), Genre(name='RPG')]
+    for i in range(count):
+        db.session.add(Game(
+            title=f'Game {i}',
+            console=consoles[i % 2],
+            genres=[genres[i % 3], genres[(i + 1) % 3]]
+        ))
+    db.session.commit()
+
+def count_statements(func):
+    """Return how many SQL statements were executed while calling func."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        func()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return len(statements)
+
+#################################################
+# Tests
+#################################################
+
+class APITests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['WTF_CSRF_ENABLED'] = False
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        self.app = app.test_client()
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+
+    def test_games_with_includes(self):
+        create_games(3)
+        response = self.app.get('/api/v1/games?include=console,genres&fields=title')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['data'][0], {
+            'id': 1,
+            'title': 'Game 0',
+            'console': {'id': 1, 'name': 'Gamecube', 'company': None,
+                        'portable': False, 'console_notes': None},
+            'genres': [{'id': 1, 'name': 'Action'}, {'id': 2, 'name': 'Puzzle'}],
+        })
+
+    def test_includes_query_count(self):
+        """Test that each include costs one query, however many games there are."""
+        create_games(2)
+        url = '/api/v1/games?include=console,genres'
+        few = count_statements(lambda: self.app.get(url))
+
+        console, genre = Console.query.get(2), Genre.query.get(3)
+        for i in range(40):
+            db.session.add(Game(title=f'More {i}', console=console, genres=[genre]))
+        db.session.commit()
+        many = count_statements(lambda: self.app.get(url))
+        self.assertEqual(few, many)
+        self.assertEqual(count_statements(lambda: self.app.get('/api/v1/games')), few - 2)
+
+    def test_pagination(self):
+        create_games(5)
+        body = self.app.get('/api/v1/games?limit=2&console_id=1').get_json()
+        self.assertEqual([game['title'] for game in body['data']], ['Game 0', 'Game 2'])
+        self.assertEqual(body['next_after'], 3)
+
+        body = self.app.get(body['next']).get_json()
+        self.assertEqual([game['title'] for game in body['data']], ['Game 4'])
+        self.assertIsNone(body['next'])
+
+    def test_errors(self):
+        create_games(1)
+        response = self.app.get('/api/v1/consoles?fields=name,price')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(), {'error': 'Unknown fields: price'})
+
+        response = self.app.get('/api/v1/consoles/1?include=games')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.app.get('/api/v1/games/99')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json(), {'error': 'No game with id 99.'})
+
+    def test_collection(self):
+        create_games(3)
+        password_hash = bcrypt.generate_password_hash('password').decode('utf-8')
+        user = User(username='username', password=password_hash)
+        user.games_owned.append(Game.query.get(2))
+        db.session.add(user)
+        db.session.commit()
+
+        response = self.app.get('/api/v1/collection/games')
+        self.assertEqual(response.status_code, 401)
+
+        self.app.post('/login', data={'username': 'username', 'password': 'password'})
+        body = self.app.get('/api/v1/collection/games?fields=title').get_json()
+        self.assertEqual(body['data'], [{'id': 2, 'title': 'Game 1'}])
+        body = self.app.get('/api/v1/collection/consoles').get_json()
+        self.assertEqual(body['data'], [])
+
+    def test_edit_collection(self):
+        create_games(30)
+        password_hash = bcrypt.generate_password_hash('password').decode('utf-8')
+        db.session.add(User(username='username', password=password_hash))
+        db.session.commit()
+        self.app.post('/login', data={'username': 'username', 'password': 'password'})
+
+        def edit(body):
+            return self.app.post('/api/v1/collection/games', json=body)
+
+        response = edit({'add': [1, 2, 2, 99]})
+        self.assertEqual(response.get_json()['results'], [
+            {'id': 1, 'outcome': 'added'},
+            {'id': 2, 'outcome': 'added'},
+            {'id': 99, 'outcome': 'not_found'},
+        ])
+        response = edit({'add': [2, 3], 'remove': [1, 4]})
+        self.assertEqual(response.get_json()['results'], [
+            {'id': 2, 'outcome': 'already_owned'},
+            {'id': 3, 'outcome': 'added'},
+            {'id': 1, 'outcome': 'removed'},
+            {'id': 4, 'outcome': 'not_owned'},
+        ])
+        self.assertEqual(
+            [game.owner_count for game in Game.query.order_by(Game.id).limit(4)], [0, 1, 1, 0])
+
+        # The statements run don't depend on how many ids are sent
+        few = count_statements(lambda: edit({'add': [5, 6], 'remove': [2, 3]}))
+        many = count_statements(lambda: edit({'add': list(range(7, 31)), 'remove': [5, 6]}))
+        self.assertEqual(few, many)
+
+        self.assertEqual(edit({'add': ['1']}).status_code, 400)
+        self.assertEqual(self.app.post('/api/v1/collection/games', data={'add': 1}).status_code, 400)
+
+    def test_edit_collection_rate_limited(self):
+        create_games(1)
+        password_hash = bcrypt.generate_password_hash('password').decode('utf-8')
+        db.session.add(User(username='username', password=password_hash))
+        db.session.commit()
+        self.app.post('/login', data={'username': 'username', 'password': 'password'})
+        rate_limiter.clear()
+        limits = dict(app.config['RATE_LIMITS'], collection='2/minute')
+        for name, value in [('RATELIMIT_ENABLED', True), ('RATE_LIMITS', limits)]:
+            self.addCleanup(app.config.__setitem__, name, app.config[name])
+            app.config[name] = value
+
+        for _ in range(2):
+            self.app.post('/api/v1/collection/games', json={'add': [1]})
+        response = self.app.post('/api/v1/collection/games', json={'add': [1]})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn(response.headers['Retry-After'], ('29', '30'))
+        self.assertIn('try again in', response.get_json()['error'])
@@ -2,7 +2,7 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, Length, ValidationError
 from tracker_app.models import User
-from tracker_app import bcrypt
+from tracker_app.auth.hashing import check_password
 
 class SignUpForm(FlaskForm):
     """Form to sign up."""
@@ -24,13 +24,25 @@ class LoginForm(FlaskForm):
     password = PasswordField('Password', validators=[DataRequired()])
     submit = SubmitField('Log In')
 
+    _user = None
+    _user_loaded = False
+
+    @property
+    def user(self):
+        """The user with the submitted username, looked up once per form."""
+        if not self._user_loaded:
+            self._user = User.query.filter_by(username=self.username.data).first()
+            self._user_loaded = True
+        return self._user
+
     def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if not user:
+        if not self.user:
             raise ValidationError('No user with that username. Please try again.')
 
     def validate_password(self, password):
-        user = User.query.filter_by(username=self.username.data).first()
-        if user and not bcrypt.check_password_hash(
-                user.password, password.data):
+        # Unknown users are still checked, against a dummy hash, so they
+        # take as long to reject as a wrong password
+        user = self.user
+        password_hash = user.password if user else None
+        if not check_password(password_hash, password.data) and user:
             raise ValidationError('Password doesn\'t match. Please try again.')
\ No newline at end of file
@@ -0,0 +1,49 @@
+"""Password hashing, run on a bounded pool of threads.
+
+bcrypt releases the GIL while it hashes, so logins handled by different
+threads can hash in parallel. Sending every hash through one pool caps how
+many cores hashing can take at BCRYPT_THREADS, so a burst of logins queues
+up instead of starving every other request of CPU.
+
+The pool is started by the first hash, so a server that forks workers after
+loading the app doesn't fork its threads.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from tracker_app import bcrypt
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Checked against when there is no user, so unknown usernames take as long
+# to reject as wrong passwords
+_dummy_hash = None
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=current_app.config['BCRYPT_THREADS'], thread_name_prefix='bcrypt')
+        return _pool
+
+def hash_password(password):
+    """Return the bcrypt hash of a password as text."""
+    return get_pool().submit(bcrypt.generate_password_hash, password).result().decode('utf-8')
+
+def check_password(password_hash, password):
+    """Return whether password matches password_hash.
+
+    A password_hash of None never matches, but costs the same as one that
+    doesn't.
+    """
+    global _dummy_hash
+    if password_hash is None:
+        if _dummy_hash is None:
+            _dummy_hash = hash_password(os.urandom(16).hex())
+        get_pool().submit(bcrypt.check_password_hash, _dummy_hash, password).result()
+        return False
+    return get_pool().submit(bcrypt.check_password_hash, password_hash, password).result()
@@ -0,0 +1,50 @@
+"""Lightweight stand-in for the logged in User, cached between requests."""
+from sqlalchemy import event
+from tracker_app import db, user_cache
+from tracker_app.models import OwnerMixin, User
+
+class UserPrincipal(OwnerMixin):
+    """The id and username of a logged in user.
+
+    Has everything Flask-Login and the templates need from current_user,
+    plus the collection methods, without being tied to a session. Routes
+    that need the full User can call load().
+    """
+    __slots__ = ('id', 'username')
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    def get_id(self):
+        return str(self.id)
+
+    def load(self):
+        """Return the User this principal stands for."""
+        return User.query.get(self.id)
+
+    def __repr__(self):
+        return f'<UserPrincipal: {self.username}>'
+
+def load_principal(user_id):
+    """Return the principal for a user id, from the cache if possible."""
+    user_id = int(user_id)
+    principal = user_cache.get(user_id)
+    if principal is None:
+        row = db.session.query(User.id, User.username).filter_by(id=user_id).first()
+        if row is None:
+            return None
+        principal = UserPrincipal(*row)
+        user_cache.set(user_id, principal)
+    return principal
+
+@event.listens_for(User.username, 'set')
+@event.listens_for(User.password, 'set')
+def evict_user(target, value, oldvalue, initiator):
+    """Drop a user's cached principal when their credentials change."""
+    if target.id is not None:
+        user_cache.delete(target.id)
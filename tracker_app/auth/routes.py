@@ -3,18 +3,21 @@ from flask_login import login_user, logout_user, login_required, current_user
 
 from tracker_app.models import Console, Game, Genre, User
 from tracker_app.auth.forms import SignUpForm, LoginForm
-from tracker_app import bcrypt
+from tracker_app.auth.hashing import hash_password
+from tracker_app.ratelimit import by_ip, by_username
 
-# Import app and db from events_app package so that we can run app
-from tracker_app import app, db
+# Import db from events_app package so that we can run app
+from tracker_app import db, user_cache, rate_limiter
 
 auth = Blueprint("auth", __name__)
 
+# Both hash a password, so they're limited before their forms are validated
 @auth.route('/signup', methods=['GET', 'POST'])
+@rate_limiter.limit('signup', by_ip)
 def signup():
     form = SignUpForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = hash_password(form.password.data)
         user = User(
             username=form.username.data,
             password=hashed_password
@@ -28,11 +31,12 @@ def signup():
 
 
 @auth.route('/login', methods=['GET', 'POST'])
+@rate_limiter.limit('login', by_ip)
+@rate_limiter.limit('login_username', by_username)
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=form.username.data).first()
-        login_user(user, remember=True)
+        login_user(form.user, remember=True)
         next_page = request.args.get('next')
         return redirect(next_page if next_page else url_for('main.homepage'))
     print(form.errors)
@@ -41,5 +45,6 @@ def login():
 @auth.route('/logout')
 @login_required
 def logout():
+    user_cache.delete(current_user.id)
     logout_user()
     return redirect(url_for('main.homepage'))
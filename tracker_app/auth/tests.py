@@ -1,8 +1,13 @@
 import os
 from unittest import TestCase
+
+from sqlalchemy import event
  
-from tracker_app import app, db, bcrypt
+from tracker_app import create_app, db, bcrypt, user_cache, rate_limiter
+from tracker_app.config import TestConfig
 from tracker_app.models import Console, Game, User
+from tracker_app.auth.principal import UserPrincipal
+from tracker_app.ratelimit import LocalBackend
 
 """
 Run these tests with the command:
@@ -13,11 +18,14 @@ python -m unittest discover
 # Setup
 #################################################
 
+app = create_app(TestConfig)
+
 def create_user():
     password_hash = bcrypt.generate_password_hash('password').decode('utf-8')
     user = User(username='me1', password=password_hash)
-    db.session.add(user)
-    db.session.commit()
+    with app.app_context():
+        db.session.add(user)
+        db.session.commit()
 
 #################################################
 # Tests
@@ -28,13 +36,15 @@ class AuthTests(TestCase):
 
     def setUp(self):
         """Executed prior to each test."""
-        app.config['TESTING'] = True
         app.config['WTF_CSRF_ENABLED'] = False
-        app.config['DEBUG'] = False
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         self.app = app.test_client()
-        db.drop_all()
-        db.create_all()
+        # Each request gets its own app context, as Flask-Login keeps the
+        # current user in it, so the database is only used inside contexts
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+        user_cache.clear()
 
     def test_signup(self):
         # - Makes a POST request to /signup, sending a username & password
@@ -45,7 +55,8 @@ class AuthTests(TestCase):
         }
         self.app.post('/signup', data=post_data)
 
-        created_user = User.query.filter_by(username='thatuser').one()
+        with app.app_context():
+            created_user = User.query.filter_by(username='thatuser').one()
         self.assertIsNotNone(created_user)
 
     def test_signup_existing_user(self):
@@ -128,3 +139,118 @@ class AuthTests(TestCase):
         response_text = response.get_data(as_text=True)
 
         self.assertIn('Log In', response_text)
+
+    def test_logged_in_user_cached(self):
+        # - Create a user and log in
+        create_user()
+        post_data = {
+            'username': 'me1',
+            'password': 'password'
+        }
+        self.app.post('/login', data=post_data)
+
+        # - Check that the user is loaded once, then kept in the cache
+        self.app.get('/profile')
+        principal = user_cache.get(1)
+        self.assertIsInstance(principal, UserPrincipal)
+        self.assertEqual(principal.username, 'me1')
+        response = self.app.get('/profile')
+        self.assertIs(user_cache.get(1), principal)
+        self.assertIn("Welcome to me1's profile", response.get_data(as_text=True))
+
+        # - Check that logging out evicts the user
+        self.app.get('/logout')
+        self.assertIsNone(user_cache.get(1))
+
+    def test_password_change_evicts_user(self):
+        # - Create a user, log in and load the profile to cache the user
+        create_user()
+        post_data = {
+            'username': 'me1',
+            'password': 'password'
+        }
+        self.app.post('/login', data=post_data)
+        self.app.get('/profile')
+        self.assertIsNotNone(user_cache.get(1))
+
+        # - Change the password and check the user is evicted
+        with app.app_context():
+            user = User.query.get(1)
+            user.password = bcrypt.generate_password_hash('newpassword').decode('utf-8')
+            db.session.commit()
+        self.assertIsNone(user_cache.get(1))
+
+    def test_login_looks_up_user_once(self):
+        # - Create a user
+        create_user()
+        # - Record the statements run while logging in
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', before_cursor_execute)
+
+        post_data = {
+            'username': 'me1',
+            'password': 'password'
+        }
+        response = self.app.post('/login', data=post_data)
+        self.assertEqual(response.status_code, 302)
+        # - Check that the username was only looked up once
+        lookups = [s for s in statements if 'WHERE' in s and '.username = ' in s]
+        self.assertEqual(len(lookups), 1)
+
+class RateLimitTests(TestCase):
+    """Tests for the rate limits on signing up and logging in."""
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.app = app.test_client()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+        user_cache.clear()
+        rate_limiter.clear()
+        limits = dict(app.config['RATE_LIMITS'], login='5/minute', login_username='3/minute')
+        for name, value in [('RATELIMIT_ENABLED', True), ('RATE_LIMITS', limits)]:
+            self.addCleanup(app.config.__setitem__, name, app.config[name])
+            app.config[name] = value
+
+    def test_login_limited_per_username_and_address(self):
+        create_user()
+        login = lambda username: self.app.post(
+            '/login', data={'username': username, 'password': 'wrong'})
+
+        # - Three tries at one account, then it's refused before hashing
+        for _ in range(3):
+            self.assertEqual(login('me1').status_code, 200)
+        response = login('ME1')
+        self.assertEqual(response.status_code, 429)
+        # A token comes back every 20 seconds
+        self.assertIn(response.headers['Retry-After'], ('19', '20'))
+
+        # - Other addresses can still try the account
+        response = self.app.post('/login', data={'username': 'me1', 'password': 'wrong'},
+            environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(response.status_code, 200)
+
+        # - Other accounts, and no account at all, can be tried until the
+        # address runs out
+        self.assertEqual(login('other').status_code, 200)
+        self.assertEqual(login('').status_code, 429)
+
+        # - Showing the form isn't limited
+        self.assertEqual(self.app.get('/login').status_code, 200)
+
+    def test_buckets_refill(self):
+        backend = LocalBackend()
+        rate, burst = 0.5, 2
+        self.assertEqual([backend.take('key', rate, burst, now=0) for _ in range(3)], [0, 0, 2])
+        self.assertEqual(backend.take('key', rate, burst, now=2), 0)
+        self.assertEqual(backend.take('key', rate, burst, now=2), 2)
+        # - Buckets don't fill past their burst
+        self.assertEqual([backend.take('key', rate, burst, now=100) for _ in range(3)], [0, 0, 2])
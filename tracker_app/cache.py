@@ -0,0 +1,81 @@
+"""Small in-process caches."""
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache whose entries expire after ttl seconds.
+
+    Holds at most maxsize entries, evicting the least recently used one when
+    full. A ttl of None keeps entries until they're evicted.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class CacheBackend(object):
+    """Where rendered fragments are kept.
+
+    LocalBackend keeps them in this process. A backend shared between
+    processes, e.g. one built on memcached or Redis, renders each fragment
+    once for every worker.
+    """
+
+    def get(self, key):
+        """Return the value stored under key, or None."""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+class LocalBackend(CacheBackend):
+    """Keeps fragments in an LRUCache, in this process."""
+
+    def __init__(self, maxsize=1024):
+        self.fragments = LRUCache(maxsize)
+
+    def get(self, key):
+        return self.fragments.get(key)
+
+    def set(self, key, value):
+        self.fragments.set(key, value)
+
+    def clear(self):
+        self.fragments.clear()
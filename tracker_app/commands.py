@@ -0,0 +1,137 @@
+"""Command line tasks, run with `flask <command>`."""
+import json
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from tracker_app import db, catalog_snapshot
+from tracker_app import activity, exporter, importer, jobs, migrations, recommendations, stats
+
+@click.command('init-db')
+@with_appcontext
+def init_db():
+    """Create the tables of a new database, and any that are missing."""
+    db.create_all()
+    click.echo('Database initialized.')
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db():
+    """Upgrade an existing database file to the current schema."""
+    migrations.upgrade(db.engine)
+    click.echo('Database upgraded.')
+
+@click.command('rebuild-stats')
+@with_appcontext
+def rebuild_stats():
+    """Recompute the stats counters, repairing any drift."""
+    start = time.perf_counter()
+    with db.engine.begin() as connection:
+        stats.rebuild(connection)
+        # The snapshot has the consoles' game counts
+        jobs.enqueue(connection, 'snapshot', 'catalog')
+    click.echo(f'Stats rebuilt in {time.perf_counter() - start:.2f}s.')
+
+@click.command('rebuild-recommendations')
+@with_appcontext
+def rebuild_recommendations():
+    """Recompute similar games and recommendations from every collection."""
+    try:
+        import numpy, scipy
+    except ImportError:
+        raise click.ClickException('Rebuilding recommendations needs `pip install numpy scipy`.')
+    start = time.perf_counter()
+    with db.engine.begin() as connection:
+        similar, recommended = recommendations.rebuild(connection)
+    click.echo(
+        f'Stored {similar} similar games and {recommended} recommendations '
+        f'in {time.perf_counter() - start:.2f}s.')
+
+@click.command('rebuild-snapshot')
+@with_appcontext
+def rebuild_snapshot():
+    """Write a new catalog snapshot, e.g. before starting the workers."""
+    start = time.perf_counter()
+    catalog_snapshot.rebuild()
+    click.echo(f'Catalog snapshot written to {catalog_snapshot.path} '
+        f'in {time.perf_counter() - start:.2f}s.')
+
+@click.command('import-catalog')
+@with_appcontext
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--kind', type=click.Choice(importer.KINDS), required=True,
+    help='What the rows of the file are.')
+@click.option('--batch-size', default=importer.BATCH_SIZE, show_default=True,
+    help='Rows to insert per transaction.')
+def import_catalog(path, kind, batch_size):
+    """Stream consoles, genres or games from a .csv or .jsonl file."""
+    start = time.perf_counter()
+    result = importer.import_catalog(db.engine, path, kind, batch_size)
+    elapsed = time.perf_counter() - start
+    rate = (result.imported + result.skipped) / elapsed if elapsed else 0
+    click.echo(
+        f'Imported {result.imported} {kind}, skipped {result.skipped}, '
+        f'in {elapsed:.2f}s ({rate:.0f} rows/sec).')
+
+@click.command('export-catalog')
+@with_appcontext
+@click.argument('output', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--kind', type=click.Choice(importer.KINDS), required=True,
+    help='What to export.')
+@click.option('--format', 'format', type=click.Choice(exporter.FORMATS),
+    help='Output format, by default taken from the file extension or jsonl.')
+def export_catalog(output, kind, format):
+    """Stream the consoles, genres or games in the catalog to a file or stdout."""
+    if format is None:
+        format = 'csv' if getattr(output, 'name', '').endswith('.csv') else 'jsonl'
+    rows = exporter.catalog_rows(kind)
+    for chunk in exporter.encode(rows, exporter.CATALOG_FIELDS[kind], format):
+        output.write(chunk)
+
+@click.command('worker')
+@with_appcontext
+@click.option('--threads', type=int, help='Jobs to run at once, by default JOB_THREADS.')
+@click.option('--once', is_flag=True, help='Run the jobs that are due, then exit.')
+def worker(threads, once):
+    """Run background jobs as they're queued."""
+    app = current_app._get_current_object()
+    runner = jobs.Worker(app, threads or app.config['JOB_THREADS'])
+    if not once:
+        click.echo(f'Running jobs with {runner.threads} threads.')
+        runner.run_forever()
+        return
+    ran = 0
+    while True:
+        count = runner.run_once()
+        if not count:
+            break
+        ran += count
+    click.echo(f'Ran {ran} jobs.')
+
+@click.command('jobs')
+@with_appcontext
+def job_stats():
+    """Show how many jobs of each kind are waiting, running and failed."""
+    with db.engine.connect() as connection:
+        click.echo(json.dumps(jobs.queue_stats(connection), indent=2, sort_keys=True))
+
+@click.command('compact-activity')
+@with_appcontext
+@click.option('--days', type=int, help='Days of events to keep, by default ACTIVITY_RETENTION_DAYS.')
+def compact_activity(days):
+    """Delete old activity events, which the daily rollups still count."""
+    if days is None:
+        days = current_app.config['ACTIVITY_RETENTION_DAYS']
+    start = time.perf_counter()
+    deleted = activity.compact(db.engine, time.time() - days * 86400)
+    click.echo(f'Deleted {deleted} events older than {days} days '
+        f'in {time.perf_counter() - start:.2f}s.')
+
+COMMANDS = [init_db, upgrade_db, rebuild_stats, rebuild_recommendations, rebuild_snapshot,
+    import_catalog, export_catalog, worker, job_stats, compact_activity]
+
+def init_app(app):
+    for command in COMMANDS:
+        app.cli.add_command(command)
@@ -1,12 +1,101 @@
 """Initialize Config class to access environment variables."""
 from dotenv import load_dotenv
 import os
+import tempfile
 
 load_dotenv()
 
+def env_flag(name, default):
+    """Read a true/false environment variable."""
+    return os.getenv(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
 class Config(object):
     """Set environment variables."""
 
     SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Connection pool settings. SQLite connections aren't pooled, so it only
+    # uses pool_recycle; see tracker_app.engine
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.getenv('DATABASE_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DATABASE_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.getenv('DATABASE_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DATABASE_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': env_flag('DATABASE_POOL_PRE_PING', True),
+    }
+
+    # SQLite waits up to SQLITE_BUSY_TIMEOUT milliseconds for a lock
+    SQLITE_WAL = env_flag('SQLITE_WAL', True)
+    SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+
+    # What the tests run against, e.g. postgresql://localhost/tracker_test
+    TEST_DATABASE_URI = os.getenv('TEST_DATABASE_URI', 'sqlite:///:memory:')
     SECRET_KEY = os.getenv('SECRET_KEY')
+
+    # Logged in users stay cached for up to USER_CACHE_TTL seconds
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))
+
+    # Where rendered page fragments are cached; see tracker_app.cache.CacheBackend.
+    # Fragments are keyed by the catalog snapshot, so each process may keep
+    # its own, and a shared backend only saves rendering them in each.
+    FRAGMENT_CACHE_BACKEND = os.getenv('FRAGMENT_CACHE_BACKEND', 'tracker_app.cache.LocalBackend')
+    FRAGMENT_CACHE_SIZE = int(os.getenv('FRAGMENT_CACHE_SIZE', 1024))
+
+    # The catalog snapshot file, by default catalog.snapshot in the instance
+    # folder. Processes serving the same database must share the file, as
+    # deleting it is how they learn of each other's changes; see
+    # tracker_app.snapshot
+    SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH')
+
+    # Days of activity events kept for the feeds; `flask compact-activity`
+    # deletes older ones, which the daily rollups still count. See
+    # tracker_app.activity
+    ACTIVITY_RETENTION_DAYS = int(os.getenv('ACTIVITY_RETENTION_DAYS', 90))
+
+    # Background jobs run by `flask worker`; see tracker_app.jobs. A claimed
+    # job is given JOB_LEASE seconds before another worker may run it, and
+    # failing jobs are tried JOB_MAX_ATTEMPTS times
+    JOB_THREADS = int(os.getenv('JOB_THREADS', 4))
+    JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1))
+    JOB_LEASE = int(os.getenv('JOB_LEASE', 300))
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+
+    # Token buckets limiting how often a client may sign up, log in and edit
+    # collections; see tracker_app.ratelimit. Each limit is 'N/period':
+    # bursts of up to N requests, refilled at N per second, minute, hour or
+    # day. Processes only share buckets with a shared RATELIMIT_BACKEND
+    RATELIMIT_ENABLED = env_flag('RATELIMIT_ENABLED', True)
+    RATELIMIT_BACKEND = os.getenv('RATELIMIT_BACKEND', 'tracker_app.ratelimit.LocalBackend')
+    RATELIMIT_SIZE = int(os.getenv('RATELIMIT_SIZE', 100000))
+    RATE_LIMITS = {
+        # Per address
+        'signup': os.getenv('RATE_LIMIT_SIGNUP', '10/hour'),
+        'login': os.getenv('RATE_LIMIT_LOGIN', '30/minute'),
+        # Per username tried from each address
+        'login_username': os.getenv('RATE_LIMIT_LOGIN_USERNAME', '10/minute'),
+        # Per user
+        'collection': os.getenv('RATE_LIMIT_COLLECTION', '120/minute'),
+    }
+
+    # Per-request timings in Server-Timing headers, logs and /_perf, which
+    # keeps the last PERF_SAMPLES requests of each endpoint; see tracker_app.perf
+    PERF_ENABLED = env_flag('PERF_ENABLED', False)
+    PERF_SAMPLES = int(os.getenv('PERF_SAMPLES', 1000))
+
+    # bcrypt work factor, and how many passwords can be hashed at once
+    BCRYPT_LOG_ROUNDS = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
+    BCRYPT_THREADS = int(os.getenv('BCRYPT_THREADS', os.cpu_count() or 1))
+
+class TestConfig(Config):
+    """Settings for the tests."""
+
+    TESTING = True
+    DEBUG = False
+    SQLALCHEMY_DATABASE_URI = Config.TEST_DATABASE_URI
+    SECRET_KEY = Config.SECRET_KEY or 'testing'
+    # Per process, so test runs against different databases can't share it
+    SNAPSHOT_PATH = os.path.join(tempfile.gettempdir(), f'tracker_test_{os.getpid()}.snapshot')
+    # The tests log in over and over; RateLimitTests turn it back on
+    RATELIMIT_ENABLED = False
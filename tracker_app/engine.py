@@ -0,0 +1,50 @@
+"""Database engine setup for SQLite and PostgreSQL.
+
+Pool settings come from SQLALCHEMY_ENGINE_OPTIONS. SQLite connections
+aren't pooled (flask-sqlalchemy uses a NullPool for files and a StaticPool
+for :memory:), so the options that only apply to a connection pool are left
+out for SQLite, and each new SQLite connection is set up with the pragmas
+from sqlite_pragmas() instead.
+"""
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+
+# Options only accepted by a QueuePool, or only useful with one
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_pre_ping')
+
+def sqlite_pragmas(config):
+    """Return the PRAGMA statements run on every new SQLite connection."""
+    pragmas = [f'PRAGMA busy_timeout = {config["SQLITE_BUSY_TIMEOUT"]}']
+    if config['SQLITE_WAL']:
+        # Readers don't block the writer (or the other way around) in WAL
+        # mode, and NORMAL only syncs at checkpoints, which is safe with WAL
+        pragmas.append('PRAGMA journal_mode = WAL')
+        pragmas.append('PRAGMA synchronous = NORMAL')
+    return pragmas
+
+class Database(SQLAlchemy):
+    """SQLAlchemy extension that applies our per-backend engine settings."""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        self.pragmas = sqlite_pragmas(app.config)
+
+    def create_engine(self, sa_url, engine_opts):
+        # Called with SQLALCHEMY_ENGINE_OPTIONS already merged in
+        is_sqlite = sa_url.drivername.startswith('sqlite')
+        if is_sqlite:
+            engine_opts = {
+                name: value for name, value in engine_opts.items()
+                if name not in POOL_OPTIONS
+            }
+        engine = super().create_engine(sa_url, engine_opts)
+        if is_sqlite:
+            pragmas = self.pragmas
+
+            @event.listens_for(engine, 'connect')
+            def set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for pragma in pragmas:
+                    cursor.execute(pragma)
+                cursor.close()
+        return engine
@@ -0,0 +1,117 @@
+"""Streaming export of user collections and the catalog as CSV or JSONL.
+
+Rows are read with yield_per() and written out a chunk at a time, so an
+export never holds the whole result set or output in memory. Catalog
+exports use the same columns import-catalog reads, so they can be imported
+again.
+"""
+import csv
+import io
+import json
+
+from flask import Response, stream_with_context
+from tracker_app import db
+from tracker_app.importer import batches
+from tracker_app.models import Console, Game, Genre, game_genre_table, consoles_owned_table, games_owned_table
+
+YIELD_PER = 1000
+
+FORMATS = ('csv', 'jsonl')
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+COLLECTION_FIELDS = ['type', 'id', 'name', 'maker', 'console', 'portable', 'personal_rating']
+
+CATALOG_FIELDS = {
+    'consoles': ['name', 'company', 'portable', 'console_notes'],
+    'genres': ['name'],
+    'games': ['title', 'publisher', 'personal_rating', 'game_notes', 'console', 'genres'],
+}
+
+def stream(query):
+    """Iterate a query's rows a batch at a time instead of all at once."""
+    return query.execution_options(stream_results=True).yield_per(YIELD_PER)
+
+def collection_rows(user_id):
+    """Yield a dict for each console and then each game a user owns."""
+    consoles = db.session.query(Console.id, Console.name, Console.company, Console.portable) \
+        .join(consoles_owned_table) \
+        .filter(consoles_owned_table.c.user_id == user_id) \
+        .order_by(Console.id)
+    for id, name, company, portable in stream(consoles):
+        yield {'type': 'console', 'id': id, 'name': name, 'maker': company, 'portable': portable}
+
+    games = db.session.query(Game.id, Game.title, Game.publisher, Game.personal_rating, Console.name) \
+        .join(games_owned_table) \
+        .join(Game.console) \
+        .filter(games_owned_table.c.user_id == user_id) \
+        .order_by(Game.id)
+    for id, title, publisher, rating, console in stream(games):
+        yield {'type': 'game', 'id': id, 'name': title, 'maker': publisher,
+               'console': console, 'personal_rating': rating}
+
+def catalog_rows(kind):
+    """Yield a dict for each console, genre or game in the catalog."""
+    if kind == 'consoles':
+        query = db.session.query(
+            Console.name, Console.company, Console.portable, Console.console_notes
+        ).order_by(Console.id)
+        for row in stream(query):
+            yield dict(zip(CATALOG_FIELDS['consoles'], row))
+    elif kind == 'genres':
+        for name, in stream(db.session.query(Genre.name).order_by(Genre.id)):
+            yield {'name': name}
+    else:
+        yield from game_rows()
+
+def game_rows():
+    """Yield every game, looking up each batch's genres with one query."""
+    genre_names = dict(db.session.query(Genre.id, Genre.name))
+    query = db.session.query(
+        Game.id, Game.title, Game.publisher, Game.personal_rating, Game.game_notes, Console.name
+    ).join(Game.console).order_by(Game.id)
+
+    for batch in batches(stream(query), YIELD_PER):
+        genres = {row[0]: [] for row in batch}
+        links = db.session.query(game_genre_table.c.game_id, game_genre_table.c.genre_id) \
+            .filter(game_genre_table.c.game_id.in_(list(genres)))
+        for game_id, genre_id in links:
+            genres[game_id].append(genre_names[genre_id])
+
+        for id, title, publisher, rating, notes, console in batch:
+            yield {'title': title, 'publisher': publisher, 'personal_rating': rating,
+                   'game_notes': notes, 'console': console, 'genres': sorted(genres[id])}
+
+def csv_value(value):
+    """Format a value the way import-catalog reads it back from CSV."""
+    if isinstance(value, list):
+        return '|'.join(value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+def encode(rows, fields, format):
+    """Yield rows as CSV or JSONL text, YIELD_PER rows per chunk."""
+    if format == 'csv':
+        yield ','.join(fields) + '\r\n'
+    for batch in batches(rows, YIELD_PER):
+        buffer = io.StringIO()
+        if format == 'csv':
+            writer = csv.DictWriter(buffer, fields, extrasaction='ignore')
+            for row in batch:
+                writer.writerow({key: csv_value(value) for key, value in row.items()})
+        else:
+            for row in batch:
+                buffer.write(json.dumps(row))
+                buffer.write('\n')
+        yield buffer.getvalue()
+
+def stream_response(rows, fields, format, filename):
+    """Return a streamed download of rows in the given format."""
+    return Response(
+        stream_with_context(encode(rows, fields, format)),
+        mimetype=MIMETYPES[format],
+        headers={'Content-Disposition': f'attachment; filename={filename}.{format}'})
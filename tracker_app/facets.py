@@ -0,0 +1,364 @@
+"""Faceted browsing of the games in the catalog snapshot.
+
+Games are numbered by their position in the snapshot's console.games
+array, i.e. by console and then id, so each console's games are one range
+of positions. Alongside its other arrays the snapshot holds:
+
+- facet.row: the game row at each position
+- facet.portable: a bitmap of the games on portable consoles
+- facet.genre.bitmaps: a bitmap per genre, in genre.id order
+- facet.rating.values and facet.rating.bitmaps: a bitmap per rating
+- facet.publisher: the publishers in order, with the positions of each one's
+  games as a posting list, and facet.publisher.of, each position's publisher
+- facet.publisher.bitmaps: a bitmap per publisher with at least 1/DENSE of
+  the games, and facet.publisher.bitmap, each publisher's bitmap or -1.
+  facet.publisher.small is a bitmap of the games of the other publishers.
+
+A bitmap is bytes of one bit per position. There can be nearly as many
+publishers as games, so only the big ones get bitmaps too, which bounds
+their size at DENSE bitmaps.
+
+Browsing turns each filter into a bitmap held as a Python int, ORing the
+values picked within a filter and ANDing the filters together, so a query
+costs a few passes over one bit per game rather than a pass over the rows.
+The counts of each facet apply every filter but its own, so they show what
+picking another value of it would match.
+"""
+import array
+import bisect
+from collections import Counter, namedtuple
+from itertools import compress
+
+from tracker_app.pagination import Page
+
+# Values listed per facet, apart from the picked ones, by most games
+FACET_LIMIT = 20
+
+# Publishers with at least 1/DENSE of the games get a bitmap
+DENSE = 64
+
+# Genres are counted from the games in a match with fewer than 1/SPARSE
+# of them, rather than from each genre's bitmap
+SPARSE = 16
+
+# The set bits of an int; int.bit_count needs Python 3.10
+_popcount = getattr(int, 'bit_count', None) or (lambda bitmap: bin(bitmap).count('1'))
+
+# Turns '0' and '1' characters into 0 and 1 bytes
+_FLAGS = bytes.maketrans(b'01', b'\x00\x01')
+
+Filters = namedtuple('Filters', 'console genre publisher min_rating max_rating portable')
+FacetValue = namedtuple('FacetValue', 'value label count selected')
+Browse = namedtuple('Browse', 'total games facets')
+
+DIMENSIONS = ('console', 'genre', 'publisher', 'rating', 'portable')
+
+
+##########################################
+#           Building                     #
+##########################################
+
+def _bitmap(size):
+    return bytearray(-(-size // 8))
+
+def _set(bitmap, position):
+    bitmap[position >> 3] |= 1 << (position & 7)
+
+def build(order, portable, game_genres, ratings, publishers, genre_ids):
+    """Return the facet arrays of a snapshot, and the publishers' names and
+    posting lists.
+
+    order lists the game rows by position and portable is whether each
+    position's console is portable. game_genres (Ragged), ratings and
+    publishers are per game row.
+    """
+    size = len(order)
+    genre_rows = {id: row for row, id in enumerate(genre_ids)}
+    genre_offsets, genre_values = game_genres.offsets, game_genres.values
+    rating_rows = {value: row for row, value in enumerate(sorted(
+        {ratings[row] for row in order if ratings[row] >= 0}))}
+
+    portable_bitmap = _bitmap(size)
+    genre_bitmaps = [_bitmap(size) for _ in genre_rows]
+    rating_bitmaps = [_bitmap(size) for _ in rating_rows]
+    postings = {}
+    for position, row in enumerate(order):
+        if portable[position]:
+            _set(portable_bitmap, position)
+        for genre_id in genre_values[genre_offsets[row]:genre_offsets[row + 1]]:
+            if genre_id in genre_rows:
+                _set(genre_bitmaps[genre_rows[genre_id]], position)
+        if ratings[row] in rating_rows:
+            _set(rating_bitmaps[rating_rows[ratings[row]]], position)
+        if publishers[row]:
+            postings.setdefault(publishers[row], []).append(position)
+
+    names = sorted(postings)
+    publisher_of = array.array('i', [-1]) * size
+    publisher_bitmap = array.array('i', [-1]) * len(names)
+    publisher_bitmaps, small = [], _bitmap(size)
+    for publisher_row, name in enumerate(names):
+        if len(postings[name]) * DENSE >= size:
+            publisher_bitmap[publisher_row] = len(publisher_bitmaps)
+            publisher_bitmaps.append(_bitmap(size))
+        for position in postings[name]:
+            publisher_of[position] = publisher_row
+            _set(publisher_bitmaps[-1] if publisher_bitmap[publisher_row] != -1 else small, position)
+
+    facet_arrays = {
+        'facet.row': array.array('i', order),
+        'facet.portable': array.array('B', portable_bitmap),
+        'facet.genre.bitmaps': array.array('B', b''.join(genre_bitmaps)),
+        'facet.rating.values': array.array('i', rating_rows),
+        'facet.rating.bitmaps': array.array('B', b''.join(rating_bitmaps)),
+        'facet.publisher.of': publisher_of,
+        'facet.publisher.bitmap': publisher_bitmap,
+        'facet.publisher.bitmaps': array.array('B', b''.join(publisher_bitmaps)),
+        'facet.publisher.small': array.array('B', small),
+    }
+    return facet_arrays, names, [postings[name] for name in names]
+
+##########################################
+#           Browsing                     #
+##########################################
+
+def _row(ids, id):
+    """Return the row of id in a sorted array of ids, or None."""
+    row = bisect.bisect_left(ids, id)
+    return row if row < len(ids) and ids[row] == id else None
+
+class _Ragged(object):
+    """Rows of a ragged section of a snapshot, as a sequence."""
+
+    def __init__(self, arrays, name, text=False):
+        self.offsets = arrays[f'{name}.offsets']
+        self.values = arrays[f'{name}.values']
+        self.text = text
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        values = self.values[self.offsets[row]:self.offsets[row + 1]]
+        return str(values, 'utf-8') if self.text else values
+
+class Facets(object):
+    """The facet arrays of a Snapshot, read as int bitmaps."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.arrays = arrays = snapshot.arrays
+        self.size = len(arrays['console.games.values'])
+        self.width = -(-self.size // 8)
+        self.everything = (1 << self.size) - 1
+        self.console_ids = arrays['console.id']
+        self.console_offsets = arrays['console.games.offsets']
+        self.genre_ids = arrays['genre.id']
+        self.rating_values = arrays['facet.rating.values']
+        self.publisher_names = _Ragged(arrays, 'facet.publisher.name', text=True)
+        self.publisher_games = _Ragged(arrays, 'facet.publisher.games')
+        self.publisher_bitmap = arrays['facet.publisher.bitmap']
+        # The counts of everything, as most browsing starts there
+        self._totals = {}
+        # The flags of the last match, as most are needed more than once
+        self._last_flags = (None, None)
+
+    def _bitmap(self, name, row=0):
+        """Return a stored bitmap as an int."""
+        return int.from_bytes(self.arrays[name][row * self.width:(row + 1) * self.width], 'little')
+
+    def _flags(self, match):
+        """Return a byte per position, 1 where match has the position."""
+        last, flags = self._last_flags
+        if last is not match:
+            flags = format(match, f'0{self.size}b')[::-1].encode('ascii').translate(_FLAGS)
+            self._last_flags = (match, flags)
+        return flags
+
+    def _positions(self, match):
+        """Yield the positions in match, in order."""
+        flags = self._flags(match)
+        position = flags.find(1)
+        while position != -1:
+            yield position
+            position = flags.find(1, position + 1)
+
+    def _console(self, console_id):
+        row = _row(self.console_ids, console_id)
+        if row is None:
+            return 0
+        start, end = self.console_offsets[row], self.console_offsets[row + 1]
+        return ((1 << (end - start)) - 1) << start
+
+    def _genre(self, genre_id):
+        row = _row(self.genre_ids, genre_id)
+        return 0 if row is None else self._bitmap('facet.genre.bitmaps', row)
+
+    def publisher_row(self, name):
+        """Return the row of a publisher, or None."""
+        row = bisect.bisect_left(self.publisher_names, name)
+        if row == len(self.publisher_names) or self.publisher_names[row] != name:
+            return None
+        return row
+
+    def _publisher(self, name):
+        row = self.publisher_row(name)
+        if row is None:
+            return 0
+        if self.publisher_bitmap[row] != -1:
+            return self._bitmap('facet.publisher.bitmaps', self.publisher_bitmap[row])
+        bitmap = _bitmap(self.size)
+        for position in self.publisher_games[row]:
+            _set(bitmap, position)
+        return int.from_bytes(bitmap, 'little')
+
+    def masks(self, filters):
+        """Return the bitmap of each dimension that's filtered on."""
+        masks = {}
+        for dimension, values, bitmap in [
+                ('console', filters.console, self._console),
+                ('genre', filters.genre, self._genre),
+                ('publisher', filters.publisher, self._publisher)]:
+            if values:
+                masks[dimension] = 0
+                for value in values:
+                    masks[dimension] |= bitmap(value)
+        if filters.min_rating is not None or filters.max_rating is not None:
+            masks['rating'] = 0
+            for row, value in enumerate(self.rating_values):
+                if in_range(filters, value):
+                    masks['rating'] |= self._bitmap('facet.rating.bitmaps', row)
+        if filters.portable is not None:
+            portable = self._bitmap('facet.portable')
+            masks['portable'] = portable if filters.portable else self.everything & ~portable
+        return masks
+
+    def match(self, masks, without=None):
+        """AND together the masks, apart from the one of dimension without."""
+        match = self.everything
+        for dimension, mask in masks.items():
+            if dimension != without:
+                match &= mask
+        return match
+
+    def counts(self, dimension, match):
+        """Return the games within match of each value of a dimension.
+
+        Publishers are counted by row.
+        """
+        if match is self.everything:
+            if dimension not in self._totals:
+                self._totals[dimension] = self._counts(dimension, match)
+            return self._totals[dimension]
+        return self._counts(dimension, match)
+
+    def _counts(self, dimension, match):
+        if dimension == 'console':
+            offsets = self.console_offsets
+            if match is self.everything:
+                return {id: offsets[row + 1] - offsets[row] for row, id in enumerate(self.console_ids)}
+            flags = self._flags(match)
+            return {id: flags.count(1, offsets[row], offsets[row + 1])
+                    for row, id in enumerate(self.console_ids)}
+        if dimension == 'genre':
+            if _popcount(match) * SPARSE < self.size:
+                rows, counts = self.arrays['facet.row'], Counter()
+                genres = _Ragged(self.arrays, 'game.genres')
+                for position in self._positions(match):
+                    counts.update(genres[rows[position]])
+                return counts
+            return {id: _popcount(match & self._bitmap('facet.genre.bitmaps', row))
+                    for row, id in enumerate(self.genre_ids)}
+        if dimension == 'publisher':
+            # Big publishers by their bitmaps, and the rest by a pass over
+            # the publisher of each of their games in match
+            small = match & self._bitmap('facet.publisher.small')
+            counts = Counter(compress(self.arrays['facet.publisher.of'], self._flags(small)))
+            for row, bitmap in enumerate(self.publisher_bitmap):
+                if bitmap != -1:
+                    counts[row] = _popcount(match & self._bitmap('facet.publisher.bitmaps', bitmap))
+            return counts
+        if dimension == 'rating':
+            return {value: _popcount(match & self._bitmap('facet.rating.bitmaps', row))
+                    for row, value in enumerate(self.rating_values)}
+        portable = _popcount(match & self._bitmap('facet.portable'))
+        return {True: portable, False: _popcount(match) - portable}
+
+    def page(self, match, after, limit):
+        """Return a Page of the games in match from position after on, whose
+        next_after is the position the next page starts from."""
+        flags = self._flags(match)
+        positions = []
+        position = flags.find(1, after)
+        while position != -1 and len(positions) <= limit:
+            positions.append(position)
+            position = flags.find(1, position + 1)
+        game_ids = self.arrays['console.games.values']
+        games = [self.snapshot.game(game_ids[position]) for position in positions[:limit]]
+        if len(positions) > limit:
+            return Page(games, limit, next_after=positions[limit])
+        return Page(games, limit)
+
+def in_range(filters, rating):
+    """Return whether a rating is within the filters' rating range."""
+    return ((filters.min_rating is None or rating >= filters.min_rating)
+        and (filters.max_rating is None or rating <= filters.max_rating))
+
+def _facet_values(dimension, counts, selected, label):
+    """Return the FacetValues of a dimension.
+
+    Consoles and publishers list the picked values and the FACET_LIMIT
+    others with the most games; the rest list every value with games.
+    """
+    counted = [(value, count) for value, count in counts.items() if count and value not in selected]
+    if dimension in ('console', 'publisher'):
+        counted = sorted(counted, key=lambda pair: -pair[1])[:FACET_LIMIT]
+    counted = [(value, counts.get(value, 0)) for value in selected] + counted
+    values = [FacetValue(value, label(value), count, value in selected) for value, count in counted]
+    if dimension == 'genre':
+        values.sort(key=lambda value: value.label)
+    elif dimension == 'rating':
+        values.sort(key=lambda value: -value.value)
+    elif dimension == 'portable':
+        values.sort(key=lambda value: not value.value)
+    return values
+
+_facets = None
+
+def facets_of(snapshot):
+    """Return the Facets of a Snapshot, kept until the snapshot changes."""
+    global _facets
+    if _facets is None or _facets.snapshot is not snapshot:
+        _facets = Facets(snapshot)
+    return _facets
+
+def browse(snapshot, filters, after, limit):
+    """Return the games matching filters, and the counts of each facet."""
+    facets = facets_of(snapshot)
+    masks = facets.masks(filters)
+    match = facets.match(masks)
+
+    rated = filters.min_rating is not None or filters.max_rating is not None
+    selected = {
+        'console': set(filters.console),
+        'genre': set(filters.genre),
+        'publisher': {facets.publisher_row(name) for name in filters.publisher} - {None},
+        'rating': {value for value in facets.rating_values if rated and in_range(filters, value)},
+        'portable': set() if filters.portable is None else {filters.portable},
+    }
+    genre_names = dict(snapshot.choices('genre'))
+    labels = {
+        'console': lambda id: getattr(snapshot.console(id), 'name', ''),
+        'genre': lambda id: genre_names.get(id, ''),
+        'publisher': facets.publisher_names.__getitem__,
+        'rating': str,
+        'portable': lambda portable: 'Portable' if portable else 'Home',
+    }
+    facet_values = {}
+    for dimension in DIMENSIONS:
+        within = facets.match(masks, without=dimension) if dimension in masks else match
+        facet_values[dimension] = _facet_values(dimension,
+            facets.counts(dimension, within), selected[dimension], labels[dimension])
+    # Counted by row, but picked by name
+    facet_values['publisher'] = [value._replace(value=value.label) for value in facet_values['publisher']]
+    return Browse(_popcount(match), facets.page(match, after, limit), facet_values)
@@ -0,0 +1,107 @@
+"""Cache of rendered page fragments, keyed by the catalog snapshot.
+
+Cached fragments are rendered only from the catalog snapshot (see
+tracker_app.snapshot), so each is keyed by the snapshot's version stamp
+plus what it shows, e.g. a console's id and page. Any change to the catalog
+replaces the snapshot, and with it the stamp, so later requests build new
+keys and re-render instead of reading the old fragments. The snapshot file
+is shared by every process using the database, so a change one worker
+commits is seen by all of them, and the fragments of the old stamp age out
+of the backend. Only parts of pages that look the same to everyone are
+cached; collection buttons, forms and flashed messages are rendered per
+request.
+"""
+import hashlib
+import time
+
+from flask import current_app, make_response, render_template, request, session
+from flask_login import current_user
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
+from werkzeug.utils import import_string
+
+class FragmentCache(object):
+    """Renders templates into fragments kept in a CacheBackend."""
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def init_app(self, app):
+        """Use the app's FRAGMENT_CACHE_BACKEND."""
+        backend = import_string(app.config['FRAGMENT_CACHE_BACKEND'])
+        self.backend = backend(app.config['FRAGMENT_CACHE_SIZE'])
+
+    def render(self, stamp, key, template, context):
+        """Return the rendered template, from the cache if it was rendered
+        from the snapshot with this stamp.
+
+        context is a function returning the template's variables, read from
+        that snapshot, so they're only built when the fragment has to be
+        rendered.
+        """
+        cache_key = repr((template, key, stamp))
+        html = self.backend.get(cache_key)
+        if html is None:
+            html = render_template(template, **context())
+            self.backend.set(cache_key, html)
+        return Markup(html)
+
+    def clear(self):
+        self.backend.clear()
+
+class PageValidators(object):
+    """ETag and Last-Modified of a page built from cached fragments.
+
+    The ETag covers the stamp of the snapshot the page was built from, who
+    is viewing it, their CSRF token and whatever else is passed in, e.g.
+    whether they own the item. The snapshot was written when the catalog
+    last changed, which is the page's Last-Modified.
+    """
+
+    def __init__(self, stamp, *parts):
+        viewer = (current_user.get_id(), getattr(current_user, 'username', None))
+        data = repr((stamp, viewer, csrf_state(), parts))
+        self.etag = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        self.last_modified = stamp / 1e9
+
+    def not_modified(self):
+        """Return whether the client's copy of the page is still current.
+
+        Only GET requests with a matching If-None-Match are answered from
+        the client's copy, never while there are flashed messages waiting to
+        be shown. If-Modified-Since alone isn't enough, as the page also
+        depends on who is viewing it.
+        """
+        if request.method != 'GET' or 'If-None-Match' not in request.headers:
+            return False
+        if session.get('_flashes'):
+            return False
+        return not is_resource_modified(request.environ, etag=self.etag)
+
+    def apply(self, response):
+        """Add the validators to a response for a GET request."""
+        if request.method == 'GET':
+            response.set_etag(self.etag)
+            response.last_modified = self.last_modified
+            # Browsers must check back each time, as the page can change
+            response.cache_control.no_cache = True
+            response.cache_control.private = True
+        return response
+
+    def respond(self, render):
+        """Return a 304 if the client's copy is current, or else render()."""
+        if self.not_modified():
+            response = make_response('', 304)
+        else:
+            response = make_response(render())
+        return self.apply(response)
+
+def csrf_state():
+    """Return what a page's CSRF token depends on.
+
+    Tokens expire, so this changes every half WTF_CSRF_TIME_LIMIT seconds to
+    stop a browser reusing a page whose form can no longer be submitted.
+    """
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    period = int(time.time() // (limit / 2)) if limit else None
+    return session.get('csrf_token'), period
@@ -0,0 +1,216 @@
+"""Bulk import of consoles, genres and games from CSV or JSONL files.
+
+Rows are streamed from the file and inserted in batches with Core
+executemany inserts, so memory use doesn't depend on the size of the file.
+Console and genre names are resolved to ids through in-memory maps loaded
+once at the start.
+
+Ids come from the database, so the site can keep taking writes during an
+import: each batch of games reserves its ids before inserting them with
+their game_genre rows (see insert_with_ids), and genres are matched by
+name, skipping any the site created since. A job to replace the catalog
+snapshot is queued once the import ends, even if it failed part way.
+
+Expected columns, by kind:
+
+- consoles: name, company, portable, console_notes
+- genres: name
+- games: title, publisher, personal_rating, game_notes, console (a console
+  name) and genres (a list in JSONL, names separated by "|" in CSV)
+"""
+import csv
+import itertools
+import json
+from collections import Counter
+
+from sqlalchemy import func, select, text
+from tracker_app import jobs, stats
+from tracker_app.models import Console, Game, Genre, game_genre_table, insert_ignoring_duplicates
+
+BATCH_SIZE = 5000
+
+KINDS = ('consoles', 'genres', 'games')
+
+class ImportResult(object):
+    """Counts of the rows an import inserted and skipped."""
+
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+
+def read_rows(path):
+    """Yield each row of a .jsonl or .csv file as a dict."""
+    with open(path, newline='', encoding='utf-8') as file:
+        if path.endswith('.jsonl'):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(file)
+
+def batches(rows, size):
+    """Yield lists of up to size rows at a time."""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def clean(value):
+    """Strip a text value, turning empty strings into None."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return (clean(value) or '').lower() in ('1', 'true', 'yes', 'y')
+
+def parse_int(value):
+    value = clean(value)
+    return int(value) if value is not None else None
+
+def parse_names(value):
+    """Parse a list of names, or a "|" separated string of them."""
+    if isinstance(value, list):
+        names = value
+    else:
+        names = (clean(value) or '').split('|')
+    return [name for name in (clean(name) for name in names) if name]
+
+class CatalogImporter(object):
+    """Inserts batches of catalog rows through one database engine."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        with engine.connect() as connection:
+            # When console names repeat, games go to the oldest console
+            self.console_ids = {
+                name: id for id, name in connection.execute(
+                    select([Console.id, Console.name]).order_by(Console.id.desc()))
+            }
+            self.genre_ids = {
+                name: id for id, name in connection.execute(select([Genre.id, Genre.name]))
+            }
+
+    def import_rows(self, kind, rows, batch_size=BATCH_SIZE):
+        """Import an iterable of row dicts of the given kind."""
+        insert_batch = getattr(self, f'insert_{kind}')
+        result = ImportResult()
+        for batch in batches(rows, batch_size):
+            with self.engine.begin() as connection:
+                imported = insert_batch(connection, batch)
+            result.imported += imported
+            result.skipped += len(batch) - imported
+        return result
+
+    def insert_consoles(self, connection, batch):
+        consoles = []
+        for row in batch:
+            name = clean(row.get('name'))
+            if not name:
+                continue
+            consoles.append({
+                'name': name,
+                'company': clean(row.get('company')),
+                'portable': parse_bool(row.get('portable')),
+                'console_notes': clean(row.get('console_notes')),
+            })
+        insert_with_ids(connection, Console.__table__, consoles)
+        for console in consoles:
+            self.console_ids.setdefault(console['name'], console['id'])
+        return len(consoles)
+
+    def insert_genres(self, connection, batch):
+        names = set()
+        for row in batch:
+            names.update(parse_names([row.get('name')]))
+        return self.create_genres(connection, names)
+
+    def create_genres(self, connection, names):
+        """Insert the genres whose names aren't in the database yet,
+        returning how many this inserted."""
+        names = sorted(set(names) - set(self.genre_ids))
+        if not names:
+            return 0
+        # The site may have created some since the import started
+        insert = insert_ignoring_duplicates(Genre.__table__, connection.dialect.name)
+        created = connection.execute(insert, [{'name': name} for name in names]).rowcount
+        self.genre_ids.update(
+            (name, id) for id, name in connection.execute(
+                select([Genre.id, Genre.name]).where(Genre.name.in_(names))))
+        return created
+
+    def insert_games(self, connection, batch):
+        games = []
+        game_genres = []
+        for row in batch:
+            title = clean(row.get('title'))
+            console_id = self.console_ids.get(clean(row.get('console')))
+            if not title or console_id is None:
+                continue
+            try:
+                rating = parse_int(row.get('personal_rating'))
+            except ValueError:
+                continue
+            game = {
+                'title': title,
+                'publisher': clean(row.get('publisher')),
+                'personal_rating': rating,
+                'game_notes': clean(row.get('game_notes')),
+                'console_id': console_id,
+            }
+            games.append(game)
+            for name in set(parse_names(row.get('genres'))):
+                game_genres.append((game, name))
+
+        self.create_genres(connection, [name for _, name in game_genres])
+        insert_with_ids(connection, Game.__table__, games)
+        if game_genres:
+            connection.execute(game_genre_table.insert(), [
+                {'game_id': game['id'], 'genre_id': self.genre_ids[name]}
+                for game, name in game_genres
+            ])
+        stats.add_counts(connection, stats.CONSOLE_GAMES,
+            Counter(game['console_id'] for game in games))
+        stats.add_counts(connection, stats.GENRE_GAMES,
+            Counter(self.genre_ids[name] for _, name in game_genres))
+        return len(games)
+
+def insert_with_ids(connection, table, rows):
+    """Insert rows with ids assigned by the database, setting each row's 'id'.
+
+    PostgreSQL reserves the ids from the table's sequence first, so rows
+    the site inserts meanwhile get others. SQLite lets one transaction
+    write at a time, and the insert numbers the rows one past the largest
+    id, so the ids are the last len(rows) up to the largest afterwards.
+    """
+    if not rows:
+        return
+    if connection.dialect.name == 'postgresql':
+        ids = [id for id, in connection.execute(
+            text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+            table=table.name, count=len(rows))]
+        for row, id in zip(rows, ids):
+            row['id'] = id
+        connection.execute(table.insert(), rows)
+    elif connection.dialect.name == 'sqlite':
+        connection.execute(table.insert(), rows)
+        last = connection.execute(select([func.max(table.c.id)])).scalar()
+        for row, id in zip(rows, range(last - len(rows) + 1, last + 1)):
+            row['id'] = id
+    else:
+        for row in rows:
+            row['id'], = connection.execute(table.insert(), row).inserted_primary_key
+
+def import_catalog(engine, path, kind, batch_size=BATCH_SIZE):
+    """Stream the rows of a .csv or .jsonl file of the given kind into the database."""
+    try:
+        return CatalogImporter(engine).import_rows(kind, read_rows(path), batch_size)
+    finally:
+        # The pages cached from the snapshot follow it
+        with engine.begin() as connection:
+            jobs.enqueue(connection, 'snapshot', 'catalog')
@@ -0,0 +1,236 @@
+"""Background jobs, queued in the database and run by `flask worker`.
+
+Work that follows from a write but needn't be done before its request
+returns is queued as a job in the write's own transaction, so a job exists
+exactly when its write was committed. The worker claims jobs that are due
+and runs them on a pool of threads:
+
+- A claim lasts JOB_LEASE seconds. Jobs whose worker died are claimed
+  again once their claim runs out.
+- A job that raises is retried after a delay that doubles with each
+  attempt. After JOB_MAX_ATTEMPTS attempts it's kept, marked as failed.
+- Queuing a job while one of the same kind and key is waiting merges the
+  two, e.g. one user's collection changes become one job. Jobs with the
+  same kind and key never run at the same time.
+
+Handlers are registered with @handler(kind). They're called with the
+connection of the job's transaction and its payload, and the job is
+deleted in that same transaction.
+"""
+import json
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from flask import current_app, has_app_context
+from sqlalchemy import and_, exists, func, or_, select
+from tracker_app import db
+from tracker_app.models import job_table
+from tracker_app.perf import percentile
+
+# Seconds before the first retry, doubled for each one after it
+RETRY_DELAY = 2
+MAX_RETRY_DELAY = 600
+
+# Latencies the worker keeps for its metrics
+LATENCY_SAMPLES = 1000
+
+# Seconds between the worker logging its metrics
+REPORT_INTERVAL = 60
+
+# Most seconds the worker waits before polling again after polls failed,
+# e.g. while the database is locked or unreachable
+MAX_POLL_BACKOFF = 60
+
+HANDLERS = {}
+
+def handler(kind, merge=None):
+    """Register a function to run the jobs of a kind.
+
+    merge(waiting, new) returns the payload of a waiting job with another
+    job's merged in. Without it, the newer payload replaces the older.
+    """
+    def register(func):
+        HANDLERS[kind] = (func, merge)
+        return func
+    return register
+
+def enqueue(connection, kind, key, payload=None):
+    """Queue a job, or merge it into a waiting one with the same kind and key."""
+    payload = payload or {}
+    _, merge = HANDLERS[kind]
+    job = job_table
+    waiting = connection.execute(select([job.c.id, job.c.payload]).where(and_(
+        job.c.kind == kind, job.c.key == str(key),
+        job.c.claimed_until.is_(None), job.c.failed == False))).first()
+    if waiting is not None:
+        merged = merge(json.loads(waiting.payload), payload) if merge else payload
+        # Unless a worker claimed it in the meantime
+        result = connection.execute(job.update()
+            .where(and_(job.c.id == waiting.id, job.c.claimed_until.is_(None)))
+            .values(payload=json.dumps(merged)))
+        if result.rowcount:
+            return
+    now = time.time()
+    connection.execute(job.insert().values(
+        kind=kind, key=str(key), payload=json.dumps(payload), created_at=now, run_at=now))
+
+def claim(connection, limit, lease):
+    """Claim up to limit jobs that are due, returning their rows."""
+    now = time.time()
+    job, running = job_table, job_table.alias('running')
+    unclaimed = or_(job.c.claimed_until.is_(None), job.c.claimed_until < now)
+    key_running = exists().where(and_(
+        running.c.kind == job.c.kind, running.c.key == job.c.key, running.c.claimed_until >= now))
+    due = connection.execute(select([job.c.id, job.c.kind, job.c.key])
+        .where(and_(job.c.failed == False, job.c.run_at <= now, unclaimed, ~key_running))
+        .order_by(job.c.run_at, job.c.id)
+        .limit(limit)).fetchall()
+
+    claimed, keys = [], set()
+    for id, kind, key in due:
+        if (kind, key) in keys:
+            continue
+        # Another worker may have claimed it since it was selected
+        result = connection.execute(job.update()
+            .where(and_(job.c.id == id, unclaimed))
+            .values(claimed_until=now + lease))
+        if result.rowcount:
+            claimed.append(id)
+            keys.add((kind, key))
+    if not claimed:
+        return []
+    return connection.execute(select([job]).where(job.c.id.in_(claimed)).order_by(job.c.id)).fetchall()
+
+def run(job):
+    """Run a claimed job, returning whether it succeeded.
+
+    Succeeding deletes the job. Failing schedules a retry, or marks it as
+    failed after its last attempt.
+    """
+    try:
+        func, _ = HANDLERS[job.kind]
+        with db.engine.begin() as connection:
+            func(connection, json.loads(job.payload))
+            connection.execute(job_table.delete().where(job_table.c.id == job.id))
+        return True
+    except Exception as error:
+        attempts = job.attempts + 1
+        failed = attempts >= current_app.config['JOB_MAX_ATTEMPTS']
+        delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+        current_app.logger.exception('Job %s (%s %s) failed, attempt %s', job.id, job.kind, job.key, attempts)
+        with db.engine.begin() as connection:
+            connection.execute(job_table.update().where(job_table.c.id == job.id).values(
+                attempts=attempts, failed=failed, run_at=time.time() + delay,
+                claimed_until=None, error=f'{type(error).__name__}: {error}'))
+        return False
+
+def queue_stats(connection):
+    """Return each kind's waiting, running and failed jobs, and how many
+    seconds its oldest waiting job has waited."""
+    now = time.time()
+    job = job_table
+    running = func.coalesce(job.c.claimed_until >= now, False).label('running')
+    stats = {}
+    rows = connection.execute(
+        select([job.c.kind, job.c.failed, running, func.count(), func.min(job.c.created_at)])
+        .group_by(job.c.kind, job.c.failed, 'running')).fetchall()
+    for kind, failed, is_running, count, oldest in rows:
+        kind_stats = stats.setdefault(kind, {'waiting': 0, 'running': 0, 'failed': 0, 'oldest_wait': 0})
+        if failed:
+            kind_stats['failed'] += count
+        elif is_running:
+            kind_stats['running'] += count
+        else:
+            kind_stats['waiting'] += count
+            kind_stats['oldest_wait'] = round(now - oldest, 1)
+    return stats
+
+class Worker(object):
+    """Runs due jobs on a pool of threads, keeping metrics of what it ran."""
+
+    def __init__(self, app, threads=1):
+        self.app = app
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.counts = Counter()
+        self._counts_lock = threading.Lock()
+        # Seconds from each job being queued to it finishing
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        # Polls that failed in a row
+        self.failures = 0
+
+    def app_context(self):
+        """Return a context for the app, unless this thread is already in one.
+
+        Popping a second context would remove the session of the first.
+        """
+        if has_app_context() and current_app._get_current_object() is self.app:
+            return nullcontext()
+        return self.app.app_context()
+
+    def _run(self, job):
+        with self.app_context():
+            succeeded = run(job)
+        with self._counts_lock:
+            self.counts['succeeded' if succeeded else 'errors'] += 1
+            if succeeded:
+                self.latencies.append(time.time() - job.created_at)
+
+    def run_once(self):
+        """Claim the jobs that are due and run them, returning how many ran."""
+        with self.app_context():
+            with db.engine.begin() as connection:
+                jobs = claim(connection, self.threads * 2, self.app.config['JOB_LEASE'])
+        if self.pool is None:
+            for job in jobs:
+                self._run(job)
+        else:
+            list(self.pool.map(self._run, jobs))
+        return len(jobs)
+
+    def poll(self):
+        """Run the jobs that are due, returning the seconds to wait before
+        the next poll.
+
+        Errors, e.g. the database being locked or its connection dropping,
+        are logged rather than raised, and each one in a row doubles the
+        wait, up to MAX_POLL_BACKOFF.
+        """
+        interval = self.app.config['JOB_POLL_INTERVAL']
+        try:
+            ran = self.run_once()
+        except Exception:
+            self.failures += 1
+            self.app.logger.exception('Polling for jobs failed, %s in a row', self.failures)
+            with self.app_context():
+                db.session.rollback()
+            return min(interval * 2 ** self.failures, MAX_POLL_BACKOFF)
+        self.failures = 0
+        return 0 if ran else interval
+
+    def run_forever(self):
+        """Run jobs as they become due, logging metrics now and then."""
+        reported = time.monotonic()
+        while True:
+            wait = self.poll()
+            if wait:
+                time.sleep(wait)
+            if time.monotonic() - reported >= REPORT_INTERVAL:
+                self.app.logger.info('Jobs: %s', json.dumps(self.metrics()))
+                reported = time.monotonic()
+
+    def metrics(self):
+        """Return what this worker ran and the queue's current depth."""
+        latencies = sorted(self.latencies)
+        with self.app_context():
+            with db.engine.connect() as connection:
+                queue = queue_stats(connection)
+        return {
+            'succeeded': self.counts['succeeded'],
+            'errors': self.counts['errors'],
+            'latency_ms': {f'p{p}': round(percentile(latencies, p) * 1000, 1) for p in (50, 95, 99)},
+            'queue': queue,
+        }
@@ -1,9 +1,133 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SelectField, SubmitField, TextAreaField, BooleanField, IntegerField
-from wtforms.ext.sqlalchemy.fields import QuerySelectField, QuerySelectMultipleField
+from wtforms import Field, HiddenField, StringField, PasswordField, SelectField, SelectMultipleField, SubmitField, TextAreaField, BooleanField, IntegerField
 from wtforms.validators import DataRequired, Length, ValidationError
+from tracker_app import catalog_snapshot
 from tracker_app.models import Console, Game, Genre, User
 
+class ChoiceCache(object):
+    """A model's (id, name) choices, read from the catalog snapshot.
+
+    Kept until the snapshot is replaced, which commits changing the model's
+    rows cause in every process.
+    """
+
+    def __init__(self, model, kind):
+        self.model = model
+        self.kind = kind
+        self._cached = None
+
+    def get(self):
+        """Return the (id, name) choices and the set of valid ids."""
+        snapshot = catalog_snapshot.get()
+        cached = self._cached
+        if cached is None or cached[0] is not snapshot:
+            choices = snapshot.choices(self.kind)
+            cached = self._cached = (snapshot, choices, frozenset(id for id, _ in choices))
+        return cached[1:]
+
+    def invalidate(self):
+        self._cached = None
+
+console_choices = ChoiceCache(Console, 'console')
+genre_choices = ChoiceCache(Genre, 'genre')
+
+def coerce_id(value):
+    """Coerce a submitted value or a model instance to its id."""
+    return value.id if hasattr(value, 'id') else int(value)
+
+class CachedSelectField(SelectField):
+    """Select field for one id, with its choices read from a ChoiceCache.
+
+    Populates `<name>_id` on the object, e.g. a field named console sets
+    console_id.
+    """
+
+    def __init__(self, label=None, validators=None, cache=None, **kwargs):
+        super(CachedSelectField, self).__init__(label, validators, coerce=coerce_id, **kwargs)
+        self.cache = cache
+
+    def iter_choices(self):
+        choices, _ = self.cache.get()
+        for value, label in choices:
+            yield (value, label, value == self.data)
+
+    def pre_validate(self, form):
+        _, ids = self.cache.get()
+        if self.data not in ids:
+            raise ValueError(self.gettext('Not a valid choice'))
+
+    def populate_obj(self, obj, name):
+        setattr(obj, f'{name}_id', self.data)
+
+class CachedSelectMultipleField(SelectMultipleField):
+    """Select field for many ids, with its choices read from a ChoiceCache."""
+
+    def __init__(self, label=None, validators=None, cache=None, **kwargs):
+        super(CachedSelectMultipleField, self).__init__(label, validators, coerce=coerce_id, **kwargs)
+        self.cache = cache
+
+    def iter_choices(self):
+        choices, _ = self.cache.get()
+        selected = set(self.data or ())
+        for value, label in choices:
+            yield (value, label, value in selected)
+
+    def pre_validate(self, form):
+        _, ids = self.cache.get()
+        for value in self.data or ():
+            if value not in ids:
+                raise ValueError(self.gettext("'%(value)s' is not a valid choice for this field") % dict(value=value))
+
+    def selected_objects(self):
+        """Load the model instances for the selected ids."""
+        model = self.cache.model
+        if not self.data:
+            return []
+        return model.query.filter(model.id.in_(self.data)).all()
+
+    def populate_obj(self, obj, name):
+        setattr(obj, name, self.selected_objects())
+
+# Most ids one bulk collection edit takes. Each id is two parameters of the
+# INSERT, which keeps it under older SQLite builds' limit of 999
+MAX_COLLECTION_IDS = 400
+
+class IdListField(Field):
+    """Field for a list of ids, e.g. from checkboxes that share a name."""
+
+    def process_formdata(self, valuelist):
+        self.data = []
+        try:
+            self.data = [int(value) for value in valuelist]
+        except ValueError:
+            raise ValueError('Not a valid id')
+
+class VersionField(HiddenField):
+    """Hidden field for the version of the row a form edits.
+
+    Checked by the route, never copied onto the row.
+    """
+
+    def process_formdata(self, valuelist):
+        self.data = None
+        if valuelist and valuelist[0]:
+            try:
+                self.data = int(valuelist[0])
+            except ValueError:
+                raise ValueError('Not a valid version')
+
+    def populate_obj(self, obj, name):
+        pass
+
+class CollectionForm(FlaskForm):
+    """Form to add or remove many consoles or games at once."""
+    ids = IdListField('Items', validators=[
+        Length(min=1, max=MAX_COLLECTION_IDS,
+            message=f'Select between 1 and {MAX_COLLECTION_IDS} items.')])
+    next = HiddenField()
+    add = SubmitField('Add Selected To Collection')
+    remove = SubmitField('Remove Selected From Collection')
+
 class ConsoleForm(FlaskForm):
     """Form to create a console."""
     name = StringField('Console Name',
@@ -11,6 +135,7 @@ class ConsoleForm(FlaskForm):
     company = StringField('Company')
     portable = BooleanField('Portable?')
     console_notes = TextAreaField('Notes')
+    version = VersionField()
     submit = SubmitField('Submit')
 
 class GameForm(FlaskForm):
@@ -19,11 +144,10 @@ class GameForm(FlaskForm):
         validators=[DataRequired(), Length(min=3, max=80)])
     publisher = StringField('Publisher')
     personal_rating = IntegerField('Rating')
-    console = QuerySelectField('Console', 
-        query_factory=lambda: Console.query, allow_blank=False)
-    genres = QuerySelectMultipleField('Genres',
-        query_factory=lambda: Genre.query)
+    console = CachedSelectField('Console', cache=console_choices)
+    genres = CachedSelectMultipleField('Genres', cache=genre_choices)
     game_notes = TextAreaField('Notes')
+    version = VersionField()
     submit = SubmitField('Submit')
 
 class GenreForm(FlaskForm):
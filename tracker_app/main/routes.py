@@ -1,13 +1,21 @@
 """Import packages and modules."""
-from flask import Blueprint, request, render_template, redirect, url_for, flash
+from flask import Blueprint, request, render_template, redirect, url_for, flash, jsonify, abort
 from flask_login import login_user, logout_user, login_required, current_user
+from collections import Counter
 from datetime import date, datetime
-from tracker_app.models import Console, Game, Genre, User
-from tracker_app.main.forms import ConsoleForm, GameForm, GenreForm
+from sqlalchemy.orm.exc import StaleDataError
+from tracker_app.models import Console, Game, Genre, User, record_activity
+from tracker_app.main.forms import ConsoleForm, GameForm, GenreForm, CollectionForm
+from tracker_app.pagination import page_args, keyset_page
+from tracker_app.search import search
+from tracker_app.facets import Filters, browse
+from tracker_app import activity, exporter, recommendations, stats
+from tracker_app.fragments import PageValidators
+from tracker_app.ratelimit import by_user
 from tracker_app import bcrypt
 
-# Import app and db from events_app package so that we can run app
-from tracker_app import app, db
+# Import db from events_app package so that we can run app
+from tracker_app import db, fragment_cache, catalog_snapshot, rate_limiter
 
 main = Blueprint("main", __name__)
 
@@ -17,9 +25,119 @@ main = Blueprint("main", __name__)
 
 @main.route('/')
 def homepage():
-    all_consoles = Console.query.all()
-    print(all_consoles)
-    return render_template('home.html', all_consoles=all_consoles)
+    after, limit = page_args()
+    snapshot = catalog_snapshot.get()
+
+    def console_list():
+        return {'all_consoles': snapshot.consoles(after, limit)}
+
+    def render():
+        return render_template('home.html', console_list=fragment_cache.render(
+            snapshot.stamp, (after, limit), 'fragments/console_list.html', console_list))
+
+    return PageValidators(snapshot.stamp, after, limit).respond(render)
+
+def search_args():
+    """Read the ?q=<text>&score=<score>&after=<rowid> search arguments from
+    the request, where score and after are the cursor of the previous page."""
+    query = request.args.get('q', '').strip()
+    score = request.args.get('score', type=float)
+    after = request.args.get('after', type=int)
+    if score is None or after is None:
+        return query, None
+    return query, (score, after)
+
+@main.route('/search')
+def search_page():
+    query, after = search_args()
+    results, next_after, limited = search(query, after)
+    return render_template('search.html', query=query, first_page=after is None,
+        results=results, next_after=next_after, limited=limited)
+
+@main.route('/search.json')
+def search_json():
+    query, after = search_args()
+    results, next_after, limited = search(query, after)
+    next_url = None
+    if next_after:
+        score, rowid = next_after
+        next_url = url_for('main.search_json', q=query, score=score, after=rowid)
+    return jsonify(query=query, results=results, next=next_url, limited=limited)
+
+def browse_args():
+    """Read the browse filters from the request, e.g.
+    ?genre=1&genre=2&publisher=Sega&min_rating=8&portable=1. Picking
+    several values of a filter matches any of them."""
+    portable = request.args.get('portable', '')
+    return Filters(
+        console=request.args.getlist('console', type=int),
+        genre=request.args.getlist('genre', type=int),
+        publisher=[name for name in request.args.getlist('publisher') if name],
+        min_rating=request.args.get('min_rating', type=int),
+        max_rating=request.args.get('max_rating', type=int),
+        portable=portable.lower() in ('1', 'true', 'yes', 'on') if portable else None)
+
+def filter_args(filters):
+    """Return the query arguments of filters, the opposite of browse_args()."""
+    args = {'console': filters.console, 'genre': filters.genre, 'publisher': filters.publisher}
+    for name in ('min_rating', 'max_rating'):
+        if getattr(filters, name) is not None:
+            args[name] = getattr(filters, name)
+    if filters.portable is not None:
+        args['portable'] = int(filters.portable)
+    return args
+
+def toggled(filters, dimension, value):
+    """Return filters with a facet value picked, or unpicked if it was."""
+    if dimension == 'rating':
+        picked = filters.min_rating == filters.max_rating == value
+        return filters._replace(min_rating=None if picked else value, max_rating=None if picked else value)
+    if dimension == 'portable':
+        return filters._replace(portable=None if filters.portable == value else value)
+    values = list(getattr(filters, dimension))
+    if value in values:
+        values.remove(value)
+    else:
+        values.append(value)
+    return filters._replace(**{dimension: values})
+
+@main.route('/games')
+def browse_page():
+    filters = browse_args()
+    after, limit = page_args()
+    result = browse(catalog_snapshot.get(), filters, after, limit)
+
+    def toggle_url(dimension, value):
+        return url_for('main.browse_page', **filter_args(toggled(filters, dimension, value)))
+
+    filtered = any(value not in (None, []) for value in filters)
+    return render_template('browse.html', filters=filters, args=filter_args(filters),
+        filtered=filtered, result=result, limit=limit, toggle_url=toggle_url)
+
+@main.route('/games.json')
+def browse_json():
+    filters = browse_args()
+    after, limit = page_args()
+    result = browse(catalog_snapshot.get(), filters, after, limit)
+    return jsonify(
+        filters=filter_args(filters),
+        total=result.total,
+        results=[{
+            'id': game.id, 'title': game.title, 'publisher': game.publisher,
+            'personal_rating': game.personal_rating, 'console_id': game.console_id,
+            'genres': [genre.id for genre in game.genres],
+        } for game in result.games],
+        facets={dimension: [value._asdict() for value in values]
+                for dimension, values in result.facets.items()},
+        next_after=result.games.next_after)
+
+@main.route('/stats')
+def stats_page():
+    return render_template('stats.html',
+        most_owned_games=stats.most_owned_games(),
+        largest_libraries=stats.consoles_by(Console.game_count),
+        most_owned_consoles=stats.consoles_by(Console.owner_count),
+        genres=stats.genres_by_game_count())
 
 @main.route('/new_console', methods=['GET', 'POST'])
 @login_required
@@ -37,6 +155,9 @@ def new_console():
         )
         # Add console to database
         db.session.add(new_console)
+        # Flushed for its id
+        db.session.flush()
+        record_activity(current_user.id, 'create', 'console', [new_console.id])
         db.session.commit()
 
         # Flash success message, redirect to detail page
@@ -57,11 +178,14 @@ def new_game():
             publisher=form.publisher.data,
             personal_rating=form.personal_rating.data,
             game_notes=form.game_notes.data,
-            console=form.console.data,
-            genres=form.genres.data
+            console_id=form.console.data,
+            genres=form.genres.selected_objects()
         )
         # Add game to database
         db.session.add(new_game)
+        # Flushed for its id
+        db.session.flush()
+        record_activity(current_user.id, 'create', 'game', [new_game.id])
         db.session.commit()
 
         # Flash success message, redirect to detail page
@@ -82,6 +206,9 @@ def create_genre():
         )
         # Add genre to database
         db.session.add(new_genre)
+        # Flushed for its id
+        db.session.flush()
+        record_activity(current_user.id, 'create', 'genre', [new_genre.id])
         db.session.commit()
 
         # Flash success message, redirect to homepage
@@ -89,95 +216,274 @@ def create_genre():
         return redirect(url_for('main.homepage'))
     return render_template('create_genre.html', form=form)
 
-@main.route('/console/<console_id>', methods=['GET', 'POST'])
+# Flashed when an edit started from an older version of the row
+CONFLICT_MESSAGE = ('This {kind} was changed while you were editing it. The page now shows '
+    'the changes; submit the form again to save yours over them.')
+
+def save_edit(obj, form, user_id):
+    """Copy a user's edit form onto obj and commit, returning False on a conflict.
+
+    The edit conflicts if obj changed since the form was rendered: either
+    its version isn't the form's, or another edit commits first, which the
+    UPDATE's version check catches. Only changed columns are written.
+    """
+    if obj.version != form.version.data:
+        return False
+    # Populates the attributes of the passed obj with data from the form's fields.
+    # Loading the genres mustn't flush, which would bump the version already
+    with db.session.no_autoflush:
+        form.populate_obj(obj)
+    if db.session.is_modified(obj):
+        # Bumped here, as an UPDATE only bumps it when a column changed,
+        # not when only the genres did
+        obj.version = obj.version + 1
+        record_activity(user_id, 'edit', obj.__tablename__, [obj.id])
+    try:
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return False
+    return True
+
+def current_version(model, id):
+    return db.session.query(model.version).filter(model.id == id).scalar()
+
+@main.route('/console/<int:console_id>', methods=['GET', 'POST'])
 @login_required
 def console_detail(console_id):
-    console = Console.query.get(console_id)
+    # Read from the snapshot, and only loaded from the database to be edited
+    snapshot = catalog_snapshot.get()
+    console = snapshot.console(console_id)
+    if console is None:
+        abort(404)
     form = ConsoleForm(obj=console)
 
+    conflict = False
+
     # If form was submitted and was valid:
     if form.validate_on_submit():
-        # Populates the attributes of the passed obj with data from the form's fields
-        form.populate_obj(console)
-        db.session.add(console)
-        db.session.commit()
+        edited = Console.query.get_or_404(console_id)
+        if save_edit(edited, form, current_user.id):
+            flash('Console was edited!')
+            return redirect(url_for('main.console_detail', console_id=console_id))
+        conflict = True
+        flash(CONFLICT_MESSAGE.format(kind='console'))
+        form.version.data = current_version(Console, console_id)
+    after, limit = page_args()
+    owned = current_user.owns_console(console.id)
+
+    def details():
+        games = snapshot.console_games(console.id, after, limit)
+        return {'console': console, 'games': games}
+
+    # Posted to edit_collection_form, with the games checked in the list
+    collection_form = CollectionForm(formdata=None, next=request.full_path)
+
+    def render():
+        return render_template('console_detail.html',
+            console=console, owned=owned, form=form, collection_form=collection_form,
+            details=fragment_cache.render(snapshot.stamp, (console.id, after, limit),
+                'fragments/console_detail.html', details))
 
-        flash('Console was edited!')
-        return redirect(url_for('main.console_detail', console_id=console.id))
-    console = Console.query.get(console_id)
-    return render_template('console_detail.html', console=console, form=form)
+    response = PageValidators(snapshot.stamp, after, limit, owned).respond(render)
+    if conflict:
+        response.status_code = 409
+    return response
 
-@main.route('/game/<game_id>', methods=['GET', 'POST'])
+@main.route('/game/<int:game_id>', methods=['GET', 'POST'])
 @login_required
 def game_detail(game_id):
-    game = Game.query.get(game_id)
+    # Read from the snapshot, and only loaded from the database to be edited
+    snapshot = catalog_snapshot.get()
+    game = snapshot.game(game_id)
+    if game is None:
+        abort(404)
     form = GameForm(obj=game)
 
+    conflict = False
+
     # If form was submitted and was valid:
     if form.validate_on_submit():
-        # Populates the attributes of the passed obj with data from the form's fields
-        form.populate_obj(game)
-        db.session.add(game)
-        db.session.commit()
+        edited = Game.query.get_or_404(game_id)
+        if save_edit(edited, form, current_user.id):
+            flash('Game was edited!')
+            return redirect(url_for('main.game_detail', game_id=game_id))
+        conflict = True
+        flash(CONFLICT_MESSAGE.format(kind='game'))
+        form.version.data = current_version(Game, game_id)
+    owned = current_user.owns_game(game.id)
+    # Changes with every collection, so it's part of the ETag, not the cache
+    similar = recommendations.similar_games(game.id)
+
+    def render():
+        return render_template('game_detail.html',
+            game=game, owned=owned, form=form, similar=similar,
+            details=fragment_cache.render(snapshot.stamp, game.id,
+                'fragments/game_detail.html', lambda: {'game': game}))
 
-        flash('Game was edited!')
-        return redirect(url_for('main.game_detail', game_id=game.id))
-    game = Game.query.get(game_id)
-    return render_template('game_detail.html', game=game, form=form)
+    response = PageValidators(snapshot.stamp, owned, similar).respond(render)
+    if conflict:
+        response.status_code = 409
+    return response
 
 @main.route('/profile')
 @login_required
 def profile():
-    return render_template('profile.html')
+    # Each collection pages on its own cursor, e.g. ?games_after=<id>
+    consoles_after, consoles_limit = page_args('consoles_')
+    games_after, games_limit = page_args('games_')
+    consoles = keyset_page(
+        current_user.owned_consoles(), Console.id, consoles_after, consoles_limit)
+    games = keyset_page(
+        current_user.owned_games(), Game.id, games_after, games_limit)
+    collection_form = CollectionForm(formdata=None, next=request.full_path)
+    recommended = recommendations.recommended_games(current_user.id)
+
+    def more_url(**cursor):
+        """Link to the next page of one collection, keeping the other's page."""
+        return url_for('main.profile', **dict(request.args.to_dict(), **cursor))
+
+    return render_template('profile.html',
+        consoles=consoles, games=games, collection_form=collection_form,
+        recommended=recommended, more_url=more_url)
+
+def feed_args():
+    """Read the ?before=<id>&limit=N cursor of a feed, which pages back
+    from the newest event."""
+    _, limit = page_args()
+    return request.args.get('before', type=int), limit
+
+def feed_json(events):
+    return jsonify(
+        events=[dict(event._asdict(), when=event.when.isoformat()) for event in events],
+        next_before=events.next_after)
+
+@main.route('/activity')
+def activity_page():
+    before, limit = feed_args()
+    return render_template('activity.html', title='Activity',
+        events=activity.feed(before=before, limit=limit), trending=activity.trending())
+
+@main.route('/activity.json')
+def activity_json():
+    before, limit = feed_args()
+    return feed_json(activity.feed(before=before, limit=limit))
+
+@main.route('/profile/activity')
+@login_required
+def profile_activity():
+    before, limit = feed_args()
+    return render_template('activity.html', title='Your Activity',
+        events=activity.feed(current_user.id, before, limit))
+
+@main.route('/profile/activity.json')
+@login_required
+def profile_activity_json():
+    before, limit = feed_args()
+    return feed_json(activity.feed(current_user.id, before, limit))
+
+@main.route('/game/<int:game_id>/activity.json')
+def game_activity_json(game_id):
+    """How many users added and removed a game each day lately."""
+    days = max(1, min(request.args.get('days', 30, type=int), 365))
+    counts = activity.daily_counts('game', game_id, days)
+    return jsonify(game_id=game_id, days=days, counts={
+        action: [{'day': day.isoformat(), 'count': count} for day, count in rows]
+        for action, rows in counts.items()})
+
+@main.route('/export/collection.<any(csv, jsonl):format>')
+@login_required
+def export_collection(format):
+    rows = exporter.collection_rows(current_user.id)
+    return exporter.stream_response(rows, exporter.COLLECTION_FIELDS, format, 'collection')
 
-@main.route('/add_collection_console/<console_id>', methods=['POST'])
+@main.route('/add_collection_console/<int:console_id>', methods=['POST'])
 @login_required
+@rate_limiter.limit('collection', by_user)
 def add_collection_console(console_id):
-    console = Console.query.get(console_id)
-    if console in current_user.consoles_owned:
+    Console.query.get_or_404(console_id)
+    if not current_user.add_console(console_id):
         flash('Console already in collection.')
     else:
-        current_user.consoles_owned.append(console)
-        db.session.add(current_user)
         db.session.commit()
         flash('Console added to collection!')
     return redirect(url_for('main.console_detail', console_id=console_id))
 
-@main.route('/remove_collection_console/<console_id>', methods=['POST'])
+@main.route('/remove_collection_console/<int:console_id>', methods=['POST'])
 @login_required
+@rate_limiter.limit('collection', by_user)
 def remove_collection_console(console_id):
-    console = Console.query.get(console_id)
-    if console not in current_user.consoles_owned:
+    if not current_user.remove_console(console_id):
         flash('Console not in collection.')
     else:
-        current_user.consoles_owned.remove(console)
-        db.session.add(current_user)
         db.session.commit()
         flash('Console removed from collection!')
     return redirect(url_for('main.console_detail', console_id=console_id))
 
-@main.route('/add_collection_game/<game_id>', methods=['POST'])
+@main.route('/add_collection_game/<int:game_id>', methods=['POST'])
 @login_required
+@rate_limiter.limit('collection', by_user)
 def add_collection_game(game_id):
-    game = Game.query.get(game_id)
-    if game in current_user.games_owned:
+    Game.query.get_or_404(game_id)
+    if not current_user.add_game(game_id):
         flash('Game already in collection.')
     else:
-        current_user.games_owned.append(game)
-        db.session.add(current_user)
         db.session.commit()
         flash('Game added to collection!')
     return redirect(url_for('main.game_detail', game_id=game_id))
 
-@main.route('/remove_collection_game/<game_id>', methods=['POST'])
+@main.route('/remove_collection_game/<int:game_id>', methods=['POST'])
 @login_required
+@rate_limiter.limit('collection', by_user)
 def remove_collection_game(game_id):
-    game = Game.query.get(game_id)
-    if game not in current_user.games_owned:
+    if not current_user.remove_game(game_id):
         flash('Game not in collection.')
     else:
-        current_user.games_owned.remove(game)
-        db.session.add(current_user)
         db.session.commit()
         flash('Game removed from collection!')
-    return redirect(url_for('main.game_detail', game_id=game_id))
\ No newline at end of file
+    return redirect(url_for('main.game_detail', game_id=game_id))
+
+# Flashed after a bulk collection edit, for each outcome that happened
+OUTCOME_MESSAGES = {
+    'added': 'Added {count} {kind} to collection.',
+    'removed': 'Removed {count} {kind} from collection.',
+    'already_owned': '{count} already in collection.',
+    'not_owned': '{count} not in collection.',
+    'not_found': "{count} couldn't be found.",
+}
+
+def edit_collection(kind, add_ids, remove_ids):
+    """Add and remove many consoles or games, returning each id's outcome."""
+    outcomes = {}
+    if add_ids:
+        outcomes.update(getattr(current_user, f'add_{kind}')(add_ids))
+    if remove_ids:
+        outcomes.update(getattr(current_user, f'remove_{kind}')(remove_ids))
+    db.session.commit()
+    return outcomes
+
+def local_url(url):
+    """Return url if it's a path on this site, to only redirect within it."""
+    if url and url.startswith('/') and not url.startswith('//'):
+        return url
+    return None
+
+@main.route('/collection/<any(consoles, games):kind>', methods=['POST'])
+@login_required
+@rate_limiter.limit('collection', by_user)
+def edit_collection_form(kind):
+    form = CollectionForm()
+    if form.validate_on_submit():
+        ids = form.ids.data
+        if form.remove.data:
+            outcomes = edit_collection(kind, [], ids)
+        else:
+            outcomes = edit_collection(kind, ids, [])
+        counts = Counter(outcomes.values())
+        flash(' '.join(
+            message.format(count=counts[outcome], kind=kind)
+            for outcome, message in OUTCOME_MESSAGES.items() if counts[outcome]))
+    else:
+        for errors in form.errors.values():
+            flash(' '.join(errors))
+    return redirect(local_url(form.next.data) or url_for('main.profile'))
@@ -1,8 +1,14 @@
-import os
 import unittest
 
-from tracker_app import app, db, bcrypt
-from tracker_app.models import Console, Game, User
+from sqlalchemy import event
+
+from tracker_app import create_app, db, bcrypt, user_cache, fragment_cache, catalog_snapshot
+from tracker_app import jobs, search as search_module
+from tracker_app.snapshot import CatalogSnapshot
+from tracker_app.config import TestConfig
+from tracker_app.models import Console, Game, Genre, User, game_similarity_table
+from tracker_app.main.forms import ConsoleForm, console_choices, genre_choices
+from tracker_app.main.routes import save_edit
 
 """
 Run these tests with the command:
@@ -13,6 +19,8 @@ python -m unittest discover
 # Setup
 #################################################
 
+app = create_app(TestConfig)
+
 def login(client, username, password):
     return client.post('/login', data=dict(
         username=username,
@@ -38,6 +46,34 @@ def create_items():
     db.session.add(b2)
     db.session.commit()
 
+def create_consoles(count):
+    for i in range(count):
+        console = Console(name=f'Console {i}', portable=False)
+        db.session.add(Game(title=f'Game {i}', console=console))
+    db.session.commit()
+
+def run_jobs():
+    """Run the queued jobs, e.g. replacing the catalog snapshot after a change."""
+    worker = jobs.Worker(app)
+    while worker.run_once():
+        pass
+
+def count_statements(func, containing=''):
+    """Return how many SQL statements, optionally only those containing
+    some text, were executed while calling func."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if containing in statement:
+            statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        func()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return len(statements)
+
 def create_user():
     password_hash = bcrypt.generate_password_hash('password').decode('utf-8')
     user = User(username='username', password=password_hash)
@@ -52,13 +88,18 @@ class MainTests(unittest.TestCase):
  
     def setUp(self):
         """Executed prior to each test."""
-        app.config['TESTING'] = True
         app.config['WTF_CSRF_ENABLED'] = False
-        app.config['DEBUG'] = False
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
         self.app = app.test_client()
+        db.session.remove()
         db.drop_all()
         db.create_all()
+        user_cache.clear()
+        fragment_cache.clear()
+        console_choices.invalidate()
+        genre_choices.invalidate()
 
     def test_homepage_logged_out(self):
         """Test that everything that should show up on the homepage does."""
@@ -111,6 +152,160 @@ class MainTests(unittest.TestCase):
         self.assertNotIn('Log In', response_text)
         self.assertNotIn('Sign Up', response_text)
 
+    def test_homepage_game_counts(self):
+        """Test that each console shows how many games it has."""
+        create_items()
+        db.session.add(Game(title='Melee', console=Console.query.get(1)))
+        db.session.add(Console(name='Wii', portable=False))
+        db.session.commit()
+
+        response = self.app.get('/', follow_redirects=True)
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Gamecube</a> - \n    2 games', response_text)
+        self.assertIn('Samsung S10</a> - \n    1 games', response_text)
+        self.assertIn('Wii</a> - \n    0 games', response_text)
+
+    def test_homepage_query_count(self):
+        """Test that the homepage query count doesn't grow with the consoles."""
+        create_items()
+        run_jobs()
+        few = count_statements(lambda: self.app.get('/'))
+
+        create_consoles(50)
+        run_jobs()
+        many = count_statements(lambda: self.app.get('/'))
+        self.assertEqual(few, many)
+
+    def test_homepage_pagination(self):
+        """Test that the homepage pages through consoles by id."""
+        create_consoles(5)
+
+        response = self.app.get('/?limit=2')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Console 0', response_text)
+        self.assertIn('Console 1', response_text)
+        self.assertNotIn('Console 2', response_text)
+        self.assertIn('/?after=2&amp;limit=2', response_text)
+
+        response = self.app.get('/?after=2&limit=2')
+        response_text = response.get_data(as_text=True)
+        self.assertNotIn('Console 1', response_text)
+        self.assertIn('Console 2', response_text)
+        self.assertIn('Console 3', response_text)
+
+    def test_homepage_fragment_cached(self):
+        """Test that the console list is cached until the catalog changes."""
+        create_items()
+        self.app.get('/')
+        self.assertEqual(count_statements(lambda: self.app.get('/')), 0)
+
+        console = Console.query.get(1)
+        console.name = 'Wii'
+        db.session.commit()
+        # Until the job replaces the snapshot, the cached list is served
+        self.assertNotIn('Wii', self.app.get('/').get_data(as_text=True))
+        run_jobs()
+        response_text = self.app.get('/').get_data(as_text=True)
+        self.assertIn('Wii', response_text)
+        self.assertNotIn('Gamecube', response_text)
+
+    def test_homepage_not_modified(self):
+        """Test that repeat views with a current ETag get a 304."""
+        create_items()
+        response = self.app.get('/')
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+
+        response = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        db.session.add(Console(name='Wii', portable=False))
+        db.session.commit()
+        run_jobs()
+        response = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Wii', response.get_data(as_text=True))
+
+    def test_homepage_follows_other_workers(self):
+        """Test that cached pages follow changes committed by another process."""
+        create_items()
+        response = self.app.get('/')
+        etag = response.headers['ETag']
+
+        # Another process's commit doesn't go through this process's session,
+        # but its job replaces the shared snapshot file
+        db.engine.execute(Console.__table__.update().where(Console.id == 1).values(name='Wii'))
+        other = CatalogSnapshot()
+        other.path = catalog_snapshot.path
+        other.rebuild()
+        response = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Wii', response.get_data(as_text=True))
+
+    def test_game_detail_fragment_invalidated(self):
+        """Test that game pages follow edits and their owner's collection."""
+        create_items()
+        create_user()
+        login(self.app, 'username', 'password')
+        response = self.app.get('/game/1')
+        etag = response.headers['ETag']
+        self.assertIn('Add To Collection', response.get_data(as_text=True))
+
+        # Collection buttons aren't cached with the game's details
+        self.app.post('/add_collection_game/1', follow_redirects=True)
+        response = self.app.get('/game/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Remove From Collection', response.get_data(as_text=True))
+
+        game = Game.query.get(1)
+        game.genres.append(Genre(name='Sports'))
+        db.session.commit()
+        run_jobs()
+        self.assertIn('Sports,', self.app.get('/game/1').get_data(as_text=True))
+
+        # Moving the game takes it off its old console's page
+        self.assertIn('NBA 2K3', self.app.get('/console/1').get_data(as_text=True))
+        game = Game.query.get(1)
+        game.console_id = 2
+        db.session.commit()
+        run_jobs()
+        self.assertNotIn('NBA 2K3', self.app.get('/console/1').get_data(as_text=True))
+        self.assertIn('NBA 2K3', self.app.get('/console/2').get_data(as_text=True))
+
+    def test_profile_pagination(self):
+        """Test that the profile pages through the user's games."""
+        create_consoles(3)
+        create_user()
+        user = User.query.filter_by(username='username').one()
+        for game in Game.query.all():
+            user.games_owned.append(game)
+        db.session.commit()
+        login(self.app, 'username', 'password')
+
+        response = self.app.get('/profile?games_limit=2')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Game 1', response_text)
+        self.assertNotIn('Game 2', response_text)
+        self.assertIn('More Games', response_text)
+
+        response = self.app.get('/profile?games_after=2&games_limit=2')
+        response_text = response.get_data(as_text=True)
+        self.assertNotIn('Game 1', response_text)
+        self.assertIn('Game 2', response_text)
+        self.assertNotIn('More Games', response_text)
+
+        # - Paging one collection keeps the other's page
+        for console in Console.query.all():
+            user.add_console(console.id)
+        db.session.commit()
+        response = self.app.get('/profile?games_after=1&games_limit=1&consoles_limit=1')
+        response_text = response.get_data(as_text=True)
+        self.assertIn(
+            'href="/profile?games_after=1&amp;games_limit=1&amp;consoles_limit=1&amp;consoles_after=1"',
+            response_text)
+        self.assertIn(
+            'href="/profile?games_after=2&amp;games_limit=1&amp;consoles_limit=1"', response_text)
+
     def test_console_detail(self):
         """Test that everything that should show up on the homepage does."""
         # Set up
@@ -146,6 +341,27 @@ class MainTests(unittest.TestCase):
         self.assertEqual(game.title, 'NBA 2K3')
         self.assertEqual(game.console, Console.query.get(1))
 
+    def test_similar_and_recommended_games(self):
+        # - Create two games, the second similar to the first
+        create_items()
+        create_user()
+        db.engine.execute(game_similarity_table.insert(),
+            {'game_id': 1, 'similar_id': 2, 'co_owners': 3, 'score': 0.5})
+        login(self.app, 'username', 'password')
+
+        # - Check the first game's page lists the second
+        response_text = self.app.get('/game/1').get_data(as_text=True)
+        self.assertIn('Owners of this game also own', response_text)
+        self.assertIn('Dynamix</a> (3 owners)', response_text)
+
+        # - Add the first game and check the second is recommended once the
+        #   job updating recommendations has run
+        self.app.post('/add_collection_game/1')
+        jobs.Worker(app).run_once()
+        response_text = self.app.get('/profile').get_data(as_text=True)
+        self.assertIn('Recommended for username', response_text)
+        self.assertIn('<a href="/game/2">Dynamix</a>', response_text)
+
     def test_create_console(self):
         # Set up
         create_items()
@@ -186,4 +402,328 @@ class MainTests(unittest.TestCase):
         created_game = Game.query.filter_by(title='Kirbys Epic Yarn').one()
         self.assertIsNotNone(created_game)
         self.assertEqual(created_game.publisher, 'Nintendo')
-        self.assertEqual(created_game.console.name, 'Gamecube')
\ No newline at end of file
+        self.assertEqual(created_game.console.name, 'Gamecube')
+
+    def test_create_game_with_genres(self):
+        # Set up
+        create_items()
+        create_user()
+        db.session.add_all([Genre(name='Sports'), Genre(name='Rhythm')])
+        db.session.commit()
+        login(self.app, 'username', 'password')
+
+        post_data = {
+            'title': 'NBA Jam',
+            'console': 1,
+            'genres': [1, 2]
+        }
+        self.app.post('/new_game', data=post_data)
+
+        created_game = Game.query.filter_by(title='NBA Jam').one()
+        self.assertEqual(created_game.console.name, 'Gamecube')
+        self.assertEqual(sorted(genre.name for genre in created_game.genres), ['Rhythm', 'Sports'])
+
+    def test_create_game_unknown_console(self):
+        # Set up
+        create_items()
+        create_user()
+        login(self.app, 'username', 'password')
+
+        response = self.app.post('/new_game', data={'title': 'Missing', 'console': 99})
+        self.assertIn('Not a valid choice', response.get_data(as_text=True))
+        self.assertIsNone(Game.query.filter_by(title='Missing').first())
+
+    def test_game_choices_cached(self):
+        # Set up
+        create_items()
+        create_user()
+        login(self.app, 'username', 'password')
+
+        # The choices are read from the catalog snapshot, built by the
+        # homepage after logging in, so rendering the form doesn't query them
+        render = lambda: self.app.get('/new_game')
+        self.assertEqual(count_statements(render, 'FROM console'), 0)
+        self.assertEqual(count_statements(render, 'FROM genre'), 0)
+
+        # Creating a console refreshes the choices
+        self.app.post('/new_console', data={'name': 'Dreamcast'})
+        run_jobs()
+        response = self.app.get('/new_game')
+        self.assertIn('Dreamcast', response.get_data(as_text=True))
+
+    def test_add_remove_collection_game(self):
+        # Set up
+        create_items()
+        create_user()
+        login(self.app, 'username', 'password')
+        user = lambda: User.query.filter_by(username='username').one()
+
+        # Add the game, then try to add it a second time
+        self.app.post('/add_collection_game/1')
+        self.assertTrue(user().owns_game(1))
+        response = self.app.post('/add_collection_game/1', follow_redirects=True)
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Game already in collection.', response_text)
+        self.assertIn('Remove From Collection', response_text)
+        self.assertEqual(user().games_owned.count(), 1)
+
+        # Remove the game, then try to remove it a second time
+        self.app.post('/remove_collection_game/1')
+        self.assertFalse(user().owns_game(1))
+        response = self.app.post('/remove_collection_game/1', follow_redirects=True)
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Game not in collection.', response_text)
+        self.assertIn('Add To Collection', response_text)
+
+    def test_add_collection_console(self):
+        # Set up
+        create_items()
+        create_user()
+        login(self.app, 'username', 'password')
+        user = lambda: User.query.filter_by(username='username').one()
+
+        response = self.app.post('/add_collection_console/2', follow_redirects=True)
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Console added to collection!', response_text)
+        self.assertTrue(user().owns_console(2))
+        self.assertFalse(user().owns_console(1))
+
+        # Unknown consoles can't be added
+        response = self.app.post('/add_collection_console/99')
+        self.assertEqual(response.status_code, 404)
+
+    def test_edit_collection_form(self):
+        create_consoles(3)
+        create_user()
+        login(self.app, 'username', 'password')
+        user = lambda: User.query.filter_by(username='username').one()
+
+        response = self.app.post('/collection/games', data={
+            'ids': ['1', '3', '99'], 'add': 'Add', 'next': '/console/1'})
+        self.assertTrue(response.location.endswith('/console/1'))
+        self.assertEqual(sorted(game.id for game in user().games_owned), [1, 3])
+        self.assertEqual(Game.query.get(3).owner_count, 1)
+
+        response = self.app.post('/collection/games', data={
+            'ids': ['1', '2'], 'remove': 'Remove'}, follow_redirects=True)
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Removed 1 games from collection. 1 not in collection.', response_text)
+        self.assertEqual([game.id for game in user().games_owned], [3])
+
+        # Nothing selected, and redirects off the site are ignored
+        response = self.app.post('/collection/consoles', data={
+            'add': 'Add', 'next': 'https://example.com/'})
+        self.assertTrue(response.location.endswith('/profile'))
+
+    def test_stats(self):
+        create_items()
+        create_user()
+        login(self.app, 'username', 'password')
+        self.app.post('/add_collection_game/2')
+        self.app.post('/add_collection_console/2')
+
+        response_text = self.app.get('/stats').get_data(as_text=True)
+        self.assertIn('Dynamix</a> - owned by 1', response_text)
+        self.assertNotIn('NBA 2K3</a> - owned by', response_text)
+        self.assertIn('Gamecube</a> - 1 games', response_text)
+        self.assertIn('Samsung S10</a> - owned by 1', response_text)
+
+    def test_search(self):
+        # Set up
+        create_items()
+        db.session.add(Game(title='NBA Street', publisher='EA Sports', console_id=2))
+        db.session.commit()
+
+        # Words match by prefix and in any indexed column
+        response = self.app.get('/search?q=nba')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('NBA 2K3', response_text)
+        self.assertIn('NBA Street', response_text)
+        self.assertNotIn('Dynamix', response_text)
+
+        response = self.app.get('/search.json?q=game')
+        self.assertEqual(response.json['results'], [
+            {'type': 'console', 'id': 1, 'name': 'Gamecube', 'maker': None}])
+
+        # Punctuation is ignored rather than treated as search syntax
+        response = self.app.get('/search.json?q=ea+"sports')
+        self.assertEqual([r['name'] for r in response.json['results']], ['NBA Street'])
+
+    def test_edit_game_checks_version(self):
+        # Set up
+        create_items()
+        create_user()
+        login(self.app, 'username', 'password')
+        game = lambda: db.session.query(Game.title, Game.version).filter(Game.id == 1).one()
+
+        # - The form carries the version it was rendered from
+        response_text = self.app.get('/game/1').get_data(as_text=True)
+        self.assertIn('name="version" type="hidden" value="1"', response_text)
+
+        post_data = {'title': 'NBA 2K4', 'console': 1, 'version': 1}
+        response = self.app.post('/game/1', data=post_data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(tuple(game()), ('NBA 2K4', 2))
+
+        # - An edit from the old version conflicts and shows the new one
+        post_data = {'title': 'NBA 2K5', 'console': 1, 'version': 1}
+        response = self.app.post('/game/1', data=post_data)
+        response_text = response.get_data(as_text=True)
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('changed while you were editing', response_text)
+        self.assertIn('name="version" type="hidden" value="2"', response_text)
+        self.assertEqual(tuple(game()), ('NBA 2K4', 2))
+
+        # - Submitting nothing new writes nothing
+        post_data = {'title': 'NBA 2K4', 'console': 1, 'version': 2}
+        update = lambda: self.app.post('/game/1', data=post_data)
+        self.assertEqual(count_statements(update, 'UPDATE game'), 0)
+        self.assertEqual(tuple(game()), ('NBA 2K4', 2))
+
+    def test_edit_conflicts_with_concurrent_edit(self):
+        # Set up
+        create_items()
+        create_user()
+        console = Console.query.get(1)
+        form = ConsoleForm(formdata=None, obj=console)
+        form.name.data = 'Nintendo Gamecube'
+        # - Another edit commits after the console was loaded
+        db.engine.execute(Console.__table__.update().values(name='GCN', version=2))
+
+        self.assertFalse(save_edit(console, form, 1))
+        self.assertEqual(Console.query.get(1).name, 'GCN')
+
+    def test_browse_games(self):
+        # Set up
+        create_items()
+        Game.query.get(1).publisher = '2K'
+        Game.query.get(1).personal_rating = 8
+        db.session.add(Game(title='Tetris', console_id=2, publisher='Nintendo', personal_rating=9))
+        db.session.commit()
+
+        response = self.app.get('/games.json?portable=1&min_rating=8')
+        self.assertEqual(response.json['total'], 1)
+        self.assertEqual([game['title'] for game in response.json['results']], ['Tetris'])
+        # - Counts leave out their own filter, but apply the others
+        portable = {value['label']: value['count'] for value in response.json['facets']['portable']}
+        self.assertEqual(portable, {'Portable': 1, 'Home': 1})
+        publishers = [(value['value'], value['count']) for value in response.json['facets']['publisher']]
+        self.assertEqual(publishers, [('Nintendo', 1)])
+
+        # - Consoles picked are ORed
+        response = self.app.get('/games.json?console=1&console=2&limit=2')
+        self.assertEqual(response.json['total'], 3)
+        self.assertIsNotNone(response.json['next_after'])
+        response = self.app.get(f'/games.json?console=1&console=2&after={response.json["next_after"]}')
+        self.assertEqual([game['title'] for game in response.json['results']], ['Tetris'])
+
+        response_text = self.app.get('/games?publisher=2K').get_data(as_text=True)
+        self.assertIn('NBA 2K3', response_text)
+        self.assertNotIn('Tetris', response_text)
+        # - Facet links add to the filters
+        self.assertIn('href="/games?console=1&amp;publisher=2K"', response_text)
+
+    def test_activity_feeds(self):
+        # Set up
+        create_items()
+        create_user()
+        login(self.app, 'username', 'password')
+
+        self.app.post('/new_genre', data={'name': 'Sports'})
+        self.app.post('/console/1', data={'name': 'Nintendo Gamecube', 'version': 1})
+        self.app.post('/add_collection_game/1')
+        self.app.post('/collection/games', data={'ids': [1, 2]})
+        run_jobs()
+
+        response = self.app.get('/activity.json')
+        events = [(event['action'], event['item'], event['name']) for event in response.json['events']]
+        self.assertEqual(events, [
+            ('add', 'game', 'Dynamix'), ('add', 'game', 'NBA 2K3'),
+            ('edit', 'console', 'Nintendo Gamecube'), ('create', 'genre', 'Sports')])
+        self.assertEqual(response.json['events'][0]['username'], 'username')
+
+        response = self.app.get('/profile/activity.json?limit=1')
+        self.assertEqual(len(response.json['events']), 1)
+        response = self.app.get(f'/profile/activity.json?before={response.json["next_before"]}')
+        self.assertEqual(len(response.json['events']), 3)
+
+        response_text = self.app.get('/activity').get_data(as_text=True)
+        self.assertIn('Most Added This Week', response_text)
+        self.assertIn('<a href="/console/1">Nintendo Gamecube</a>', response_text)
+
+        response = self.app.get('/game/1/activity.json')
+        self.assertEqual([count['count'] for count in response.json['counts']['add']], [1])
+
+    def test_search_follows_edits(self):
+        # Set up
+        create_items()
+        create_user()
+        login(self.app, 'username', 'password')
+
+        post_data = {'name': 'Nintendo Gamecube', 'console_notes': 'Purple', 'version': 1}
+        self.app.post('/console/1', data=post_data)
+        response = self.app.get('/search.json?q=purple')
+        self.assertEqual(response.json['results'][0]['name'], 'Nintendo Gamecube')
+
+        db.session.delete(Game.query.get(2))
+        db.session.commit()
+        response = self.app.get('/search.json?q=dynamix')
+        self.assertEqual(response.json['results'], [])
+
+    def test_search_pagination(self):
+        create_consoles(25)
+
+        # Equally ranked consoles page newest first, each exactly once
+        response = self.app.get('/search.json?q=console')
+        self.assertEqual([r['id'] for r in response.json['results']], list(range(25, 5, -1)))
+        self.assertIsNotNone(response.json['next'])
+
+        response = self.app.get(response.json['next'])
+        self.assertEqual([r['id'] for r in response.json['results']], list(range(5, 0, -1)))
+        self.assertIsNone(response.json['next'])
+
+        response_text = self.app.get('/search?q=console').get_data(as_text=True)
+        self.assertIn('Next Page', response_text)
+        self.assertNotIn('First Page', response_text)
+
+    def test_search_ranks_newest_matches(self):
+        # A match in the name ranks above matches in the notes, even when
+        # it is the oldest of many matches
+        db.session.add(Console(name='Zelda Console', portable=False))
+        for i in range(30):
+            db.session.add(Console(name=f'Console {i}', console_notes='zelda', portable=False))
+        db.session.commit()
+
+        response = self.app.get('/search.json?q=zelda')
+        self.assertEqual(response.json['results'][0]['name'], 'Zelda Console')
+        self.assertFalse(response.json['limited'])
+
+        # Past RANK_LIMIT matches only the newest are ranked, and the page says so
+        self.addCleanup(setattr, search_module, 'RANK_LIMIT', search_module.RANK_LIMIT)
+        search_module.RANK_LIMIT = 10
+        response = self.app.get('/search.json?q=zelda')
+        self.assertEqual([r['id'] for r in response.json['results']], list(range(31, 21, -1)))
+        self.assertIsNone(response.json['next'])
+        self.assertTrue(response.json['limited'])
+        self.assertIn('too many', self.app.get('/search?q=zelda').get_data(as_text=True))
+
+    def test_export_collection(self):
+        # Set up
+        create_items()
+        create_user()
+        login(self.app, 'username', 'password')
+        self.app.post('/add_collection_console/2')
+        self.app.post('/add_collection_game/1')
+
+        response = self.app.get('/export/collection.csv')
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.get_data(as_text=True).splitlines(), [
+            'type,id,name,maker,console,portable,personal_rating',
+            'console,2,Samsung S10,,,true,',
+            'game,1,NBA 2K3,,Gamecube,,',
+        ])
+
+        response = self.app.get('/export/collection.jsonl')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('"name": "NBA 2K3"', lines[1])
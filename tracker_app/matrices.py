@@ -0,0 +1,113 @@
+"""Sparse matrix helpers for tracker_app.recommendations.rebuild().
+
+Needs NumPy and SciPy, so it's only imported when rebuilding.
+"""
+import itertools
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+
+def load(connection, row_column, column_column, shape, batch_size):
+    """Return a CSR matrix with a 1 at each (row, column) pair in a table."""
+    result = connection.execution_options(stream_results=True) \
+        .execute(select([row_column, column_column]))
+    chunks = []
+    for rows in iter(lambda: result.fetchmany(batch_size), []):
+        chunks.append(np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64))
+    pairs = np.concatenate(chunks).reshape(-1, 2) if chunks else np.zeros((0, 2), dtype=np.int64)
+    values = np.ones(len(pairs), dtype=np.float32)
+    return sparse.csr_matrix((values, (pairs[:, 0], pairs[:, 1])), shape=shape)
+
+def column_sums(matrix):
+    return np.asarray(matrix.sum(axis=0)).ravel()
+
+def row_sums(matrix):
+    return np.asarray(matrix.sum(axis=1)).ravel()
+
+def inverse_sqrt(counts):
+    """Return 1 / sqrt(count) of each count, or 0 for counts of 0."""
+    norms = np.zeros(len(counts), dtype=np.float32)
+    nonzero = counts > 0
+    norms[nonzero] = 1 / np.sqrt(counts[nonzero])
+    return norms
+
+def top_rows_by_column(matrix, weights, limit):
+    """Return the rows with the largest weights among each column's values."""
+    by_column = matrix.tocsc()
+    found = [np.zeros(0, dtype=np.int64)]
+    for column in range(by_column.shape[1]):
+        rows = by_column.indices[by_column.indptr[column]:by_column.indptr[column + 1]]
+        if len(rows) > limit:
+            rows = rows[np.argpartition(-weights[rows], limit)[:limit]]
+        found.append(rows)
+    return np.unique(np.concatenate(found))
+
+def row_ids(matrix):
+    """Return the row of each stored value of a CSR matrix."""
+    return np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+
+def row_counts(matrix):
+    """Return how many values each row of a CSR matrix stores."""
+    return np.diff(matrix.indptr)
+
+def remap_columns(matrix, columns, width):
+    """Return a CSR matrix whose column i is matrix's column columns[i]."""
+    return sparse.csr_matrix((matrix.data, columns[matrix.indices], matrix.indptr),
+        shape=(matrix.shape[0], width))
+
+def keep_rows(matrix, keep):
+    """Return a CSR matrix with only the rows where keep is true."""
+    return sparse.diags(keep.astype(np.float32)) @ matrix
+
+def without_diagonal(matrix, start):
+    """Drop the values of a block of rows, starting at row start, on the diagonal."""
+    matrix = matrix.tocsr()
+    matrix.data[matrix.indices == row_ids(matrix) + start] = 0
+    matrix.eliminate_zeros()
+    return matrix
+
+def scale(matrix, row_weights, column_weights):
+    """Return matrix with each value multiplied by its row's and column's weight."""
+    matrix = matrix.tocsr().astype(np.float32)
+    matrix.data *= row_weights[row_ids(matrix)] * column_weights[matrix.indices]
+    return matrix
+
+def without(matrix, mask):
+    """Drop the values where mask, a matrix of the same shape, has one."""
+    matrix = (matrix - matrix.multiply(mask)).tocsr()
+    matrix.eliminate_zeros()
+    return matrix
+
+def top_k(matrix, k):
+    """Return the (rows, columns, values) of the k largest values of each row.
+
+    Ties go to the lowest column.
+    """
+    matrix = matrix.tocsr()
+    matrix.sum_duplicates()
+    rows = row_ids(matrix)
+    if not len(rows):
+        return rows, matrix.indices, matrix.data
+    # Sorts by row, then by value descending. Each row's columns are already
+    # in order, and a stable sort keeps ties that way
+    values = matrix.data.astype(np.float64)
+    spread = values.max() - values.min()
+    key = rows - (values - values.min()) / (spread * 2 if spread else 1)
+    order = np.argsort(key, kind='stable')
+    rank = np.arange(len(order)) - matrix.indptr[rows]
+    keep = order[rank < k]
+    return rows[keep], matrix.indices[keep], matrix.data[keep]
+
+def lookup(matrix, rows, columns):
+    """Return matrix's values at each (row, column)."""
+    if not len(rows):
+        return np.zeros(0, dtype=matrix.dtype)
+    return np.asarray(matrix[rows, columns]).ravel()
+
+def from_rows(rows, columns, values, shape):
+    return sparse.csr_matrix((values, (rows, columns)), shape=shape)
+
+def stack(blocks, shape):
+    """Return the CSR matrix made of blocks of rows, one under the other."""
+    return sparse.vstack(blocks).tocsr() if blocks else sparse.csr_matrix(shape, dtype=np.float32)
@@ -0,0 +1,97 @@
+"""Upgrade database files created by older versions of the models.
+
+db.create_all() only creates missing tables, so changes to existing tables
+are applied here instead. Every step checks the schema before changing it,
+so upgrading an up to date database does nothing.
+"""
+from sqlalchemy import inspect
+from tracker_app import db
+from tracker_app.models import (game_genre_table, consoles_owned_table, games_owned_table,
+    game_similarity_table, user_recommendation_table, job_table, activity_event_table,
+    activity_rollup_table)
+from tracker_app.search import create_search_index
+from tracker_app import stats
+
+def add_association_primary_keys(connection):
+    """Rebuild association tables that have no primary key, dropping duplicate rows."""
+    inspector = inspect(connection)
+    for table in (game_genre_table, consoles_owned_table, games_owned_table):
+        if inspector.get_pk_constraint(table.name)['constrained_columns']:
+            continue
+        old_name = f'{table.name}_old'
+        columns = ', '.join(column.name for column in table.columns)
+        not_null = ' AND '.join(f'{column.name} IS NOT NULL' for column in table.columns)
+
+        connection.execute(f'ALTER TABLE {table.name} RENAME TO {old_name}')
+        table.create(connection)
+        connection.execute(
+            f'INSERT INTO {table.name} ({columns}) '
+            f'SELECT DISTINCT {columns} FROM {old_name} WHERE {not_null}')
+        connection.execute(f'DROP TABLE {old_name}')
+
+def create_missing_indexes(connection):
+    """Create any index declared on the models that the database lacks,
+    on the tables it has."""
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+
+def add_counter_columns(connection):
+    """Add the stats counter columns, filling them in from the tables they count."""
+    inspector = inspect(connection)
+    added = False
+    for column in (stats.CONSOLE_GAMES, stats.CONSOLE_OWNERS, stats.GAME_OWNERS, stats.GENRE_GAMES):
+        existing = {column['name'] for column in inspector.get_columns(column.table.name)}
+        if column.name not in existing:
+            connection.execute(
+                f'ALTER TABLE {column.table.name} '
+                f'ADD COLUMN {column.name} INTEGER NOT NULL DEFAULT 0')
+            added = True
+    if added:
+        stats.rebuild(connection)
+
+def create_recommendation_tables(connection):
+    """Create the tables tracker_app.recommendations fills in."""
+    for table in (game_similarity_table, user_recommendation_table):
+        table.create(connection, checkfirst=True)
+
+def create_job_table(connection):
+    """Create the queue of tracker_app.jobs."""
+    job_table.create(connection, checkfirst=True)
+
+def add_version_columns(connection):
+    """Add the version columns edits of consoles and games check."""
+    inspector = inspect(connection)
+    for table in ('console', 'game'):
+        if 'version' not in {column['name'] for column in inspector.get_columns(table)}:
+            connection.execute(f'ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+
+def create_activity_tables(connection):
+    """Create the event log and rollups of tracker_app.activity."""
+    activity_event_table.create(connection, checkfirst=True)
+    activity_rollup_table.create(connection, checkfirst=True)
+
+# Steps run in order, add new ones before create_missing_indexes, which
+# indexes the columns and tables the others add
+STEPS = [
+    add_association_primary_keys,
+    create_search_index,
+    add_counter_columns,
+    create_recommendation_tables,
+    create_job_table,
+    add_version_columns,
+    create_activity_tables,
+    create_missing_indexes,
+]
+
+def upgrade(engine):
+    """Bring an existing database up to date with the models."""
+    with engine.begin() as connection:
+        for step in STEPS:
+            step(connection)
@@ -1,21 +1,32 @@
 """Create database models to represent tables."""
 from tracker_app import db
+from sqlalchemy import and_, exists, text
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import backref
 from flask_login import UserMixin
 
 class Console(db.Model):
     """Console model."""
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(80), nullable=False)
+    name = db.Column(db.String(80), nullable=False, index=True)
     company = db.Column(db.String(80))
     portable = db.Column(db.Boolean, nullable=False)
     console_notes = db.Column(db.String(200))
 
+    # Counters kept up to date by tracker_app.stats
+    game_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    owner_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Bumped by each edit, which only succeeds if it started from the current
+    # version; see tracker_app.main.routes.save_edit
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
+
     # The games - What games exist on this console?
-    games = db.relationship('Game', back_populates='console')
+    games = db.relationship('Game', back_populates='console', lazy='dynamic')
 
     # Who owns this console?
-    users_who_own = db.relationship('User', secondary='user_console', back_populates='consoles_owned')
+    users_who_own = db.relationship('User', secondary='user_console', back_populates='consoles_owned', lazy='dynamic')
 
     def __str__(self):
         return f'<Console: {self.name}>'
@@ -26,20 +37,27 @@ class Console(db.Model):
 class Game(db.Model):
     """Game model."""
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(80), nullable=False)
+    title = db.Column(db.String(80), nullable=False, index=True)
     publisher = db.Column(db.String(80))
     personal_rating = db.Column(db.Integer)
     game_notes = db.Column(db.String(200))
 
+    # Counter kept up to date by tracker_app.stats, indexed for the most owned games
+    owner_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
+
+    # Bumped by each edit, like Console.version
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
+
     # The console - Which console do users play this game on?
-    console_id = db.Column(db.Integer, db.ForeignKey('console.id'), nullable=False)
+    console_id = db.Column(db.Integer, db.ForeignKey('console.id'), nullable=False, index=True)
     console = db.relationship('Console', back_populates='games')
 
     # The genres, e.g. first-person shooter (FPS), role-playing game (RPG), sandbox
     genres = db.relationship('Genre', secondary='game_genre', back_populates='games')
 
     # Who owns this game?
-    users_who_own = db.relationship('User', secondary='user_game', back_populates='games_owned')
+    users_who_own = db.relationship('User', secondary='user_game', back_populates='games_owned', lazy='dynamic')
 
     def __str__(self):
         return f'<Game: {self.name}>'
@@ -52,8 +70,11 @@ class Genre(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False, unique=True)
 
+    # Counter kept up to date by tracker_app.stats
+    game_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     # The games - what games have these genres?
-    games = db.relationship('Game', secondary='game_genre', back_populates='genres')
+    games = db.relationship('Game', secondary='game_genre', back_populates='genres', lazy='dynamic')
 
     def __str__(self):
         return f'<Genre: {self.name}>'
@@ -62,27 +83,307 @@ class Genre(db.Model):
         return f'<Genre: {self.name}>'
 
 # Game <--> Genre table
+# The primary key answers "what genres does game X have", the index the reverse
 game_genre_table = db.Table('game_genre',
     db.Column('game_id', db.Integer, db.ForeignKey('game.id')),
-    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id'))
+    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id')),
+    db.PrimaryKeyConstraint('game_id', 'genre_id'),
+    db.Index('ix_game_genre_genre_id', 'genre_id', 'game_id')
 )
 
-class User(UserMixin, db.Model):
+class OwnerMixin(object):
+    """Collection methods for anything with the id of a user.
+
+    Ownership is read and written straight through the association tables,
+    so checking or changing one item never loads the whole collection.
+    """
+    __slots__ = ()
+
+    def owns_console(self, console_id):
+        """Return whether the console is in this user's collection."""
+        return _owns(consoles_owned_table, 'console_id', self.id, console_id)
+
+    def owns_game(self, game_id):
+        """Return whether the game is in this user's collection."""
+        return _owns(games_owned_table, 'game_id', self.id, game_id)
+
+    def add_console(self, console_id):
+        """Add the console to this user's collection, unless already owned."""
+        added = _add_owned(consoles_owned_table, 'console_id', Console, self.id, console_id)
+        if added:
+            record_activity(self.id, 'add', 'console', [console_id])
+        return added
+
+    def add_game(self, game_id):
+        """Add the game to this user's collection, unless already owned."""
+        added = _add_owned(games_owned_table, 'game_id', Game, self.id, game_id)
+        if added:
+            _record_owned_games(self.id, [game_id], [])
+            record_activity(self.id, 'add', 'game', [game_id])
+        return added
+
+    def remove_console(self, console_id):
+        """Remove the console from this user's collection, if owned."""
+        removed = _remove_owned(consoles_owned_table, 'console_id', Console, self.id, console_id)
+        if removed:
+            record_activity(self.id, 'remove', 'console', [console_id])
+        return removed
+
+    def remove_game(self, game_id):
+        """Remove the game from this user's collection, if owned."""
+        removed = _remove_owned(games_owned_table, 'game_id', Game, self.id, game_id)
+        if removed:
+            _record_owned_games(self.id, [], [game_id])
+            record_activity(self.id, 'remove', 'game', [game_id])
+        return removed
+
+    def add_consoles(self, console_ids):
+        """Add many consoles at once, returning {id: outcome} for each id."""
+        outcomes = _add_many_owned(consoles_owned_table, 'console_id', Console, self.id, console_ids)
+        record_activity(self.id, 'add', 'console', _ids_with(outcomes, ADDED))
+        return outcomes
+
+    def add_games(self, game_ids):
+        """Add many games at once, returning {id: outcome} for each id."""
+        outcomes = _add_many_owned(games_owned_table, 'game_id', Game, self.id, game_ids)
+        added_ids = _ids_with(outcomes, ADDED)
+        _record_owned_games(self.id, added_ids, [])
+        record_activity(self.id, 'add', 'game', added_ids)
+        return outcomes
+
+    def remove_consoles(self, console_ids):
+        """Remove many consoles at once, returning {id: outcome} for each id."""
+        outcomes = _remove_many_owned(consoles_owned_table, 'console_id', Console, self.id, console_ids)
+        record_activity(self.id, 'remove', 'console', _ids_with(outcomes, REMOVED))
+        return outcomes
+
+    def remove_games(self, game_ids):
+        """Remove many games at once, returning {id: outcome} for each id."""
+        outcomes = _remove_many_owned(games_owned_table, 'game_id', Game, self.id, game_ids)
+        removed_ids = _ids_with(outcomes, REMOVED)
+        _record_owned_games(self.id, [], removed_ids)
+        record_activity(self.id, 'remove', 'game', removed_ids)
+        return outcomes
+
+    def owned_consoles(self):
+        """Return a query for the consoles in this user's collection."""
+        return Console.query.join(consoles_owned_table) \
+            .filter(consoles_owned_table.c.user_id == self.id)
+
+    def owned_games(self):
+        """Return a query for the games in this user's collection."""
+        return Game.query.join(games_owned_table) \
+            .filter(games_owned_table.c.user_id == self.id)
+
+class User(OwnerMixin, UserMixin, db.Model):
     """User model."""
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), nullable=False, unique=True)
     password = db.Column(db.String(200), nullable=False)
-    consoles_owned = db.relationship('Console', secondary='user_console', back_populates='users_who_own')
-    games_owned = db.relationship('Game', secondary='user_game', back_populates='users_who_own')
+    consoles_owned = db.relationship('Console', secondary='user_console', back_populates='users_who_own', lazy='dynamic')
+    games_owned = db.relationship('Game', secondary='user_game', back_populates='users_who_own', lazy='dynamic')
 
 # Console <--> User table
+# The primary key answers "what does user Y own", the index "who owns X"
 consoles_owned_table = db.Table('user_console',
     db.Column('console_id', db.Integer, db.ForeignKey('console.id')),
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
+    db.PrimaryKeyConstraint('user_id', 'console_id'),
+    db.Index('ix_user_console_console_id', 'console_id', 'user_id')
 )
 
 # Game <--> User table
 games_owned_table = db.Table('user_game',
     db.Column('game_id', db.Integer, db.ForeignKey('game.id')),
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id'))
-)
\ No newline at end of file
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
+    db.PrimaryKeyConstraint('user_id', 'game_id'),
+    db.Index('ix_user_game_game_id', 'game_id', 'user_id')
+)
+
+# Each game's most similar games, precomputed by tracker_app.recommendations.
+# The primary key lists a game's similar games, the index finds the lists a
+# game is in
+game_similarity_table = db.Table('game_similarity',
+    db.Column('game_id', db.Integer, db.ForeignKey('game.id', ondelete='CASCADE')),
+    db.Column('similar_id', db.Integer, db.ForeignKey('game.id', ondelete='CASCADE')),
+    db.Column('co_owners', db.Integer, nullable=False),
+    db.Column('score', db.Float, nullable=False),
+    db.PrimaryKeyConstraint('game_id', 'similar_id'),
+    db.Index('ix_game_similarity_similar_id', 'similar_id', 'game_id')
+)
+
+# Each user's recommended games, from the same module
+user_recommendation_table = db.Table('user_recommendation',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id', ondelete='CASCADE')),
+    db.Column('game_id', db.Integer, db.ForeignKey('game.id', ondelete='CASCADE')),
+    db.Column('score', db.Float, nullable=False),
+    db.PrimaryKeyConstraint('user_id', 'game_id')
+)
+
+# Background jobs waiting to run, see tracker_app.jobs. Times are Unix
+# timestamps; claimed_until is set while a worker runs the job
+job_table = db.Table('job',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('kind', db.String(40), nullable=False),
+    db.Column('key', db.String(80), nullable=False),
+    db.Column('payload', db.Text, nullable=False),
+    db.Column('created_at', db.Float, nullable=False),
+    db.Column('run_at', db.Float, nullable=False),
+    db.Column('claimed_until', db.Float),
+    db.Column('attempts', db.Integer, nullable=False, default=0, server_default='0'),
+    db.Column('failed', db.Boolean, nullable=False, default=False, server_default=db.false()),
+    db.Column('error', db.Text),
+    db.Index('ix_job_run_at', 'failed', 'run_at'),
+    db.Index('ix_job_kind_key', 'kind', 'key')
+)
+
+# What users did, written by tracker_app.activity. An append-only log, only
+# ever deleted from when old events are compacted. created_at is a Unix
+# timestamp; item is 'console', 'game' or 'genre'
+activity_event_table = db.Table('activity_event',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('created_at', db.Float, nullable=False),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False),
+    db.Column('action', db.String(10), nullable=False),
+    db.Column('item', db.String(10), nullable=False),
+    db.Column('item_id', db.Integer, nullable=False),
+    db.Index('ix_activity_event_user_id', 'user_id', 'id'),
+    db.Index('ix_activity_event_created_at', 'created_at')
+)
+
+# How many events each item had per action and day, from the same module.
+# The primary key reads one item's days, the index the items of one day
+activity_rollup_table = db.Table('activity_rollup',
+    db.Column('item', db.String(10)),
+    db.Column('item_id', db.Integer),
+    db.Column('action', db.String(10)),
+    db.Column('day', db.Date),
+    db.Column('count', db.Integer, nullable=False),
+    db.PrimaryKeyConstraint('item', 'item_id', 'action', 'day'),
+    db.Index('ix_activity_rollup_day', 'item', 'action', 'day')
+)
+
+def _owned_row(table, column, user_id, item_id):
+    return and_(table.c.user_id == user_id, table.c[column] == item_id)
+
+def _owns(table, column, user_id, item_id):
+    row = _owned_row(table, column, user_id, item_id)
+    return db.session.query(exists().where(row)).scalar()
+
+def _count_owners(model, item_id, change):
+    db.session.execute(model.__table__.update()
+        .where(model.id == item_id)
+        .values(owner_count=model.owner_count + change))
+
+def _add_owned(table, column, model, user_id, item_id):
+    # A double submit may insert the same row at once, so duplicates are
+    # skipped and only the insert that happened counts
+    insert = insert_ignoring_duplicates(table).values({'user_id': user_id, column: item_id})
+    if db.session.execute(insert).rowcount == 0:
+        return False
+    _count_owners(model, item_id, 1)
+    return True
+
+def _remove_owned(table, column, model, user_id, item_id):
+    row = _owned_row(table, column, user_id, item_id)
+    if db.session.execute(table.delete().where(row)).rowcount == 0:
+        return False
+    _count_owners(model, item_id, -1)
+    return True
+
+
+# Outcomes of adding or removing many items at once
+ADDED = 'added'
+ALREADY_OWNED = 'already_owned'
+NOT_FOUND = 'not_found'
+REMOVED = 'removed'
+NOT_OWNED = 'not_owned'
+
+def insert_ignoring_duplicates(table, dialect=None):
+    """Return an INSERT that skips rows already in the table, for the
+    session's database or the named dialect's."""
+    dialect = dialect or db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert()
+
+def _add_many_owned(table, column, model, user_id, item_ids):
+    item_ids = list(dict.fromkeys(item_ids))
+    # One query finds which ids exist and which of those are already owned
+    owned = db.session.query(model.id, table.c.user_id) \
+        .outerjoin(table, and_(table.c[column] == model.id, table.c.user_id == user_id)) \
+        .filter(model.id.in_(item_ids))
+    states = {id: owner is not None for id, owner in owned}
+
+    new_ids = [id for id in item_ids if states.get(id) is False]
+    # Another request may have added some since, which is why duplicates
+    # are skipped rather than failing the insert, and only the rows
+    # inserted count as added
+    added_ids = _insert_owned(table, column, user_id, new_ids)
+    if added_ids:
+        _count_many_owners(model, added_ids, 1)
+
+    return {
+        id: NOT_FOUND if id not in states else ADDED if id in added_ids else ALREADY_OWNED
+        for id in item_ids
+    }
+
+def _insert_owned(table, column, user_id, item_ids):
+    """Insert the rows of item_ids that aren't owned yet, returning the set
+    of ids inserted."""
+    if not item_ids:
+        return set()
+    dialect = db.session.get_bind().dialect
+    insert = insert_ignoring_duplicates(table, dialect.name)
+    rows = [{'user_id': user_id, column: id} for id in item_ids]
+    if dialect.name == 'postgresql':
+        inserted = db.session.execute(insert.values(rows).returning(table.c[column]))
+        return {id for id, in inserted}
+    if dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 35):
+        # SQLite has RETURNING since 3.35, but SQLAlchemy 1.3 can't compile it
+        values = ', '.join(f'(:user_id, :id_{n})' for n in range(len(item_ids)))
+        params = {f'id_{n}': id for n, id in enumerate(item_ids)}
+        inserted = db.session.execute(text(
+            f'INSERT OR IGNORE INTO {table.name} (user_id, {column}) '
+            f'VALUES {values} RETURNING {column}'), dict(params, user_id=user_id))
+        return {id for id, in inserted}
+    # Elsewhere a row at a time, with rowcount telling if it was inserted
+    return {row[column] for row in rows if db.session.execute(insert, row).rowcount == 1}
+
+def _remove_many_owned(table, column, model, user_id, item_ids):
+    item_ids = list(dict.fromkeys(item_ids))
+    owned = db.session.query(table.c[column]) \
+        .filter(table.c.user_id == user_id, table.c[column].in_(item_ids))
+    owned_ids = [id for id, in owned]
+
+    if owned_ids:
+        db.session.execute(table.delete().where(and_(
+            table.c.user_id == user_id, table.c[column].in_(owned_ids))))
+        _count_many_owners(model, owned_ids, -1)
+
+    owned_ids = set(owned_ids)
+    return {id: REMOVED if id in owned_ids else NOT_OWNED for id in item_ids}
+
+def _count_many_owners(model, item_ids, change):
+    db.session.execute(model.__table__.update()
+        .where(model.id.in_(item_ids))
+        .values(owner_count=model.owner_count + change))
+
+def _record_owned_games(user_id, added_ids, removed_ids):
+    """Note games added to or removed from a collection, for tracker_app.recommendations."""
+    if added_ids or removed_ids:
+        changes = db.session.info.setdefault('owned_games_changed', [])
+        changes.append((user_id, added_ids, removed_ids))
+
+def _ids_with(outcomes, outcome):
+    return [id for id, each in outcomes.items() if each == outcome]
+
+def record_activity(user_id, action, item, item_ids):
+    """Note that a user did action ('add', 'remove', 'create' or 'edit') to
+    each item_id of an item ('console', 'game' or 'genre'), for
+    tracker_app.activity to write when the session commits."""
+    if item_ids:
+        events = db.session.info.setdefault('activity', [])
+        events.extend((user_id, action, item, item_id) for item_id in item_ids)
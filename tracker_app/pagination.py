@@ -0,0 +1,41 @@
+"""Keyset pagination helpers for list views."""
+from flask import request
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+class Page(object):
+    """One page of rows plus the cursor for the page after it."""
+
+    def __init__(self, items, limit, next_after=None):
+        self.items = items
+        self.limit = limit
+        self.next_after = next_after
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+def page_args(prefix=''):
+    """Read the ?after=<id>&limit=N cursor arguments from the request."""
+    after = request.args.get(f'{prefix}after', 0, type=int)
+    limit = request.args.get(f'{prefix}limit', DEFAULT_LIMIT, type=int)
+    return after, max(1, min(limit, MAX_LIMIT))
+
+def keyset_page(query, column, after, limit):
+    """Return the rows of query whose column is greater than after.
+
+    Seeks on the (indexed) id column instead of using OFFSET, so every page
+    costs the same no matter how deep into the collection it is.
+    """
+    rows = query.filter(column > after).order_by(column).limit(limit + 1).all()
+    return page_of(rows, limit)
+
+def page_of(rows, limit):
+    """Return a Page of up to limit rows, from a list of up to limit + 1."""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return Page(rows, limit, next_after=rows[-1].id)
+    return Page(rows, limit)
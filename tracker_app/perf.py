@@ -0,0 +1,188 @@
+"""Opt-in per-request performance instrumentation.
+
+With PERF_ENABLED set, every request records how many SQL statements it
+ran, their total time, the slowest one, the time spent rendering templates
+and the total time. These are sent back in a Server-Timing header and
+logged as one JSON line on the tracker_app.perf logger. The last
+PERF_SAMPLES requests of each endpoint are kept in ring buffers, and /_perf
+reports their p50/p95/p99.
+
+The hooks are installed by init_app() and stay installed when it's off,
+but only check the setting.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+import jinja2
+from flask import current_app, g, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import NotFound
+
+# Logged through the app's logger, which writes to stderr by default
+logger = logging.getLogger('tracker_app.perf')
+logger.setLevel(logging.INFO)
+
+# Measurements kept per request, in milliseconds apart from statements
+METRICS = ('total', 'sql', 'render', 'statements')
+
+PERCENTILES = (50, 95, 99)
+
+class RequestStats(object):
+    """What one request has cost so far."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.sql_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+        self.render_time = 0.0
+
+    def add_statement(self, statement, duration):
+        self.statements += 1
+        self.sql_time += duration
+        if duration > self.slowest_time:
+            self.slowest_time = duration
+            self.slowest_statement = statement
+
+    def milliseconds(self):
+        """Return the request's METRICS."""
+        return {
+            'total': (time.perf_counter() - self.start) * 1000,
+            'sql': self.sql_time * 1000,
+            'render': self.render_time * 1000,
+            'statements': self.statements,
+        }
+
+class Samples(object):
+    """The METRICS of an endpoint's last few requests, in a ring buffer."""
+
+    def __init__(self, size):
+        self.requests = 0
+        self.samples = deque(maxlen=size)
+
+    def add(self, metrics):
+        self.requests += 1
+        self.samples.append(tuple(metrics[name] for name in METRICS))
+
+    def summary(self):
+        samples = list(self.samples)
+        summary = {'requests': self.requests, 'samples': len(samples)}
+        for index, name in enumerate(METRICS):
+            values = sorted(sample[index] for sample in samples)
+            summary[name] = {f'p{p}': round(percentile(values, p), 2) for p in PERCENTILES}
+        return summary
+
+def percentile(values, p):
+    """Return the nearest-rank percentile p of sorted values."""
+    if not values:
+        return 0
+    rank = max(1, -(-len(values) * p // 100))
+    return values[rank - 1]
+
+_samples = {}
+_samples_lock = threading.Lock()
+
+def record(endpoint, metrics):
+    with _samples_lock:
+        samples = _samples.get(endpoint)
+        if samples is None:
+            samples = _samples[endpoint] = Samples(current_app.config['PERF_SAMPLES'])
+        samples.add(metrics)
+
+def summaries():
+    with _samples_lock:
+        return {endpoint: samples.summary() for endpoint, samples in _samples.items()}
+
+def reset():
+    with _samples_lock:
+        _samples.clear()
+
+def current_stats():
+    """Return the RequestStats of the request being handled, if it's measured."""
+    return g.get('perf') if g else None
+
+##########################################
+#           Hooks                        #
+##########################################
+
+# Start times are kept per cursor, and dropped when a statement fails, so
+# they neither pile up on pooled connections nor time the wrong statement
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('perf_start', {})[cursor] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.get('perf_start', {}).pop(cursor, None)
+    stats = current_stats()
+    if stats is not None and start is not None:
+        stats.add_statement(statement, time.perf_counter() - start)
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(exception_context):
+    # The cursor is on the execution context, when the statement has one
+    cursor = exception_context.cursor or getattr(exception_context.execution_context, 'cursor', None)
+    if exception_context.connection is not None and cursor is not None:
+        exception_context.connection.info.get('perf_start', {}).pop(cursor, None)
+
+class TimedTemplate(jinja2.Template):
+    """Template that adds the time it takes to render to the request's stats."""
+
+    def render(self, *args, **kwargs):
+        stats = current_stats()
+        if stats is None:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            stats.render_time += time.perf_counter() - start
+
+def start_request():
+    if current_app.config['PERF_ENABLED'] and request.endpoint != 'perf':
+        g.perf = RequestStats()
+
+def finish_request(response):
+    stats = g.pop('perf', None)
+    if stats is None:
+        return response
+    metrics = stats.milliseconds()
+    endpoint = request.endpoint or '<unmatched>'
+    record(endpoint, metrics)
+
+    response.headers['Server-Timing'] = ', '.join([
+        f'sql;dur={metrics["sql"]:.2f};desc="{stats.statements} statements"',
+        f'render;dur={metrics["render"]:.2f}',
+        f'total;dur={metrics["total"]:.2f}',
+    ])
+    logger.info(json.dumps({
+        'method': request.method,
+        'path': request.path,
+        'endpoint': endpoint,
+        'status': response.status_code,
+        'statements': stats.statements,
+        'sql_ms': round(metrics['sql'], 2),
+        'slowest_sql_ms': round(stats.slowest_time * 1000, 2),
+        'slowest_sql': stats.slowest_statement,
+        'render_ms': round(metrics['render'], 2),
+        'total_ms': round(metrics['total'], 2),
+    }))
+    return response
+
+def perf_report():
+    """Report each endpoint's percentiles, when instrumentation is on."""
+    if not current_app.config['PERF_ENABLED']:
+        raise NotFound()
+    return jsonify(summaries())
+
+def init_app(app):
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.add_url_rule('/_perf', 'perf', perf_report)
@@ -0,0 +1,157 @@
+"""Token bucket rate limits for the routes that are expensive to call.
+
+Signing up and logging in hash a password with bcrypt, and collection
+edits write to the database, so a script calling them in a loop could take
+every worker's CPU. Each limited route takes a token from a bucket per
+client, e.g. per IP or per logged in user. A bucket holds up to N tokens
+and refills at N per period, so a client may burst N requests and then
+keep to the average rate. A request finding its bucket empty gets a
+429 Too Many Requests with a Retry-After header.
+
+Limits are named, and RATE_LIMITS maps each name to 'N/period', where
+period is second, minute, hour or day. Views are limited with:
+
+    @rate_limiter.limit('login', by_ip)
+
+Buckets are kept in a RateLimitBackend. LocalBackend keeps them in this
+process, so with several worker processes each enforces its own limits.
+"""
+import functools
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.utils import import_string
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+# Buckets of a LocalBackend are split between this many locks, so threads
+# taking tokens for different clients rarely wait on each other
+SHARDS = 64
+
+@functools.lru_cache(maxsize=None)
+def parse_limit(limit):
+    """Return the (rate per second, burst) of a limit like '10/minute'."""
+    count, _, period = limit.partition('/')
+    if period not in PERIODS or not count.isdigit() or int(count) < 1:
+        raise ValueError(f'Invalid rate limit {limit!r}, expected e.g. 10/minute')
+    return int(count) / PERIODS[period], int(count)
+
+def by_ip():
+    """Limit each client address. Behind a proxy, use werkzeug's ProxyFix
+    so this is the client's address rather than the proxy's."""
+    return request.remote_addr
+
+def by_user():
+    """Limit each logged in user, or each address before logging in."""
+    if current_user.is_authenticated:
+        return f'user:{current_user.id}'
+    return request.remote_addr
+
+def by_username():
+    """Limit attempts at each account from each address, so nobody can lock
+    someone else out by trying their username. Requests without a username
+    are only limited per address, by another limit."""
+    username = request.form.get('username', '').strip().lower()
+    if username:
+        return f'{username}@{request.remote_addr}'
+    return None
+
+class RateLimitBackend(object):
+    """Where the token buckets are kept.
+
+    LocalBackend keeps them in this process. A backend shared between
+    processes, e.g. one running the same arithmetic in a Redis script,
+    keeps one bucket per client across every worker.
+    """
+
+    def take(self, key, rate, burst):
+        """Take a token from key's bucket, which refills at rate tokens per
+        second up to burst. Returns 0 if there was one, or else the seconds
+        until there will be."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+class LocalBackend(RateLimitBackend):
+    """Keeps up to maxsize buckets in this process, in SHARDS shards.
+
+    Each shard evicts its least recently used buckets when full. An evicted
+    bucket starts over full, which only lets through a client that has been
+    idle longer than the buckets of maxsize others.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.shards = [(threading.Lock(), OrderedDict()) for _ in range(SHARDS)]
+        self.shard_size = max(1, maxsize // SHARDS)
+
+    def take(self, key, rate, burst, now=None):
+        if now is None:
+            now = time.monotonic()
+        lock, buckets = self.shards[hash(key) % SHARDS]
+        with lock:
+            # (tokens, when they were counted)
+            tokens, counted = buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - counted) * rate)
+            if tokens >= 1:
+                tokens, wait = tokens - 1, 0
+            else:
+                wait = (1 - tokens) / rate
+            buckets[key] = (tokens, now)
+            if len(buckets) > self.shard_size:
+                buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        for lock, buckets in self.shards:
+            with lock:
+                buckets.clear()
+
+class RateLimiter(object):
+    """Limits views with token buckets kept in a RateLimitBackend."""
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def init_app(self, app):
+        """Use the app's RATELIMIT_BACKEND."""
+        backend = import_string(app.config['RATELIMIT_BACKEND'])
+        self.backend = backend(app.config['RATELIMIT_SIZE'])
+        for limit in app.config['RATE_LIMITS'].values():
+            parse_limit(limit)
+
+    def check(self, name, key):
+        """Take a token for key under the named limit, raising TooManyRequests
+        if its bucket is empty."""
+        if not current_app.config['RATELIMIT_ENABLED']:
+            return
+        rate, burst = parse_limit(current_app.config['RATE_LIMITS'][name])
+        wait = self.backend.take(f'{name}:{key}', rate, burst)
+        if wait:
+            retry_after = math.ceil(wait)
+            current_app.logger.info('Rate limited %s for %s', name, key)
+            raise TooManyRequests(
+                f'Too many requests, try again in {retry_after} seconds.', retry_after=retry_after)
+
+    def limit(self, name, key=by_ip, methods=('POST',)):
+        """Decorate a view to check the named limit for each of its requests
+        with one of methods, per client as returned by key(). Requests whose
+        key is None aren't limited."""
+        def decorator(view):
+            @functools.wraps(view)
+            def limited(*args, **kwargs):
+                if request.method in methods:
+                    client = key()
+                    if client is not None:
+                        self.check(name, client)
+                return view(*args, **kwargs)
+            return limited
+        return decorator
+
+    def clear(self):
+        self.backend.clear()
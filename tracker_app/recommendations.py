@@ -0,0 +1,280 @@
+"""Games recommended from who owns what.
+
+Two games are similar when the same users own both, scored by the cosine
+similarity of their sets of owners. rebuild() computes it for every pair of
+games with sparse matrices and keeps each game's SIMILAR_LIMIT best matches
+in game_similarity. Games with fewer co-owned matches than that are topped
+up with popular games sharing their genres, scored down by GENRE_WEIGHT.
+Each user's recommendations are the sum of the similar games of everything
+they own, minus what they own, kept in user_recommendation.
+
+Pages only read those tables. A commit that changes a collection queues a
+job (see tracker_app.jobs) that adjusts the scores of the stored pairs it
+affects and recomputes the user's recommendations from them. Pairs that
+aren't stored yet and the drift from owner counts changing are left for the
+next `flask rebuild-recommendations`.
+
+rebuild() needs NumPy and SciPy, which the app doesn't otherwise use.
+"""
+import itertools
+import math
+
+from sqlalchemy import and_, bindparam, event, func, inspect, literal, or_, select, text
+from tracker_app import db, jobs
+from tracker_app.models import (Game, User, game_genre_table, games_owned_table,
+    game_similarity_table, user_recommendation_table)
+
+SIMILAR_LIMIT = 20
+RECOMMENDATION_LIMIT = 20
+
+# Genre similarity is scaled down by this, so shared owners count for more
+GENRE_WEIGHT = 0.1
+
+# Most owned games of each genre considered for topping up similar games
+GENRE_CANDIDATES = 50
+
+# Games or users handled per matrix product, bounding rebuild()'s memory
+BLOCK_SIZE = 2000
+
+# Rows fetched or inserted at once
+BATCH_SIZE = 10000
+
+##########################################
+#           Reading                      #
+##########################################
+
+# Plain SQL, as building and compiling the equivalent query would take
+# longer than running it
+SIMILAR_GAMES = text("""
+    SELECT game.id, game.title, game_similarity.co_owners
+    FROM game_similarity JOIN game ON game.id = game_similarity.similar_id
+    WHERE game_similarity.game_id = :game_id
+    ORDER BY game_similarity.score DESC, game.id
+    LIMIT :limit""")
+
+RECOMMENDED_GAMES = text("""
+    SELECT game.id, game.title
+    FROM user_recommendation JOIN game ON game.id = user_recommendation.game_id
+    WHERE user_recommendation.user_id = :user_id
+    ORDER BY user_recommendation.score DESC, game.id
+    LIMIT :limit""")
+
+def similar_games(game_id, limit=SIMILAR_LIMIT):
+    """Return (id, title, co_owners) of the games most similar to a game."""
+    return db.session.execute(SIMILAR_GAMES, {'game_id': game_id, 'limit': limit}).fetchall()
+
+def recommended_games(user_id, limit=RECOMMENDATION_LIMIT):
+    """Return (id, title) of the games recommended to a user."""
+    return db.session.execute(RECOMMENDED_GAMES, {'user_id': user_id, 'limit': limit}).fetchall()
+
+##########################################
+#           Rebuilding                   #
+##########################################
+
+def rebuild(connection):
+    """Recompute every game's similar games and every user's recommendations.
+
+    Returns how many similar games and recommendations were stored.
+    """
+    from tracker_app import matrices
+
+    n_users = (connection.scalar(select([func.max(User.id)])) or 0) + 1
+    n_games = (connection.scalar(select([func.max(Game.id)])) or 0) + 1
+    n_genres = (connection.scalar(select([func.max(game_genre_table.c.genre_id)])) or 0) + 1
+    # Users by the games they own, and games by their genres
+    owned = matrices.load(connection, games_owned_table.c.user_id, games_owned_table.c.game_id,
+        (n_users, n_games), BATCH_SIZE)
+    genres = matrices.load(connection, game_genre_table.c.game_id, game_genre_table.c.genre_id,
+        (n_games, n_genres), BATCH_SIZE)
+
+    owners = matrices.column_sums(owned)
+    owner_norms = matrices.inverse_sqrt(owners)
+    genre_norms = matrices.inverse_sqrt(matrices.row_sums(genres))
+    candidates = matrices.top_rows_by_column(genres, owners, GENRE_CANDIDATES)
+    candidate_genres = genres[candidates].T.tocsr()
+    owners_by_game = owned.T.tocsr()
+
+    connection.execute(game_similarity_table.delete())
+    connection.execute(user_recommendation_table.delete())
+
+    # Similar games, a block of games at a time
+    blocks = []
+    for start in range(0, n_games, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, n_games)
+        co_owners = matrices.without_diagonal(owners_by_game[start:stop] @ owned, start)
+        scores = matrices.scale(co_owners, owner_norms[start:stop], owner_norms)
+
+        # Top up the games that have too few co-owned games
+        too_few = matrices.row_counts(co_owners) < SIMILAR_LIMIT
+        shared_genres = matrices.remap_columns(
+            genres[start:stop] @ candidate_genres, candidates, n_games)
+        shared_genres = matrices.without_diagonal(matrices.keep_rows(shared_genres, too_few), start)
+        scores = scores + matrices.scale(shared_genres, genre_norms[start:stop], genre_norms) * GENRE_WEIGHT
+
+        rows, columns, values = matrices.top_k(scores, SIMILAR_LIMIT)
+        counts = matrices.lookup(co_owners, rows, columns)
+        _insert(connection, game_similarity_table, ['game_id', 'similar_id', 'co_owners', 'score'],
+            zip((rows + start).tolist(), columns.tolist(), counts.astype(int).tolist(), values.tolist()))
+        blocks.append(matrices.from_rows(rows, columns, values, (stop - start, n_games)))
+    similar = matrices.stack(blocks, (n_games, n_games))
+
+    # Recommendations, a block of users at a time
+    recommendations = 0
+    for start in range(0, n_users, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, n_users)
+        scores = matrices.without(owned[start:stop] @ similar, owned[start:stop])
+        rows, columns, values = matrices.top_k(scores, RECOMMENDATION_LIMIT)
+        recommendations += _insert(connection, user_recommendation_table, ['user_id', 'game_id', 'score'],
+            zip((rows + start).tolist(), columns.tolist(), values.tolist()))
+
+    return similar.nnz, recommendations
+
+def _insert(connection, table, columns, rows):
+    """Insert tuples of values for columns, returning how many there were.
+
+    The rows go straight to the driver's executemany, as building a dict for
+    each of millions of rows takes longer than inserting them.
+    """
+    compiled = table.insert().compile(dialect=connection.dialect, column_keys=columns)
+    if not connection.dialect.positional:
+        rows = (dict(zip(columns, row)) for row in rows)
+    elif list(compiled.positiontup) != columns:
+        order = [columns.index(name) for name in compiled.positiontup]
+        rows = (tuple(row[index] for index in order) for row in rows)
+
+    cursor = connection.connection.cursor()
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, BATCH_SIZE))
+        if not batch:
+            cursor.close()
+            return count
+        cursor.executemany(str(compiled), batch)
+        count += len(batch)
+
+##########################################
+#           Collection changes           #
+##########################################
+
+def apply_changes(connection, user_id, added_ids, removed_ids):
+    """Update the index for games added to and removed from a collection.
+
+    Stored pairs that gained or lost a co-owner have their co_owners and
+    score adjusted, then the user's recommendations are recomputed.
+    """
+    added_ids, removed_ids = set(added_ids), set(removed_ids)
+    changed_ids = added_ids | removed_ids
+    similarity = game_similarity_table
+    owned_ids = select([games_owned_table.c.game_id]).where(games_owned_table.c.user_id == user_id)
+
+    def is_partner(column):
+        # Pairs gain an owner among what's owned now and lose one among what
+        # was removed
+        if removed_ids:
+            return or_(column.in_(owned_ids), column.in_(removed_ids))
+        return column.in_(owned_ids)
+
+    pairs = connection.execute(
+        select([similarity.c.game_id, similarity.c.similar_id]).where(or_(
+            and_(similarity.c.game_id.in_(changed_ids), is_partner(similarity.c.similar_id)),
+            and_(similarity.c.similar_id.in_(changed_ids), is_partner(similarity.c.game_id)),
+        ))).fetchall()
+
+    changes = {}
+    for pair in pairs:
+        # Owned now, and at least one of the two was just added
+        gained = bool(added_ids.intersection(pair)) and not removed_ids.intersection(pair)
+        # Owned before, and at least one of the two was just removed
+        lost = bool(removed_ids.intersection(pair)) and not added_ids.intersection(pair)
+        if gained != lost:
+            changes[tuple(pair)] = 1 if gained else -1
+
+    if changes:
+        game_ids = set(itertools.chain.from_iterable(changes))
+        owners = dict(connection.execute(
+            select([Game.id, Game.owner_count]).where(Game.id.in_(game_ids))).fetchall())
+        connection.execute(
+            similarity.update()
+                .where(and_(similarity.c.game_id == bindparam('pair_game_id'),
+                            similarity.c.similar_id == bindparam('pair_similar_id')))
+                .values(co_owners=similarity.c.co_owners + bindparam('change'),
+                        score=similarity.c.score + bindparam('score_change')),
+            [{'pair_game_id': game_id, 'pair_similar_id': similar_id, 'change': change,
+              'score_change': change / math.sqrt(max(owners.get(game_id, 1) * owners.get(similar_id, 1), 1))}
+             for (game_id, similar_id), change in changes.items()])
+
+    recommend(connection, user_id)
+
+def recommend(connection, user_id):
+    """Recompute a user's recommendations from the stored similar games."""
+    similarity = game_similarity_table
+    owned_ids = select([games_owned_table.c.game_id]).where(games_owned_table.c.user_id == user_id)
+    score = func.sum(similarity.c.score)
+    best = select([literal(user_id), similarity.c.similar_id, score]) \
+        .where(similarity.c.game_id.in_(owned_ids)) \
+        .where(similarity.c.similar_id.notin_(owned_ids)) \
+        .group_by(similarity.c.similar_id) \
+        .having(score > 0) \
+        .order_by(score.desc(), similarity.c.similar_id) \
+        .limit(RECOMMENDATION_LIMIT)
+
+    table = user_recommendation_table
+    connection.execute(table.delete().where(table.c.user_id == user_id))
+    connection.execute(table.insert().from_select(['user_id', 'game_id', 'score'], best))
+
+def _net_changes(changes):
+    """Combine recorded (user_id, added_ids, removed_ids) into one per user."""
+    users = {}
+    for user_id, added_ids, removed_ids in changes:
+        added, removed = users.setdefault(user_id, (set(), set()))
+        for game_id in added_ids:
+            if game_id in removed:
+                removed.discard(game_id)
+            else:
+                added.add(game_id)
+        for game_id in removed_ids:
+            if game_id in added:
+                added.discard(game_id)
+            else:
+                removed.add(game_id)
+    return users
+
+@event.listens_for(db.session, 'after_flush')
+def record_relationship_changes(session, flush_context):
+    # Collections changed through the relationship rather than OwnerMixin
+    changes = session.info.setdefault('owned_games_changed', [])
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, User):
+            history = inspect(obj).attrs.games_owned.history
+            added, deleted = history.added or (), history.deleted or ()
+            if added or deleted:
+                changes.append((obj.id, [game.id for game in added], [game.id for game in deleted]))
+
+def merge_changes(waiting, new):
+    """Combine the payloads of two jobs for the same user."""
+    (added_ids, removed_ids), = _net_changes([
+        (waiting['user_id'], waiting['added'], waiting['removed']),
+        (new['user_id'], new['added'], new['removed'])]).values()
+    return {'user_id': waiting['user_id'], 'added': sorted(added_ids), 'removed': sorted(removed_ids)}
+
+@jobs.handler('recommendations', merge=merge_changes)
+def update_recommendations(connection, payload):
+    apply_changes(connection, payload['user_id'], payload['added'], payload['removed'])
+
+@event.listens_for(db.session, 'before_commit')
+def queue_recorded_changes(session):
+    # Flush first, as committing only flushes after this runs
+    session.flush()
+    changes = session.info.pop('owned_games_changed', None)
+    if not changes:
+        return
+    connection = session.connection()
+    for user_id, (added_ids, removed_ids) in _net_changes(changes).items():
+        if added_ids or removed_ids:
+            jobs.enqueue(connection, 'recommendations', user_id,
+                {'user_id': user_id, 'added': sorted(added_ids), 'removed': sorted(removed_ids)})
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changes(session):
+    session.info.pop('owned_games_changed', None)
@@ -0,0 +1,203 @@
+"""Full-text search over games and consoles.
+
+On SQLite this is backed by an FTS5 table that triggers keep in sync with
+the game and console tables. Each row's rowid encodes what it indexes: a
+game's is id * 2 and a console's is id * 2 + 1, so the triggers update the
+index by rowid instead of scanning it.
+
+PostgreSQL has no FTS5, so there each table gets a GIN index on a weighted
+tsvector of its columns instead, and results use the same rowid encoding.
+"""
+import re
+
+from sqlalchemy import event, text
+from tracker_app import db
+
+SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        name, maker, notes, tokenize='unicode61 remove_diacritics 2', prefix='2 3 4')""",
+
+    """CREATE TRIGGER IF NOT EXISTS game_search_insert AFTER INSERT ON game BEGIN
+        INSERT INTO search_index (rowid, name, maker, notes)
+        VALUES (new.id * 2, new.title, new.publisher, new.game_notes);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS game_search_update
+    AFTER UPDATE OF title, publisher, game_notes ON game BEGIN
+        UPDATE search_index SET name = new.title, maker = new.publisher, notes = new.game_notes
+        WHERE rowid = new.id * 2;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS game_search_delete AFTER DELETE ON game BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+    END""",
+
+    """CREATE TRIGGER IF NOT EXISTS console_search_insert AFTER INSERT ON console BEGIN
+        INSERT INTO search_index (rowid, name, maker, notes)
+        VALUES (new.id * 2 + 1, new.name, new.company, new.console_notes);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS console_search_update
+    AFTER UPDATE OF name, company, console_notes ON console BEGIN
+        UPDATE search_index SET name = new.name, maker = new.company, notes = new.console_notes
+        WHERE rowid = new.id * 2 + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS console_search_delete AFTER DELETE ON console BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2 + 1;
+    END""",
+]
+
+def document(name, maker, notes):
+    """Return the SQL for a row's tsvector, weighting its columns like SCORE."""
+    return ' || '.join(
+        f"setweight(to_tsvector('simple', coalesce({column}, '')), '{weight}')"
+        for column, weight in ((name, 'A'), (maker, 'B'), (notes, 'C')))
+
+GAME_DOCUMENT = document('title', 'publisher', 'game_notes')
+CONSOLE_DOCUMENT = document('name', 'company', 'console_notes')
+
+# Queries must repeat these expressions exactly for the indexes to be used
+POSTGRES_SCHEMA = [
+    f'CREATE INDEX IF NOT EXISTS ix_game_search ON game USING gin (({GAME_DOCUMENT}))',
+    f'CREATE INDEX IF NOT EXISTS ix_console_search ON console USING gin (({CONSOLE_DOCUMENT}))',
+]
+
+def hits(column, index):
+    """Return the SQL counting the query's matches in a search_index column.
+
+    highlight() marks each match with one character, so the text grows by
+    one per match.
+    """
+    return f"coalesce(length(highlight(search_index, {index}, char(1), '')) - length({column}), 0)"
+
+# Matches in the name count the most, then the publisher/company, then
+# notes. Lower scores rank higher. Like ts_rank() on PostgreSQL this only
+# counts the row's own matches: bm25() also weighs how many rows each word
+# matches, which means reading every match of a common word before
+# returning any, about 40 ms for a word in a million games.
+SCORE = f'-(10.0 * {hits("name", 0)} + 3.0 * {hits("maker", 1)} + {hits("notes", 2)})'
+
+# Matches ranked per query. Only the newest RANK_LIMIT matches are scored
+# and listed, so a query costs the same however many rows it matches, and
+# results say when a query had more. Narrower queries rank every match.
+RANK_LIMIT = 500
+
+def create_search_index(connection):
+    """Create the search table and its triggers, indexing existing rows if it is new."""
+    if connection.dialect.name == 'postgresql':
+        for statement in POSTGRES_SCHEMA:
+            connection.execute(statement)
+        return
+    if connection.dialect.name != 'sqlite':
+        return
+    is_new = not connection.dialect.has_table(connection, 'search_index')
+    for statement in SCHEMA:
+        connection.execute(statement)
+    if is_new:
+        rebuild_search_index(connection)
+
+def rebuild_search_index(connection):
+    """Re-index every game and console."""
+    connection.execute('DELETE FROM search_index')
+    connection.execute(
+        'INSERT INTO search_index (rowid, name, maker, notes) '
+        'SELECT id * 2, title, publisher, game_notes FROM game')
+    connection.execute(
+        'INSERT INTO search_index (rowid, name, maker, notes) '
+        'SELECT id * 2 + 1, name, company, console_notes FROM console')
+
+@event.listens_for(db.metadata, 'after_create')
+def after_create(target, connection, **kw):
+    create_search_index(connection)
+
+@event.listens_for(db.metadata, 'before_drop')
+def before_drop(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS search_index')
+
+def match_expression(query):
+    """Turn free text into an FTS5 query matching every word.
+
+    The last word also matches as a prefix, so partly typed queries find
+    results. Only word characters are kept, so user input can't inject FTS5
+    syntax.
+    """
+    words = [f'"{word}"' for word in re.findall(r'\w+', query)]
+    if words:
+        words[-1] += '*'
+    return ' '.join(words)
+
+def tsquery_expression(query):
+    """Turn free text into a PostgreSQL tsquery, like match_expression()."""
+    words = re.findall(r'\w+', query)
+    if words:
+        words[-1] += ':*'
+    return ' & '.join(words)
+
+# Each backend's (query expression, select) where the select scores the
+# newest :candidates matches, lower scores ranking higher, so both order
+# and page the same way
+SQLITE_SEARCH = (
+    match_expression,
+    f"""SELECT rowid, name, maker, {SCORE} AS score
+    FROM search_index WHERE search_index MATCH :match
+    ORDER BY rowid DESC LIMIT :candidates""",
+)
+
+# Scored outside the UNION, so only the candidates are
+POSTGRES_SEARCH = (
+    tsquery_expression,
+    f"""SELECT rowid, name, maker,
+        -ts_rank({document('name', 'maker', 'notes')}, to_tsquery('simple', :match))::float8 AS score
+    FROM (
+        SELECT id * 2 AS rowid, title AS name, publisher AS maker, game_notes AS notes
+        FROM game WHERE {GAME_DOCUMENT} @@ to_tsquery('simple', :match)
+        UNION ALL
+        SELECT id * 2 + 1, name, company, console_notes
+        FROM console WHERE {CONSOLE_DOCUMENT} @@ to_tsquery('simple', :match)
+        ORDER BY rowid DESC LIMIT :candidates
+    ) AS candidates""",
+)
+
+# Ranks a backend's candidates and seeks past the cursor of a page, if any
+RANKED = """SELECT * FROM (
+    SELECT *, row_number() OVER (ORDER BY rowid DESC) AS newest, count(*) OVER () AS found
+    FROM ({select}) AS scored
+) AS ranked WHERE newest <= :ranked {where}
+ORDER BY score, rowid DESC LIMIT :limit"""
+
+AFTER = 'AND (score > :score OR (score = :score AND rowid < :rowid))'
+
+def search(query, after=None, per_page=20):
+    """Return one page of ranked results, the cursor of the next page, and
+    whether the query matched more than the RANK_LIMIT it ranks.
+
+    The newest RANK_LIMIT matches are ranked, best first, and ties go
+    newest first. after is the (score, rowid) cursor a previous page
+    returned, or None for the first page, so later pages seek past it
+    instead of using OFFSET. Each result is a dict with the type ('game'
+    or 'console'), id, name and maker (publisher or company) of the match.
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        expression, select = POSTGRES_SEARCH
+    else:
+        expression, select = SQLITE_SEARCH
+    match = expression(query)
+    if not match:
+        return [], None, False
+    # One more candidate than is ranked shows whether there were more
+    params = {'match': match, 'candidates': RANK_LIMIT + 1, 'ranked': RANK_LIMIT, 'limit': per_page + 1}
+    where = ''
+    if after is not None:
+        where = AFTER
+        params['score'], params['rowid'] = after
+    rows = db.session.execute(text(RANKED.format(select=select, where=where)), params).fetchall()
+
+    results = [{
+        'type': 'console' if rowid % 2 else 'game',
+        'id': rowid // 2,
+        'name': name,
+        'maker': maker,
+    } for rowid, name, maker, *_ in rows[:per_page]]
+    limited = bool(rows) and rows[0].found > RANK_LIMIT
+    if len(rows) > per_page:
+        row = rows[per_page - 1]
+        return results, (row.score, row.rowid), limited
+    return results, None, limited
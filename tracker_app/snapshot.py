@@ -0,0 +1,415 @@
+"""Read-only snapshot of the catalog, shared by workers through mmap.
+
+The snapshot file holds every console, game and genre as columnar arrays:
+ids, console ids, ratings and counts as fixed-size integers, text as
+offsets into a UTF-8 blob, and a game's genres and a console's games as
+CSR arrays (offsets into one flat array of ids). Each process maps the file
+and reads rows straight out of the mapping, so the homepage, the detail
+pages and the choice lists run no queries and build no ORM objects, and
+every worker on a host shares the same pages of memory. The snapshot
+also holds the bitmaps games are browsed by; see tracker_app.facets.
+
+The file is rebuilt, never updated. Commits that change a Console, Game or
+Genre queue a job to write a new one (see tracker_app.jobs), which is
+written beside it and moved into its place, so readers keep serving the
+old file until then rather than waiting for a build. Its version stamp is
+its modification time in nanoseconds, set when it's written: readers stat
+the path on each access and map the file again when the stamp changed.
+Only a missing or unreadable file, e.g. on a new database, is built by
+the request that finds it. Empty and missing text both read as ''.
+"""
+import array
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from sqlalchemy import event, func, select
+from tracker_app import db, facets, jobs
+from tracker_app.models import Console, Game, Genre, game_genre_table
+from tracker_app.pagination import page_of
+
+# Bumped whenever the layout changes, so files from older versions are rebuilt
+MAGIC = b'CATALOG3'
+
+# The magic, then the length of the JSON header that lists the arrays
+PREFIX = struct.Struct('<8sQ')
+
+# Arrays start at multiples of this, so they can be cast in place
+ALIGNMENT = 8
+
+# Stands in for a game without a personal rating
+NO_RATING = -2 ** 31
+
+# Rows fetched at once while building
+BATCH_SIZE = 10000
+
+ConsoleRow = namedtuple('ConsoleRow', 'id name company portable console_notes game_count version')
+GameRow = namedtuple('GameRow', 'id title publisher personal_rating game_notes console_id console genres version')
+GenreRow = namedtuple('GenreRow', 'id name')
+ListedGame = namedtuple('ListedGame', 'id title')
+
+##########################################
+#           Building                     #
+##########################################
+
+class Ragged(object):
+    """Rows of varying length, as offsets into one array of values."""
+
+    def __init__(self, typecode):
+        self.offsets = array.array('q', [0])
+        self.values = array.array(typecode)
+
+    def append(self, values):
+        self.values.extend(values)
+        self.offsets.append(len(self.values))
+
+class Text(Ragged):
+    """Strings, as offsets into their UTF-8 bytes."""
+
+    def __init__(self):
+        super(Text, self).__init__('B')
+
+    def append(self, value):
+        self.values.frombytes((value or '').encode('utf-8'))
+        self.offsets.append(len(self.values))
+
+    def __iter__(self):
+        values = self.values.tobytes()
+        for start, end in zip(self.offsets, self.offsets[1:]):
+            yield values[start:end].decode('utf-8')
+
+def _rows(connection, query):
+    """Yield the rows of a query, fetching them in batches."""
+    result = connection.execution_options(stream_results=True).execute(query)
+    for rows in iter(lambda: result.fetchmany(BATCH_SIZE), []):
+        yield from rows
+
+def _columns(connection, query, columns):
+    """Read a query's rows into one array, or Text, per column."""
+    loaded = [Text() if typecode is None else array.array(typecode) for typecode in columns]
+    for row in _rows(connection, query):
+        for column, value in zip(loaded, row):
+            column.append(value)
+    return loaded
+
+def _group(ids, pairs):
+    """Return the values of each id as Ragged rows, from (id, value) pairs
+    sorted the same way as ids."""
+    grouped = Ragged('i')
+    pairs = iter(pairs)
+    pair = next(pairs, None)
+    for id in ids:
+        values = []
+        while pair is not None and pair[0] <= id:
+            if pair[0] == id:
+                values.append(pair[1])
+            pair = next(pairs, None)
+        grouped.append(values)
+    return grouped
+
+def build(connection):
+    """Return the arrays of a snapshot of the catalog, by name."""
+    console_ids, names, companies, portable, notes, game_counts, console_versions = _columns(connection,
+        select([Console.id, Console.name, Console.company, Console.portable,
+                Console.console_notes, Console.game_count, Console.version]).order_by(Console.id),
+        ['i', None, None, 'b', None, 'i', 'i'])
+    game_ids, console_id, ratings, titles, publishers, game_notes, game_versions = _columns(connection,
+        select([Game.id, Game.console_id, func.coalesce(Game.personal_rating, NO_RATING),
+                Game.title, Game.publisher, Game.game_notes, Game.version]).order_by(Game.id),
+        ['i', 'i', 'i', None, None, None, 'i'])
+    genre_ids, genre_names = _columns(connection,
+        select([Genre.id, Genre.name]).order_by(Genre.id), ['i', None])
+
+    game_genres = _group(game_ids, _rows(connection,
+        select([game_genre_table.c.game_id, game_genre_table.c.genre_id])
+            .order_by(game_genre_table.c.game_id, game_genre_table.c.genre_id)))
+    # From the games already read, so every listed game has a row
+    by_console = {}
+    for row, game_console_id in enumerate(console_id):
+        by_console.setdefault(game_console_id, []).append(row)
+    console_games = Ragged('i')
+    # The game rows in console order, and whether each one's console is
+    # portable, which the facets number games by
+    order, order_portable = [], []
+    for id, is_portable in zip(console_ids, portable):
+        rows = by_console.get(id, ())
+        console_games.append(game_ids[row] for row in rows)
+        order.extend(rows)
+        order_portable.extend([is_portable] * len(rows))
+
+    arrays = {
+        'console.id': console_ids,
+        'console.portable': portable,
+        'console.game_count': game_counts,
+        'console.version': console_versions,
+        'game.id': game_ids,
+        'game.console_id': console_id,
+        'game.rating': ratings,
+        'game.version': game_versions,
+        'genre.id': genre_ids,
+    }
+    ragged = {
+        'console.name': names,
+        'console.company': companies,
+        'console.notes': notes,
+        'console.games': console_games,
+        'game.title': titles,
+        'game.publisher': publishers,
+        'game.notes': game_notes,
+        'game.genres': game_genres,
+        'genre.name': genre_names,
+    }
+
+    facet_arrays, publisher_names, publisher_games = facets.build(
+        order, order_portable, game_genres, ratings, list(publishers), genre_ids)
+    arrays.update(facet_arrays)
+    ragged['facet.publisher.name'] = Text()
+    ragged['facet.publisher.games'] = Ragged('i')
+    for name, positions in zip(publisher_names, publisher_games):
+        ragged['facet.publisher.name'].append(name)
+        ragged['facet.publisher.games'].append(positions)
+
+    for name, rows in ragged.items():
+        arrays[f'{name}.offsets'] = rows.offsets
+        arrays[f'{name}.values'] = rows.values
+    return arrays
+
+def _aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+def write(path, arrays):
+    """Replace the file at path with a snapshot of arrays, all at once.
+
+    The new file's modification time is set to the current time in
+    nanoseconds, which readers use as its version stamp.
+    """
+    header, offset = {}, 0
+    for name, values in arrays.items():
+        size = len(values) * values.itemsize
+        header[name] = [values.typecode, offset, size]
+        offset += _aligned(size)
+    header = json.dumps(header).encode('utf-8')
+
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.catalog-')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(PREFIX.pack(MAGIC, len(header)))
+            file.write(header)
+            file.write(bytes(_aligned(file.tell()) - file.tell()))
+            for values in arrays.values():
+                values.tofile(file)
+                file.write(bytes(_aligned(file.tell()) - file.tell()))
+        stamp = time.time_ns()
+        os.utime(temp_path, ns=(stamp, stamp))
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+##########################################
+#           Reading                      #
+##########################################
+
+class Snapshot(object):
+    """A snapshot file, mapped into memory."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.stamp = os.fstat(file.fileno()).st_mtime_ns
+            view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, length = PREFIX.unpack_from(view) if len(view) >= PREFIX.size else (None, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a catalog snapshot of this version')
+        header = json.loads(bytes(view[PREFIX.size:PREFIX.size + length]))
+        start = _aligned(PREFIX.size + length)
+        # Each array is a view of the mapping, so nothing is copied
+        self.arrays = {
+            name: view[start + offset:start + offset + size].cast(typecode)
+            for name, (typecode, offset, size) in header.items()}
+
+    def _index(self, kind, id):
+        """Return the row of an id of a kind, or None."""
+        ids = self.arrays[f'{kind}.id']
+        row = bisect.bisect_left(ids, id)
+        if row < len(ids) and ids[row] == id:
+            return row
+        return None
+
+    def _ragged(self, name, row):
+        offsets = self.arrays[f'{name}.offsets']
+        return self.arrays[f'{name}.values'][offsets[row]:offsets[row + 1]]
+
+    def _text(self, name, row):
+        return str(self._ragged(name, row), 'utf-8')
+
+    def _console(self, row):
+        return ConsoleRow(
+            id=self.arrays['console.id'][row],
+            name=self._text('console.name', row),
+            company=self._text('console.company', row),
+            portable=bool(self.arrays['console.portable'][row]),
+            console_notes=self._text('console.notes', row),
+            game_count=self.arrays['console.game_count'][row],
+            version=self.arrays['console.version'][row])
+
+    def console(self, console_id):
+        """Return a console's ConsoleRow, or None if it doesn't exist."""
+        row = self._index('console', console_id)
+        return None if row is None else self._console(row)
+
+    def consoles(self, after, limit):
+        """Return a Page of the consoles whose id is greater than after."""
+        ids = self.arrays['console.id']
+        start = bisect.bisect_right(ids, after)
+        return page_of([self._console(row) for row in range(start, min(start + limit + 1, len(ids)))], limit)
+
+    def console_games(self, console_id, after, limit):
+        """Return a Page of a console's games whose id is greater than after."""
+        row = self._index('console', console_id)
+        game_ids = self._ragged('console.games', row) if row is not None else []
+        start = bisect.bisect_right(game_ids, after)
+        return page_of([
+            ListedGame(game_id, self._text('game.title', self._index('game', game_id)))
+            for game_id in game_ids[start:start + limit + 1]], limit)
+
+    def game(self, game_id):
+        """Return a game's GameRow, with its console and genres, or None."""
+        row = self._index('game', game_id)
+        if row is None:
+            return None
+        rating = self.arrays['game.rating'][row]
+        console_id = self.arrays['game.console_id'][row]
+        return GameRow(
+            id=game_id,
+            title=self._text('game.title', row),
+            publisher=self._text('game.publisher', row),
+            personal_rating=None if rating == NO_RATING else rating,
+            game_notes=self._text('game.notes', row),
+            console_id=console_id,
+            console=self.console(console_id),
+            genres=[GenreRow(genre_id, self._text('genre.name', genre_row))
+                    for genre_id in self._ragged('game.genres', row)
+                    for genre_row in [self._index('genre', genre_id)] if genre_row is not None],
+            version=self.arrays['game.version'][row])
+
+    def name(self, kind, id):
+        """Return the name of a console or genre, or the title of a game,
+        or None if it doesn't exist."""
+        row = self._index(kind, id)
+        if row is None:
+            return None
+        return self._text('game.title' if kind == 'game' else f'{kind}.name', row)
+
+    def choices(self, kind):
+        """Return the (id, name) of every console or genre, by id."""
+        ids = self.arrays[f'{kind}.id']
+        return tuple((ids[row], self._text(f'{kind}.name', row)) for row in range(len(ids)))
+
+class CatalogSnapshot(object):
+    """The snapshot file of an app's catalog, built when it's missing."""
+
+    def __init__(self):
+        self.path = None
+        self._snapshot = None
+
+    def init_app(self, app):
+        """Use the app's SNAPSHOT_PATH, or catalog.snapshot in its instance folder."""
+        self.path = app.config['SNAPSHOT_PATH'] or os.path.join(app.instance_path, 'catalog.snapshot')
+
+    @contextmanager
+    def _lock(self):
+        """Hold a lock shared by every process using the file."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.lock', 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            yield
+
+    def get(self):
+        """Return the current Snapshot, building the file if it's missing."""
+        snapshot = self._snapshot
+        try:
+            if snapshot is not None and os.stat(self.path).st_mtime_ns == snapshot.stamp:
+                return snapshot
+            # Replaced files are moved into place whole, so need no lock
+            snapshot = Snapshot(self.path)
+        except (FileNotFoundError, ValueError):
+            with self._lock():
+                try:
+                    snapshot = Snapshot(self.path)
+                except (FileNotFoundError, ValueError):
+                    # Missing, or written by an older version of the app
+                    self._write()
+                    snapshot = Snapshot(self.path)
+        self._snapshot = snapshot
+        return snapshot
+
+    def _write(self):
+        with db.engine.connect() as connection:
+            write(self.path, build(connection))
+
+    def rebuild(self):
+        """Write a new file from the database, replacing the current one.
+
+        Builds wait for each other, so a build that read the catalog before
+        a change never replaces the file written after it.
+        """
+        with self._lock():
+            self._write()
+
+    def invalidate(self):
+        """Delete the file, once any build that's running has finished, e.g.
+        when the tables are dropped."""
+        with self._lock():
+            self._snapshot = None
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+##########################################
+#           Invalidation                 #
+##########################################
+
+def _invalidate():
+    from tracker_app import catalog_snapshot
+    if catalog_snapshot.path:
+        catalog_snapshot.invalidate()
+
+@event.listens_for(db.session, 'after_flush')
+def record_changes(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Console, Game, Genre)):
+            session.info['catalog_changed'] = True
+            return
+
+@jobs.handler('snapshot')
+def rebuild_snapshot(connection, payload):
+    from tracker_app import catalog_snapshot
+    catalog_snapshot.rebuild()
+
+@event.listens_for(db.session, 'before_commit')
+def queue_rebuild(session):
+    # Flush first, as committing only flushes after this runs
+    session.flush()
+    if session.info.pop('catalog_changed', False):
+        jobs.enqueue(session.connection(), 'snapshot', 'catalog')
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changes(session):
+    session.info.pop('catalog_changed', None)
+
+@event.listens_for(db.metadata, 'after_create')
+def after_create(target, connection, **kw):
+    _invalidate()
+
+@event.listens_for(db.metadata, 'before_drop')
+def before_drop(target, connection, **kw):
+    _invalidate()
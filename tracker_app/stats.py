@@ -0,0 +1,115 @@
+"""Catalog statistics kept in denormalized counter columns.
+
+Console.game_count, Console.owner_count, Game.owner_count and
+Genre.game_count are updated as changes are flushed, so the stats page
+reads them instead of counting rows across the association tables:
+
+- collection changes through OwnerMixin update owner counts themselves
+- games added, moved, deleted or given new genres through the session are
+  counted by the after_flush listener below
+- the importer counts each batch it inserts
+
+Anything else that writes the tables directly can make the counters drift,
+which `flask rebuild-stats` repairs.
+"""
+from collections import Counter
+
+from sqlalchemy import bindparam, event, func, inspect, select
+from tracker_app import db
+from tracker_app.models import Console, Game, Genre, User, game_genre_table, consoles_owned_table, games_owned_table
+
+TOP_LIMIT = 20
+
+CONSOLE_GAMES = Console.__table__.c.game_count
+CONSOLE_OWNERS = Console.__table__.c.owner_count
+GAME_OWNERS = Game.__table__.c.owner_count
+GENRE_GAMES = Genre.__table__.c.game_count
+
+def add_counts(connection, column, counts):
+    """Add each of counts' values to column in the row with that id."""
+    table = column.table
+    params = [{'row_id': id, 'change': change} for id, change in counts.items() if change]
+    if params:
+        connection.execute(
+            table.update()
+                .where(table.c.id == bindparam('row_id'))
+                .values({column.name: column + bindparam('change')}),
+            params)
+
+def rebuild(connection):
+    """Recompute every counter from the tables it counts."""
+    counters = [
+        (CONSOLE_GAMES, Game.__table__.c.console_id),
+        (CONSOLE_OWNERS, consoles_owned_table.c.console_id),
+        (GAME_OWNERS, games_owned_table.c.game_id),
+        (GENRE_GAMES, game_genre_table.c.genre_id),
+    ]
+    for counter, foreign_key in counters:
+        table = counter.table
+        count = select([func.count()]).where(foreign_key == table.c.id).as_scalar()
+        connection.execute(table.update().values({counter.name: count}))
+
+def _changes(obj, attribute):
+    """Return the (added, deleted) values of an attribute since it was loaded."""
+    history = inspect(obj).attrs[attribute].history
+    return history.added or (), history.deleted or ()
+
+def _count_game(game, change, consoles, genres):
+    consoles[game.console_id] += change
+    for genre in game.genres:
+        genres[genre.id] += change
+
+@event.listens_for(db.session, 'after_flush')
+def count_changes(session, flush_context):
+    consoles, console_owners, game_owners, genres = Counter(), Counter(), Counter(), Counter()
+
+    for obj in session.new:
+        if isinstance(obj, Game):
+            _count_game(obj, 1, consoles, genres)
+    for obj in session.deleted:
+        if isinstance(obj, Game):
+            _count_game(obj, -1, consoles, genres)
+
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, User):
+            # Collections changed through the relationships, not OwnerMixin
+            for owners, attribute in ((console_owners, 'consoles_owned'), (game_owners, 'games_owned')):
+                added, deleted = _changes(obj, attribute)
+                owners.update(item.id for item in added)
+                owners.subtract(item.id for item in deleted)
+
+    for obj in session.dirty:
+        if not isinstance(obj, Game):
+            continue
+        # The console can change through either the column or the relationship
+        old_ids = _changes(obj, 'console_id')[1] or \
+            [console.id for console in _changes(obj, 'console')[1] if console is not None]
+        for old_id in old_ids:
+            if old_id is not None and old_id != obj.console_id:
+                consoles[old_id] -= 1
+                consoles[obj.console_id] += 1
+        added, deleted = _changes(obj, 'genres')
+        genres.update(genre.id for genre in added)
+        genres.subtract(genre.id for genre in deleted)
+
+    connection = session.connection()
+    add_counts(connection, CONSOLE_GAMES, consoles)
+    add_counts(connection, CONSOLE_OWNERS, console_owners)
+    add_counts(connection, GAME_OWNERS, game_owners)
+    add_counts(connection, GENRE_GAMES, genres)
+
+def most_owned_games(limit=TOP_LIMIT):
+    return db.session.query(Game.id, Game.title, Game.owner_count) \
+        .filter(Game.owner_count > 0) \
+        .order_by(Game.owner_count.desc(), Game.id) \
+        .limit(limit).all()
+
+def consoles_by(counter, limit=TOP_LIMIT):
+    return db.session.query(Console.id, Console.name, counter.label('count')) \
+        .order_by(counter.desc(), Console.id) \
+        .limit(limit).all()
+
+def genres_by_game_count(limit=TOP_LIMIT):
+    return db.session.query(Genre.id, Genre.name, Genre.game_count) \
+        .order_by(Genre.game_count.desc(), Genre.name) \
+        .limit(limit).all()
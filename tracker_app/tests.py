@@ -0,0 +1,885 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+from sqlalchemy import create_engine, event, exc, inspect
+
+from tracker_app import create_app, db, catalog_snapshot
+from tracker_app.config import TestConfig
+from tracker_app import activity, facets, jobs, migrations, perf, recommendations
+from tracker_app.importer import CatalogImporter
+from tracker_app.snapshot import CatalogSnapshot
+from tracker_app.models import (Console, Game, Genre, User, activity_event_table,
+    activity_rollup_table, game_similarity_table, games_owned_table, job_table, record_activity)
+
+"""
+Run these tests with the command:
+python -m unittest discover
+"""
+
+#################################################
+# Setup
+#################################################
+
+app = create_app(TestConfig)
+
+try:
+    import numpy, scipy
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
+def write_file(suffix, text):
+    """Write text to a temporary file and return its path."""
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, 'w') as file:
+        file.write(text)
+    return path
+
+#################################################
+# Tests
+#################################################
+
+class MigrationTests(unittest.TestCase):
+    """Tests for upgrading databases made by older versions of the models."""
+
+    def setUp(self):
+        """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+    # Databases from before the upgrades were all SQLite files
+    @unittest.skipUnless(app.config['TEST_DATABASE_URI'].startswith('sqlite'), 'SQLite only')
+    def test_upgrade_association_tables(self):
+        # Replace user_game with the old version that had no keys or indexes
+        db.engine.execute('DROP TABLE user_game')
+        db.engine.execute('CREATE TABLE user_game (game_id INTEGER, user_id INTEGER)')
+        db.engine.execute('INSERT INTO user_game VALUES (1, 1), (1, 1), (2, 1), (NULL, 1)')
+
+        migrations.upgrade(db.engine)
+
+        # Duplicate and empty rows are gone and the keys and indexes exist
+        rows = db.engine.execute('SELECT game_id, user_id FROM user_game ORDER BY game_id').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(1, 1), (2, 1)])
+        inspector = inspect(db.engine)
+        self.assertEqual(
+            inspector.get_pk_constraint('user_game')['constrained_columns'],
+            ['user_id', 'game_id'])
+        self.assertIn(
+            'ix_user_game_game_id',
+            [index['name'] for index in inspector.get_indexes('user_game')])
+
+    def test_create_missing_indexes_skips_missing_tables(self):
+        db.engine.execute('DROP TABLE activity_rollup')
+        with db.engine.begin() as connection:
+            migrations.create_missing_indexes(connection)
+        self.assertNotIn('activity_rollup', inspect(db.engine).get_table_names())
+
+    def test_upgrade_is_repeatable(self):
+        migrations.upgrade(db.engine)
+        migrations.upgrade(db.engine)
+        self.assertIn(
+            'ix_game_title',
+            [index['name'] for index in inspect(db.engine).get_indexes('game')])
+
+    @unittest.skipUnless(app.config['TEST_DATABASE_URI'].startswith('sqlite'), 'SQLite only')
+    def test_upgrade_baseline_database(self):
+        # A copy of the database file checked in before any upgrades
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'database.db')
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'database.db'), path)
+        engine = create_engine(f'sqlite:///{path}')
+        self.addCleanup(engine.dispose)
+
+        migrations.upgrade(engine)
+        migrations.upgrade(engine)
+
+        # Every table, column and index of the models exists
+        inspector = inspect(engine)
+        for table in db.metadata.sorted_tables:
+            self.assertEqual(
+                {column['name'] for column in inspector.get_columns(table.name)},
+                {column.name for column in table.columns}, table.name)
+            self.assertLessEqual(
+                {index.name for index in table.indexes},
+                {index['name'] for index in inspector.get_indexes(table.name)}, table.name)
+
+    @unittest.skipUnless(app.config['TEST_DATABASE_URI'].startswith('sqlite'), 'SQLite only')
+    def test_upgrade_adds_counters(self):
+        db.engine.execute('DROP TABLE genre')
+        db.engine.execute('CREATE TABLE genre (id INTEGER PRIMARY KEY, name VARCHAR(80))')
+        db.engine.execute("INSERT INTO genre VALUES (1, 'RPG')")
+        db.engine.execute("INSERT INTO console (id, name, portable) VALUES (1, 'Game Boy', 1)")
+        db.engine.execute("INSERT INTO game (id, title, console_id) VALUES (1, 'Pokemon Red', 1)")
+        db.engine.execute('INSERT INTO game_genre VALUES (1, 1)')
+
+        migrations.upgrade(db.engine)
+        self.assertEqual(db.session.query(Genre.game_count).scalar(), 1)
+
+class StatsTests(unittest.TestCase):
+    """Tests for the stats counters."""
+
+    def setUp(self):
+        """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+    def counters(self):
+        db.session.expire_all()
+        return {
+            'consoles': [(c.game_count, c.owner_count) for c in Console.query.order_by(Console.id)],
+            'games': [game.owner_count for game in Game.query.order_by(Game.id)],
+            'genres': [genre.game_count for genre in Genre.query.order_by(Genre.id)],
+        }
+
+    def test_counters_follow_changes(self):
+        gamecube, wii = Console(name='Gamecube', portable=False), Console(name='Wii', portable=False)
+        party, sports = Genre(name='Party'), Genre(name='Sports')
+        melee = Game(title='Melee', console=gamecube, genres=[party])
+        db.session.add_all([melee, Game(title='Wii Sports', console=wii, genres=[party, sports])])
+        db.session.commit()
+        self.assertEqual(self.counters(), {
+            'consoles': [(1, 0), (1, 0)], 'games': [0, 0], 'genres': [2, 1]})
+
+        # Move a game and change its genres, then own it both ways
+        melee.console_id = wii.id
+        melee.genres = [sports]
+        user = User(username='username', password='password')
+        user.games_owned.append(melee)
+        db.session.add(user)
+        db.session.commit()
+        user.add_console(wii.id)
+        user.add_game(2)
+        db.session.commit()
+        self.assertEqual(self.counters(), {
+            'consoles': [(0, 0), (2, 1)], 'games': [1, 1], 'genres': [1, 2]})
+
+        user.remove_game(melee.id)
+        db.session.delete(Game.query.get(2))
+        db.session.commit()
+        self.assertEqual(self.counters(), {
+            'consoles': [(0, 0), (1, 1)], 'games': [0], 'genres': [0, 1]})
+
+    def test_rebuild_stats(self):
+        db.session.add(Game(title='Melee', console=Console(name='Gamecube', portable=False)))
+        db.session.commit()
+        db.engine.execute('UPDATE console SET game_count = 7')
+
+        result = app.test_cli_runner().invoke(args=['rebuild-stats'])
+        self.assertIn('Stats rebuilt', result.output)
+        self.assertEqual(self.counters()['consoles'], [(1, 0)])
+
+    def test_concurrent_add_counted_once(self):
+        console = Console(name='Gamecube', portable=False)
+        db.session.add_all([Game(title='Melee', console=console), Game(title='Zelda', console=console)])
+        user = User(username='username', password='password')
+        db.session.add(user)
+        db.session.commit()
+
+        # Another request adds Zelda between checking and inserting
+        def add_first(connection, clauseelement, multiparams, params):
+            inserts = (getattr(clauseelement, 'table', None) is games_owned_table
+                or 'INTO user_game' in getattr(clauseelement, 'text', ''))
+            if inserts and not raced:
+                raced.append(True)
+                connection.execute(games_owned_table.insert().values(user_id=user.id, game_id=2))
+        raced = []
+        event.listen(db.engine, 'before_execute', add_first)
+        self.addCleanup(event.remove, db.engine, 'before_execute', add_first)
+
+        self.assertEqual(user.add_games([1, 2]), {1: 'added', 2: 'already_owned'})
+        db.session.commit()
+        self.assertEqual(self.counters()['games'], [1, 0])
+        self.assertFalse(user.add_game(1))
+
+        # - And a double submit of one add
+        db.session.execute(games_owned_table.delete().where(games_owned_table.c.game_id == 2))
+        raced.clear()
+        self.assertFalse(user.add_game(2))
+        db.session.commit()
+        self.assertEqual(self.counters()['games'], [1, 0])
+
+class SnapshotTests(unittest.TestCase):
+    """Tests for the catalog snapshot."""
+
+    def setUp(self):
+        """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        gamecube = Console(name='Gamecube', company='Nintendo', portable=False)
+        party, sports = Genre(name='Party'), Genre(name='Sports')
+        db.session.add_all([
+            gamecube,
+            Console(name='Game Boy', portable=True),
+            Game(title='Pokémon Colosseum', console=gamecube, personal_rating=4),
+            Game(title='Mario Party 4', console=gamecube, genres=[sports, party]),
+        ])
+        db.session.commit()
+
+    def test_snapshot_rows(self):
+        snapshot = catalog_snapshot.get()
+
+        game = snapshot.game(2)
+        self.assertEqual(
+            (game.title, game.publisher, game.personal_rating, game.console.name),
+            ('Mario Party 4', '', None, 'Gamecube'))
+        self.assertEqual(sorted(genre.name for genre in game.genres), ['Party', 'Sports'])
+        self.assertEqual(snapshot.game(1).title, 'Pokémon Colosseum')
+        self.assertEqual(snapshot.game(1).personal_rating, 4)
+        self.assertIsNone(snapshot.game(3))
+
+        console = snapshot.console(1)
+        self.assertEqual((console.company, console.portable, console.game_count), ('Nintendo', False, 2))
+        self.assertTrue(snapshot.console(2).portable)
+
+        # Pages seek past the given id
+        page = snapshot.console_games(1, 0, 1)
+        self.assertEqual([game.title for game in page], ['Pokémon Colosseum'])
+        page = snapshot.console_games(1, page.next_after, 1)
+        self.assertEqual(([game.id for game in page], page.next_after), ([2], None))
+        self.assertEqual([console.id for console in snapshot.consoles(1, 10)], [2])
+        self.assertEqual(len(snapshot.console_games(2, 0, 10)), 0)
+        self.assertEqual(snapshot.choices('genre'), tuple((genre.id, genre.name) for genre in Genre.query.order_by(Genre.id)))
+
+    def test_commit_replaces_snapshot(self):
+        snapshot = catalog_snapshot.get()
+        # Another worker, sharing the file
+        worker = CatalogSnapshot()
+        worker.path = catalog_snapshot.path
+        self.assertEqual(worker.get().stamp, snapshot.stamp)
+        self.assertIs(catalog_snapshot.get(), snapshot)
+
+        Game.query.get(2).title = 'Mario Party 5'
+        db.session.commit()
+        # Readers keep the file they have until the queued job replaces it
+        self.assertIs(catalog_snapshot.get(), snapshot)
+        self.assertEqual(worker.get().game(2).title, 'Mario Party 4')
+        jobs.Worker(app).run_once()
+        self.assertEqual(catalog_snapshot.get().game(2).title, 'Mario Party 5')
+        self.assertEqual(worker.get().game(2).title, 'Mario Party 5')
+        self.assertNotEqual(worker.get().stamp, snapshot.stamp)
+        # Views of the old file stay readable
+        self.assertEqual(snapshot.game(2).title, 'Mario Party 4')
+
+    def test_only_job_rebuilds_after_writes(self):
+        snapshot = catalog_snapshot.get()
+        stamp = os.stat(catalog_snapshot.path).st_mtime_ns
+        Game.query.get(2).title = 'Mario Party 5'
+        db.session.commit()
+        Console.query.get(2).name = 'Game Boy Color'
+        db.session.commit()
+
+        # Reads right after the writes run no queries and keep the file
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', record)
+        self.assertIs(catalog_snapshot.get(), snapshot)
+        self.assertEqual(catalog_snapshot.get().game(2).title, 'Mario Party 4')
+        self.assertEqual(statements, [])
+        self.assertEqual(os.stat(catalog_snapshot.path).st_mtime_ns, stamp)
+
+        # Both writes queued one job, which writes the new file
+        waiting = job_table.select().where(job_table.c.kind == 'snapshot')
+        self.assertEqual(len(db.engine.execute(waiting).fetchall()), 1)
+        jobs.Worker(app).run_once()
+        self.assertEqual(db.engine.execute(waiting).fetchall(), [])
+        self.assertNotEqual(catalog_snapshot.get().stamp, stamp)
+        self.assertEqual(catalog_snapshot.get().game(2).title, 'Mario Party 5')
+        self.assertEqual(catalog_snapshot.get().console(2).name, 'Game Boy Color')
+
+    def test_unreadable_file_rebuilt(self):
+        catalog_snapshot.invalidate()
+        with open(catalog_snapshot.path, 'wb') as file:
+            file.write(b'not a snapshot')
+        self.assertEqual(catalog_snapshot.get().console(1).name, 'Gamecube')
+
+class FacetTests(unittest.TestCase):
+    """Tests for browsing games by facets."""
+
+    def setUp(self):
+        """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        rng = random.Random(0)
+        genres = [Genre(name=f'Genre {i}') for i in range(5)]
+        consoles = [Console(name=f'Console {i}', portable=i % 3 == 0) for i in range(7)]
+        db.session.add_all(genres)
+        for i in range(300):
+            db.session.add(Game(
+                title=f'Game {i}', console=rng.choice(consoles),
+                publisher=rng.choice(['Sega', 'Nintendo', 'Konami', None]),
+                personal_rating=rng.choice([None, 1, 5, 8, 9, 10]),
+                genres=rng.sample(genres, rng.randint(0, 2))))
+        db.session.commit()
+
+    def query(self, filters):
+        """Return the ids of the games matching filters, by SQL."""
+        query = Game.query.join(Console)
+        if filters.console:
+            query = query.filter(Game.console_id.in_(filters.console))
+        if filters.genre:
+            query = query.filter(Game.genres.any(Genre.id.in_(filters.genre)))
+        if filters.publisher:
+            query = query.filter(Game.publisher.in_(filters.publisher))
+        if filters.min_rating is not None:
+            query = query.filter(Game.personal_rating >= filters.min_rating)
+        if filters.max_rating is not None:
+            query = query.filter(Game.personal_rating <= filters.max_rating)
+        if filters.portable is not None:
+            query = query.filter(Console.portable == filters.portable)
+        return {game.id for game in query}
+
+    def test_browse_matches_queries(self):
+        snapshot = catalog_snapshot.get()
+        for filters in [
+            facets.Filters([], [], [], None, None, None),
+            facets.Filters([1, 3], [], [], None, None, None),
+            facets.Filters([], [2, 4], ['Sega'], 8, None, None),
+            facets.Filters([], [1], [], None, 5, True),
+            facets.Filters([2], [], ['Konami', 'Nintendo'], 5, 9, False),
+            facets.Filters([99], [], ['Nobody'], None, None, None),
+        ]:
+            result = facets.browse(snapshot, filters, 0, 500)
+            expected = self.query(filters)
+            self.assertEqual({game.id for game in result.games}, expected)
+            self.assertEqual(result.total, len(expected))
+
+            # Each facet's counts are what picking that value alone would match
+            for value in result.facets['genre'] + result.facets['publisher']:
+                dimension = 'genre' if value in result.facets['genre'] else 'publisher'
+                self.assertEqual(value.count, len(self.query(filters._replace(**{dimension: [value.value]}))))
+            for value in result.facets['portable']:
+                self.assertEqual(value.count, len(self.query(filters._replace(portable=value.value))))
+
+    def test_browse_pages(self):
+        snapshot = catalog_snapshot.get()
+        filters = facets.Filters([], [], ['Sega'], None, None, None)
+        seen, after = [], 0
+        while after is not None:
+            page = facets.browse(snapshot, filters, after, 7).games
+            seen += [game.id for game in page]
+            after = page.next_after
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(set(seen), self.query(filters))
+
+class ActivityTests(unittest.TestCase):
+    """Tests for the activity log, its rollups and feeds."""
+
+    def setUp(self):
+        """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        console = Console(name='Gamecube', portable=False)
+        db.session.add_all([
+            Game(title='Melee', console=console),
+            Game(title='Zelda', console=console),
+        ])
+        self.users = [User(username=f'user{i}', password='password') for i in range(3)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def rollups(self):
+        """Return each item's count per action, over every day."""
+        rollup = activity_rollup_table
+        counts = {}
+        for item, item_id, action, count in db.session.query(
+                rollup.c.item, rollup.c.item_id, rollup.c.action, rollup.c.count):
+            counts[item, item_id, action] = counts.get((item, item_id, action), 0) + count
+        return counts
+
+    def test_commit_writes_events_and_rollups(self):
+        self.users[0].add_games([1, 2])
+        self.users[0].add_console(1)
+        self.users[1].add_game(1)
+        self.users[1].add_game(1)
+        self.users[0].remove_game(2)
+        db.session.commit()
+
+        # - Newest first, only what changed
+        events = activity.feed()
+        self.assertEqual(
+            [(event.username, event.action, event.item, event.name) for event in events],
+            [('user0', 'remove', 'game', 'Zelda'), ('user1', 'add', 'game', 'Melee'),
+             ('user0', 'add', 'console', 'Gamecube'), ('user0', 'add', 'game', 'Zelda'),
+             ('user0', 'add', 'game', 'Melee')])
+        self.assertEqual([event.username for event in activity.feed(self.users[1].id)], ['user1'])
+        # - Paging back from the oldest event shown
+        page = activity.feed(limit=2)
+        self.assertEqual(
+            [event.id for event in activity.feed(before=page.next_after)],
+            [event.id for event in events][2:])
+
+        # - Each commit adds to the day's counts
+        self.users[2].add_game(1)
+        db.session.commit()
+        self.assertEqual(self.rollups(), {
+            ('game', 1, 'add'): 3, ('game', 2, 'add'): 1, ('game', 2, 'remove'): 1,
+            ('console', 1, 'add'): 1})
+        self.assertEqual(activity.trending(), [(1, 'Melee', 3), (2, 'Zelda', 1)])
+        self.assertEqual(activity.daily_counts('game', 1), {'add': [(activity.day_of(time.time()), 3)]})
+
+    def test_rollback_forgets_events(self):
+        self.users[0].add_game(1)
+        record_activity(self.users[0].id, 'edit', 'game', [1])
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(db.session.query(activity_event_table).count(), 0)
+        self.assertEqual(self.rollups(), {})
+
+    def test_compact_keeps_rollups(self):
+        now = time.time()
+        with db.engine.begin() as connection:
+            activity.write(connection, [(1, 'add', 'game', 1), (2, 'add', 'game', 1)], now - 100 * 86400)
+            activity.write(connection, [(3, 'add', 'game', 1)], now)
+
+        deleted = activity.compact(db.engine, now - 90 * 86400, batch_size=1)
+        self.assertEqual(deleted, 2)
+        self.assertEqual([event.user_id for event in activity.feed()], [3])
+        # - The rollups count the deleted events, on their own day
+        self.assertEqual(self.rollups(), {('game', 1, 'add'): 3})
+        self.assertEqual(activity.trending(), [(1, 'Melee', 1)])
+        self.assertEqual(len(activity.daily_counts('game', 1, days=365)['add']), 2)
+
+class RecommendationTests(unittest.TestCase):
+    """Tests for similar games and recommendations."""
+
+    def setUp(self):
+        """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        console = Console(name='Gamecube', portable=False)
+        action, puzzle = Genre(name='Action'), Genre(name='Puzzle')
+        db.session.add_all([
+            Game(title='Melee', console=console, genres=[action]),
+            Game(title='Zelda', console=console, genres=[action]),
+            Game(title='Tetris', console=console, genres=[puzzle]),
+            Game(title='Dr Mario', console=console, genres=[puzzle]),
+            Game(title='Puyo Pop', console=console, genres=[puzzle]),
+        ])
+        self.users = [User(username=f'user{i}', password='password') for i in range(3)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def similar_ids(self, game_id):
+        return [(id, co_owners) for id, _, co_owners in recommendations.similar_games(game_id)]
+
+    def recommended_ids(self, user_id):
+        return [id for id, _ in recommendations.recommended_games(user_id)]
+
+    @unittest.skipUnless(HAS_SCIPY, 'needs numpy and scipy')
+    def test_rebuild_recommendations(self):
+        for user, game_ids in zip(self.users, ([1, 2], [1, 2, 3], [3, 4])):
+            user.add_games(game_ids)
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['rebuild-recommendations'])
+        self.assertIn('Stored', result.output)
+
+        # - Games owned by the same users come first
+        self.assertEqual(self.similar_ids(1), [(2, 2), (3, 1)])
+        self.assertEqual(self.similar_ids(3)[0], (4, 1))
+        # - Games nobody owns get popular games of the same genre
+        self.assertEqual(self.similar_ids(5), [(3, 0), (4, 0)])
+        # - Users get games similar to theirs that they don't own
+        self.assertEqual(self.recommended_ids(1), [3])
+        self.assertEqual(self.recommended_ids(3), [1, 2, 5])
+
+    def test_collection_changes_update_index(self):
+        db.engine.execute(game_similarity_table.insert(), [
+            {'game_id': 1, 'similar_id': 2, 'co_owners': 1, 'score': 0.5},
+            {'game_id': 2, 'similar_id': 1, 'co_owners': 1, 'score': 0.5},
+            {'game_id': 1, 'similar_id': 3, 'co_owners': 0, 'score': 0.1},
+        ])
+        worker = jobs.Worker(app)
+        first, second = self.users[:2]
+        first.add_game(1)
+        db.session.commit()
+        # - The update is left to a job
+        self.assertEqual(self.recommended_ids(1), [])
+        worker.run_once()
+        self.assertEqual(self.recommended_ids(1), [2, 3])
+
+        # - Owning both games of a stored pair adds a co-owner
+        second.add_games([1, 2])
+        db.session.commit()
+        worker.run_once()
+        self.assertEqual(self.similar_ids(1), [(2, 2), (3, 0)])
+        self.assertEqual(self.similar_ids(2), [(1, 2)])
+        self.assertEqual(self.recommended_ids(2), [3])
+
+        # - Removing one takes it away again
+        second.remove_game(2)
+        db.session.commit()
+        worker.run_once()
+        self.assertEqual(self.similar_ids(1), [(2, 1), (3, 0)])
+        self.assertEqual(self.recommended_ids(2), [2, 3])
+
+calls = []
+
+@jobs.handler('test', merge=lambda waiting, new: {'values': waiting['values'] + new['values']})
+def record_call(connection, payload):
+    if payload.get('fail'):
+        raise ValueError('failed on purpose')
+    calls.append(payload)
+
+class JobTests(unittest.TestCase):
+    """Tests for the background job queue."""
+
+    def setUp(self):
+        """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        calls.clear()
+        self.worker = jobs.Worker(app)
+
+    def enqueue(self, key, payload):
+        with db.engine.begin() as connection:
+            jobs.enqueue(connection, 'test', key, payload)
+
+    def job_rows(self):
+        return db.engine.execute(
+            job_table.select().where(job_table.c.kind == 'test').order_by(job_table.c.id)).fetchall()
+
+    def test_waiting_jobs_merged(self):
+        self.enqueue(1, {'values': [1]})
+        self.enqueue(1, {'values': [2]})
+        self.enqueue(2, {'values': [3]})
+        self.assertEqual(len(self.job_rows()), 2)
+
+        self.assertEqual(self.worker.run_once(), 2)
+        self.assertEqual(calls, [{'values': [1, 2]}, {'values': [3]}])
+        self.assertEqual(self.job_rows(), [])
+        self.assertEqual(self.worker.metrics()['succeeded'], 2)
+
+    def test_running_jobs_not_merged_or_run_twice(self):
+        self.enqueue(1, {'values': [1]})
+        with db.engine.begin() as connection:
+            [claimed] = jobs.claim(connection, 10, lease=60)
+        # - A job queued while the first runs waits for it to finish
+        self.enqueue(1, {'values': [2]})
+        self.assertEqual(self.worker.run_once(), 0)
+
+        jobs.run(claimed)
+        self.assertEqual(self.worker.run_once(), 1)
+        self.assertEqual(calls, [{'values': [1]}, {'values': [2]}])
+
+    def test_expired_claims_run_again(self):
+        self.enqueue(1, {'values': [1]})
+        with db.engine.begin() as connection:
+            jobs.claim(connection, 10, lease=-1)
+        self.assertEqual(self.worker.run_once(), 1)
+        self.assertEqual(calls, [{'values': [1]}])
+
+    def test_poll_survives_errors(self):
+        self.enqueue(1, {'values': [1]})
+        claim = jobs.claim
+        def locked(connection, limit, lease):
+            jobs.claim = claim
+            raise exc.OperationalError('SELECT', {}, Exception('database is locked'))
+        jobs.claim = locked
+        self.addCleanup(setattr, jobs, 'claim', claim)
+
+        # The error is logged and the next poll waits longer
+        with self.assertLogs(app.logger, 'ERROR') as logs:
+            wait = self.worker.poll()
+        self.assertIn('Polling for jobs failed', logs.output[0])
+        self.assertEqual(wait, app.config['JOB_POLL_INTERVAL'] * 2)
+        self.assertEqual(calls, [])
+
+        self.assertEqual(self.worker.poll(), 0)
+        self.assertEqual(calls, [{'values': [1]}])
+        self.assertEqual(self.worker.failures, 0)
+
+    def test_failed_jobs_retried_with_backoff(self):
+        self.enqueue(1, {'values': [], 'fail': True})
+        stats = lambda: jobs.queue_stats(db.engine)['test']
+
+        with self.assertLogs(app.logger, 'ERROR'):
+            self.assertEqual(self.worker.run_once(), 1)
+        job = self.job_rows()[0]
+        self.assertEqual((job.attempts, job.failed), (1, False))
+        self.assertIn('failed on purpose', job.error)
+        # - It isn't due again until the delay has passed
+        self.assertAlmostEqual(job.run_at - job.created_at, jobs.RETRY_DELAY, delta=1)
+        self.assertEqual(self.worker.run_once(), 0)
+        self.assertEqual(stats()['waiting'], 1)
+
+        # - Its last attempt marks it as failed
+        for attempt in range(2, app.config['JOB_MAX_ATTEMPTS'] + 1):
+            db.engine.execute(job_table.update().values(run_at=0))
+            with self.assertLogs(app.logger, 'ERROR'):
+                self.worker.run_once()
+        job = self.job_rows()[0]
+        self.assertEqual((job.attempts, job.failed), (app.config['JOB_MAX_ATTEMPTS'], True))
+        self.assertEqual(stats()['failed'], 1)
+        db.engine.execute(job_table.update().values(run_at=0))
+        self.assertEqual(self.worker.run_once(), 0)
+
+    def test_worker_command(self):
+        self.enqueue(1, {'values': [1]})
+        result = app.test_cli_runner().invoke(args=['worker', '--once'])
+        self.assertIn('Ran 1 jobs', result.output)
+        self.assertEqual(calls, [{'values': [1]}])
+
+class ImportTests(unittest.TestCase):
+    """Tests for the import-catalog command."""
+
+    def setUp(self):
+        """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        self.runner = app.test_cli_runner()
+
+    def import_file(self, kind, suffix, text):
+        path = write_file(suffix, text)
+        self.addCleanup(os.remove, path)
+        return self.runner.invoke(args=['import-catalog', path, '--kind', kind, '--batch-size', '2'])
+
+    def test_import_consoles_and_games(self):
+        db.session.add(Genre(name='RPG'))
+        db.session.commit()
+
+        consoles = 'name,company,portable,console_notes\nGamecube,Nintendo,false,\nGame Boy,Nintendo,true,Brick\n'
+        result = self.import_file('consoles', '.csv', consoles)
+        self.assertIn('Imported 2 consoles, skipped 0', result.output)
+
+        games = '\n'.join(json.dumps(row) for row in [
+            {'title': 'Pokemon Red', 'console': 'Game Boy', 'genres': ['RPG', 'Adventure']},
+            {'title': 'Tetris', 'console': 'Game Boy', 'personal_rating': 9, 'genres': ['Puzzle']},
+            {'title': 'Melee', 'console': 'Gamecube', 'genres': ['Fighting', 'Puzzle']},
+            {'title': 'Halo', 'console': 'Xbox'},
+        ])
+        result = self.import_file('games', '.jsonl', games)
+        self.assertIn('Imported 3 games, skipped 1', result.output)
+        self.assertIn('rows/sec', result.output)
+
+        # Genre names are matched to existing genres instead of duplicated
+        self.assertEqual(
+            sorted(genre.name for genre in Genre.query),
+            ['Adventure', 'Fighting', 'Puzzle', 'RPG'])
+        red = Game.query.filter_by(title='Pokemon Red').one()
+        self.assertEqual(red.console.name, 'Game Boy')
+        self.assertEqual(sorted(genre.name for genre in red.genres), ['Adventure', 'RPG'])
+        self.assertEqual(Game.query.filter_by(title='Tetris').one().personal_rating, 9)
+        self.assertTrue(Console.query.filter_by(name='Game Boy').one().portable)
+        self.assertEqual(Console.query.filter_by(name='Game Boy').one().game_count, 2)
+        self.assertEqual(Genre.query.filter_by(name='Puzzle').one().game_count, 2)
+
+    def test_import_games_csv_after_existing_rows(self):
+        db.session.add(Game(title='NBA 2K3', console=Console(name='Gamecube', portable=False)))
+        db.session.commit()
+
+        games = 'title,publisher,console,genres\nMelee,Nintendo,Gamecube,Fighting|Party\n,,Gamecube,\n'
+        result = self.import_file('games', '.csv', games)
+        self.assertIn('Imported 1 games, skipped 1', result.output)
+
+        melee = Game.query.filter_by(title='Melee').one()
+        self.assertEqual(melee.id, 2)
+        self.assertEqual(melee.publisher, 'Nintendo')
+        self.assertEqual(sorted(genre.name for genre in melee.genres), ['Fighting', 'Party'])
+
+        # New rows get ids after the imported ones
+        db.session.add(Game(title='Halo', console_id=1))
+        db.session.commit()
+        self.assertEqual(Game.query.filter_by(title='Halo').one().id, 3)
+
+    def test_import_alongside_site_writes(self):
+        db.session.add(Console(name='Gamecube', portable=False))
+        db.session.commit()
+        importer = CatalogImporter(db.engine)
+
+        # The site creates a game and a genre after the import started
+        db.session.add(Game(title='NBA 2K3', console_id=1, genres=[Genre(name='Sports')]))
+        db.session.commit()
+
+        rows = [
+            {'title': 'Melee', 'console': 'Gamecube', 'genres': ['Fighting', 'Sports']},
+            {'title': 'Mario Party', 'console': 'Gamecube', 'genres': ['Party']},
+        ]
+        result = importer.import_rows('games', rows, batch_size=1)
+        self.assertEqual((result.imported, result.skipped), (2, 0))
+        self.assertEqual(
+            [(game.id, game.title) for game in Game.query.order_by(Game.id)],
+            [(1, 'NBA 2K3'), (2, 'Melee'), (3, 'Mario Party')])
+        melee = Game.query.get(2)
+        self.assertEqual(sorted(genre.name for genre in melee.genres), ['Fighting', 'Sports'])
+        self.assertEqual(Genre.query.count(), 3)
+
+class ExportTests(unittest.TestCase):
+    """Tests for the export-catalog command."""
+
+    def setUp(self):
+        """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        self.runner = app.test_cli_runner()
+
+    def test_export_games(self):
+        game = Game(title='Melee', console=Console(name='Gamecube', portable=False), personal_rating=9)
+        game.genres = [Genre(name='Party'), Genre(name='Fighting')]
+        db.session.add(game)
+        db.session.commit()
+
+        result = self.runner.invoke(args=['export-catalog', '--kind', 'games', '--format', 'csv'])
+        self.assertEqual(result.output.splitlines(), [
+            'title,publisher,personal_rating,game_notes,console,genres',
+            'Melee,,9,,Gamecube,Fighting|Party',
+        ])
+
+        result = self.runner.invoke(args=['export-catalog', '--kind', 'consoles'])
+        self.assertEqual(json.loads(result.output), {
+            'name': 'Gamecube', 'company': None, 'portable': False, 'console_notes': None})
+
+    def test_export_import_round_trip(self):
+        db.session.add(Game(title='Melee', console=Console(name='Gamecube', portable=True)))
+        db.session.commit()
+
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.runner.invoke(args=['export-catalog', path, '--kind', 'games'])
+
+        result = self.runner.invoke(args=['import-catalog', path, '--kind', 'games'])
+        self.assertIn('Imported 1 games', result.output)
+        self.assertEqual(Game.query.filter_by(title='Melee').count(), 2)
+
+class AppFactoryTests(unittest.TestCase):
+    """Tests for building the app."""
+
+    def test_create_app_leaves_database_alone(self):
+        # - Build an app for a database file that doesn't exist yet
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'new.db')
+
+        class NewDatabaseConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = f'sqlite:///{path}'
+
+        new_app = create_app(NewDatabaseConfig)
+        # - Check that nothing connected to the database
+        self.assertFalse(os.path.exists(path))
+
+        # - Check that init-db creates the tables
+        result = new_app.test_cli_runner().invoke(args=['init-db'])
+        self.assertIn('Database initialized', result.output)
+        with new_app.app_context():
+            tables = inspect(db.engine).get_table_names()
+        self.assertIn('game', tables)
+        self.assertIn('user_game', tables)
+
+    def test_secret_key_required(self):
+        class NoSecretConfig(TestConfig):
+            SECRET_KEY = None
+
+        with self.assertRaises(RuntimeError):
+            create_app(NoSecretConfig)
+
+class PerfTests(unittest.TestCase):
+    """Tests for the request instrumentation."""
+
+    def setUp(self):
+        """Executed prior to each test."""
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        app.config['PERF_ENABLED'] = True
+        app.config['PERF_SAMPLES'] = 3
+        self.addCleanup(app.config.update, PERF_ENABLED=False, PERF_SAMPLES=1000)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        perf.reset()
+        self.app = app.test_client()
+
+    def test_request_timings(self):
+        db.session.add(Console(name='Gamecube', portable=False))
+        db.session.commit()
+
+        with self.assertLogs('tracker_app.perf', 'INFO') as logs:
+            response = self.app.get('/api/v1/consoles')
+        self.assertRegex(
+            response.headers['Server-Timing'],
+            r'^sql;dur=[\d.]+;desc="1 statements", render;dur=[\d.]+, total;dur=[\d.]+$')
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['endpoint'], 'api.consoles')
+        self.assertEqual(line['statements'], 1)
+        self.assertIn('FROM console', line['slowest_sql'])
+
+        # Rendering a page is timed too
+        response = self.app.get('/search?q=game')
+        render = float(response.headers['Server-Timing'].split('render;dur=')[1].split(',')[0])
+        self.assertGreater(render, 0)
+
+    def test_failed_statement_forgotten(self):
+        with db.engine.connect() as connection:
+            for i in range(3):
+                with self.assertRaises(exc.DBAPIError):
+                    connection.execute('SELECT * FROM no_such_table')
+            self.assertEqual(connection.info['perf_start'], {})
+            connection.execute('SELECT 1')
+            self.assertEqual(connection.info['perf_start'], {})
+
+    def test_perf_report(self):
+        for i in range(5):
+            self.app.get('/api/v1/genres')
+        report = self.app.get('/_perf').get_json()
+        self.assertEqual(list(report), ['api.genres'])
+        self.assertEqual(report['api.genres']['requests'], 5)
+        self.assertEqual(report['api.genres']['samples'], 3)
+        self.assertEqual(report['api.genres']['statements'], {'p50': 1, 'p95': 1, 'p99': 1})
+
+        app.config['PERF_ENABLED'] = False
+        self.assertEqual(self.app.get('/_perf').status_code, 404)
+        self.assertNotIn('Server-Timing', self.app.get('/api/v1/genres').headers)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(perf.percentile(values, 50), 50)
+        self.assertEqual(perf.percentile(values, 99), 99)
+        self.assertEqual(perf.percentile([7], 95), 7)